@@ -11,253 +11,505 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License
-from typing import List, Set, Dict, Tuple, TypeVar, Callable
+import time
+# 起動にかかった時間を測るため，ほかのimportより先に時刻を取る
+STARTED_AT = time.perf_counter()
+
+import asyncio  # noqa: I100  timeは時刻を取るために先に読み込む
 import os
-import os.path
-import io
-import queue
-import asyncio
-
-import pickle
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import signal
+from typing import Dict, List, Optional
+
 import discord
-from discord import Intents
-from apiclient.discovery import build
-from discord.player import FFmpegPCMAudio
 from discord.channel import VoiceChannel
-import youtube_dl
-import MySQLdb
-import requests
-from bs4 import BeautifulSoup
 
-import commands
 from dotenv import load_dotenv
 load_dotenv()
-TOKEN = os.environ['TOKEN']
-CLOUD_CREDENTIALS_SECRET = os.environ['CLOUD_CREDENTIALS_SECRET']
 
-intents: Intents = discord.Intents.all()
-client = discord.Client(intents=intents)
+import audio_cache
+from audio_cache import cache
+import commands
+import drive
+import drive_index
+import health
+import image_search
+import outbox
+from player import get_player, GuildPlayer, players, remove_player, Track
+import profiles
+import queue_store
+import resolver
+import sharding
+from utils import metrics
+from utils.logging import logger
+import youtube
+
+# 起動してからDiscordにつながる（on_ready）までの目安の秒数．超えたらログに警告を出す
+STARTUP_BUDGET = float(os.environ.get("STARTUP_BUDGET", 5))
+
+# 使うイベントだけを受け取る．SHARD_COUNTがあればシャーディングする（sharding.py）
+client = sharding.make_client()
 voiceChannel: VoiceChannel 
 
-# -------------google drive 認証-------------------------------------------------
-import json
-from oauth2client.service_account import ServiceAccountCredentials
-
-def get_cred_config() -> Dict[str, str]:
-    secret = os.environ.get("CLOUD_CREDENTIALS_SECRET")
-    if secret:
-        return json.loads(secret)
-
-key = get_cred_config()
-scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-credentials = ServiceAccountCredentials.from_json_keyfile_dict(key, scope)
+drive_sync_task: Optional[asyncio.Task] = None
+# ギルドごとの，保存されていたキューを戻す処理（1回だけ）
+restore_tasks: Dict[int, "asyncio.Future[bool]"] = {}
+STARTUP_SECONDS = metrics.REGISTRY.gauge(
+    "bot_startup_seconds", "Seconds from process start to the end of each startup phase", ["phase"]
+)
 
-service = build('drive', 'v3', credentials=credentials)
-# --------------------------------------------------------------------------------
+# 処理時間を測るコマンド（それ以外のメッセージはラベルを増やさないよう測らない）
+TIMED_COMMANDS = {'/'+name.split()[0] for name in commands.commands} | {'/bye', '/help', '/name'}
+# ギルドのプレイヤーを使うコマンド
+PLAYER_COMMANDS = ('/play', '/stop', '/skip', '/remove', '/move', '/clear', '/pause', '/resume', '/list', '/bye')
 
 
-voice = None
-audio_queue = queue.Queue()
-audiofile_list = []
-# 再生キューに曲があるか確認
-def check_queue(e):
-    os.remove(audiofile_list.pop(0))
-    try:
-        if not audio_queue.empty():
-            audio_source = audio_queue.get()
-            voice.play(audio_source,after=check_queue)
-    except:
-        print(e)
-
 # 起動時に動作する処理
 @client.event
-async def on_ready():
+async def on_ready() -> None:
     # 起動したらターミナルにログイン通知が表示される
     print('ログインしました')
-
-# メッセージ受信時に動作する処理
+    # 再接続でも呼ばれるので，起動時の処理は1回だけ行う
+    global drive_sync_task
+    if drive_sync_task is None:
+        record_startup("ready")
+        drive_sync_task = asyncio.create_task(warm_up())
+        asyncio.create_task(restore_saved_queues())
+
+
+def record_startup(phase: str) -> None:
+    elapsed = time.perf_counter() - STARTED_AT
+    STARTUP_SECONDS.set(elapsed, phase=phase)
+    logger.info("startup", phase=phase, seconds=round(elapsed, 3), budget=STARTUP_BUDGET)
+    if phase == "ready" and elapsed > STARTUP_BUDGET:
+        logger.warning("startup over budget", phase=phase, seconds=round(elapsed, 3), budget=STARTUP_BUDGET)
+
+
+# 重いもの（Driveの認証とAPIクライアント，youtube_dl）はつながってから裏で用意する．
+# 先にコマンドが来ても，それぞれ最初に使うときに用意されるので問題ない
+async def warm_up() -> None:
+    loop = asyncio.get_running_loop()
+    try:
+        await asyncio.gather(
+            loop.run_in_executor(None, drive.get_service),
+            loop.run_in_executor(None, youtube.warm_up),
+            loop.run_in_executor(None, profiles.reload),
+        )
+    except Exception as e:
+        print(e)
+    record_startup("warm")
+    await drive_index.sync_forever()
+
+
+# 再起動の前のキューを戻す（ギルドごとに1回）．曲は解決し直さず，保存したYouTubeの情報とキャッシュのキーをそのまま使う．
+# voice_channelは/playでこれから入るボイスチャンネル
+async def restore_queue(guild: discord.Guild, voice_channel: Optional[VoiceChannel] = None) -> None:
+    while True:
+        task = restore_tasks.get(guild.id)
+        if task is None or (task.done() and not task.result() and voice_channel is not None):
+            task = restore_tasks[guild.id] = asyncio.ensure_future(_restore_queue(guild, voice_channel))
+        # 誰も聞いていなくて戻さなかったときは，/playで入るチャンネルが決まっていれば戻し直す
+        if await task or voice_channel is None:
+            return
+
+
+# 保存したボイスチャンネルにまだ誰かいればそこへ，いなければvoice_channelへ入り直してから曲を戻す．
+# どちらもなければ（誰も聞いていなければ）ダウンロードもpinもせず，Falseを返して次の/playを待つ
+async def _restore_queue(guild: discord.Guild, voice_channel: Optional[VoiceChannel]) -> bool:
+    # 古い形の行やボイスチャンネルにつなげないときも，コマンドは止めずに続ける
+    # （失敗したタスクを次のメッセージでまた待って同じ例外を受け取らないように，ここで握りつぶす）
+    try:
+        state = await queue_store.store.load(guild.id)
+        if not state:
+            return True
+        tracks = [Track.from_dict(t) for t in state['queue']]
+        if state['now_playing']:
+            tracks.insert(0, Track.from_dict(state['now_playing']))
+        if not tracks:
+            return True
+        saved = guild.get_channel(state['voice_channel_id'] or 0)
+        if isinstance(saved, VoiceChannel) and any(not m.bot for m in saved.members):
+            voice_channel = saved
+        if voice_channel is None:
+            return False
+        player = get_player(guild)
+        player.channel = guild.get_channel(state['text_channel_id'] or 0)
+        await player.connect(voice_channel)
+        for track in tracks:
+            cache.pin(track.cache_key)
+            player.enqueue(track)
+        if player.channel is not None:
+            outbox.post(player.channel, "**"+tracks[0].title+"**の続きから再生するね！")
+    except Exception as e:
+        print("キューを戻せませんでした", guild.id, repr(e))
+    return True
+
+
+# つながったあと，保存されているキューのうち誰かが聞いているギルドの分だけを裏で戻す
+# （ほかのギルドは最初の/playで戻す）
+async def restore_saved_queues() -> None:
+    try:
+        guild_ids = await queue_store.store.saved_guilds()
+    except Exception as e:
+        print("キューを読み込めませんでした", repr(e))
+        return
+    for guild_id in guild_ids:
+        guild = client.get_guild(guild_id)  # 他のシャードのギルドは飛ばす
+        if guild is not None:
+            await restore_queue(guild)
+
+
+# コマンドを送った人がいるボイスチャンネル（いなければ最初のボイスチャンネル）
+def get_voice_channel(message: discord.Message) -> VoiceChannel:
+    state = getattr(message.author, 'voice', None)
+    if state and state.channel:
+        return state.channel
+    return message.guild.voice_channels[0]
+
+
+# 曲を再生する（再生中、一時停止中はキューに入れる）
+async def play_track(message: discord.Message, player: GuildPlayer, voice_channel: VoiceChannel,
+                     track: Track) -> None:
+    cache.pin(track.cache_key)  # 再生し終わるまでキャッシュから追い出さない
+    await player.connect(voice_channel)  # ボイチャ接続
+    if player.enqueue(track):
+        outbox.post(message.channel, "**"+track.title+"**を再生するよー♪")
+    else:
+        outbox.post(message.channel, "**"+track.title+"**を再生リストに入れておくね！")
+
+
+# YouTubeの動画を再生する（前に再生した曲はキャッシュのタイトルを使う）
+async def play_youtube(message: discord.Message, player: GuildPlayer, voice_channel: VoiceChannel,
+                       url: str) -> None:
+    key = youtube.cache_key(url)
+    data = None
+    if key and key in cache:
+        title = cache.get_meta(key).get('title', key)
+    else:
+        data = await youtube.resolve(url)
+        title = data['title']
+        key = audio_cache.make_key('youtube', data['id'])
+    await play_track(message, player, voice_channel, Track(title, 'youtube', url, key, data))
+
+
+# 複数の曲をまとめてキューに入れる（プレイリストやDriveのフォルダ）
+async def play_tracks(message: discord.Message, player: GuildPlayer, voice_channel: VoiceChannel,
+                      name: str, tracks: List[Track]) -> None:
+    for track in tracks:
+        cache.pin(track.cache_key)
+    await player.connect(voice_channel)  # ボイチャ接続
+    started = False
+    for track in tracks:
+        started = player.enqueue(track) or started
+    if started:
+        outbox.post(message.channel, "**"+tracks[0].title+"**を再生するよー♪")
+    outbox.post(message.channel, "**"+name+"**の"+str(len(tracks))+"曲を再生リストに入れておくね！")
+
+
+# プレイリストの曲の情報を，同時に取りに行く数を絞りながら裏で埋めていく
+async def fill_in_playlist(player: GuildPlayer, tracks: List[Track]) -> None:
+    semaphore = asyncio.Semaphore(youtube.RESOLVE_CONCURRENCY)
+
+    async def resolve(track: Track) -> None:
+        async with semaphore:
+            if track.info is not None or not any(t is track for t in player.queue):
+                return  # もう再生された（または外された）曲
+            try:
+                track.info = await youtube.resolve(track.ref)
+                track.title = track.info['title']
+            except Exception as e:
+                # 非公開・削除済みの動画はキューから外す
+                print(track.ref, e)
+                player.discard(track)
+
+    await asyncio.gather(*(resolve(track) for track in tracks))
+
+
+# 2000文字に収まるようにページに分けて，指定されたページ（なければ1ページ目）を送る
+def send_page(message: discord.Message, command: str, lines: List[str], header: str, footer: str = "") -> None:
+    pages = outbox.paginate(lines, header, footer)
+    args = message.content.split(" ")
+    number = int(args[1]) if len(args) >= 2 and args[1].isnumeric() else 1
+    number = min(max(number, 1), len(pages))
+    page = pages[number-1]
+    if len(pages) > 1:
+        page += "\n("+str(number)+"/"+str(len(pages))+")"
+        if number < len(pages):
+            page += " 続きは`"+command+" "+str(number+1)+"`"
+    outbox.post(message.channel, page)
+
+
+# /listの番号（1が再生中の曲）をキューの位置に直す．範囲外ならNone
+def queue_index(player: GuildPlayer, number: str) -> Optional[int]:
+    if not number.isnumeric():
+        return None
+    index = int(number) - (2 if player.now_playing else 1)
+    if 0 <= index < len(player.queue):
+        return index
+    return None
+
+
+# メッセージ受信時に動作する処理（コマンドごとに処理時間を測る）
 @client.event
-async def on_message(message):
-    global voice
+async def on_message(message: discord.Message) -> None:
+    words = message.content.split(maxsplit=1)
+    command = words[0] if words else ''
+    if command not in TIMED_COMMANDS:
+        await handle_message(message)
+        return
+    with metrics.COMMAND_SECONDS.time(command=command[1:]):
+        await handle_message(message)
+
+
+async def handle_message(message: discord.Message) -> None:
     # メッセージ送信者がBotだった場合は無視する
     if message.author.bot:
         return
+    # DMではギルドごとのプレイヤーがないので無視する
+    if message.guild is None:
+        return
+    # プレイヤー（と保存されていたキュー）は再生に関わるコマンドのときだけ用意する．
+    # ふつうの会話だけのギルドには作らない（/statusやギルドごとのメトリクスが増えないように）
+    if message.content.startswith(PLAYER_COMMANDS):
+        if queue_store.store.enabled:
+            # /playならこれから入るチャンネルに戻す．ほかのコマンドは誰かが聞いているときだけ戻す
+            playing = message.content.startswith('/play')
+            await restore_queue(message.guild, get_voice_channel(message) if playing else None)
+        player = get_player(message.guild)
 
 
     if message.content.startswith('/play'):
-        voice_channel = client.get_channel(message.guild.voice_channels[0].id)
-        voice_client = message.guild.voice_client
+        voice_channel = get_voice_channel(message)
 
         search_word=message.content.split(" ",1)
         # print(search_word[0])
-        if search_word[1].startswith('https://www.youtube.com'): #youtubeの場合
-            url = search_word[1]
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'outtmpl':  '%(title)s.%(ext)s' ,
-                'postprocessors': [
-                    {'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192'},
-                    {'key': 'FFmpegMetadata'},
-                ],
-            }
-            ydl = youtube_dl.YoutubeDL(ydl_opts)
-            data = ydl.extract_info(url, download=False)
-            filename = data['title'] + ".mp3"
-
-            if not os.path.exists(filename):
-                await message.channel.send("ダウンロードしてくるからちょっと待ってて！")
-                loop = asyncio.get_event_loop()
-                data = await loop.run_in_executor(None, lambda: ydl.extract_info(url, download=True))
-            
-            audio_source = discord.FFmpegPCMAudio(filename)
-            audiofile_list.append(filename)
-            if not voice: #ボイチャ接続
-                voice = await voice_channel.connect()
-            # 再生中、一時停止中はキューに入れる
-            if audio_queue.empty() and not voice.is_playing() and not voice.is_paused():
-                await message.channel.send("**"+data['title']+"**を再生するよー♪")
-                message.guild.voice_client.play(audio_source,after=check_queue)
-            else:
-                await message.channel.send("**"+filename+"**を再生リストに入れておくね！")
-                audio_queue.put(audio_source)
+        player.channel = message.channel
+        if youtube.is_playlist_url(search_word[1]): #youtubeのプレイリストの場合
+            entries = await youtube.playlist_entries(search_word[1])
+            if len(entries) == 0:
+                outbox.post(message.channel, "そのプレイリストは空っぽみたい")
+                return
+            tracks = [Track(e['title'], 'youtube', e['url'], audio_cache.make_key('youtube', e['id'])) for e in entries]
+            await play_tracks(message, player, voice_channel, "プレイリスト", tracks)
+            asyncio.create_task(fill_in_playlist(player, tracks))
+        elif youtube.is_youtube_url(search_word[1]): #youtubeの場合
+            await play_youtube(message, player, voice_channel, search_word[1])
         else: #youtube以外の場合
-            results = service.files().list(q="mimeType != 'application/vnd.google-apps.folder' and name contains '"+search_word[1]+"'",
-                pageSize=10, fields="nextPageToken, files(id, name)").execute()
-            items = results.get('files', [])
-
-            if len(items) == 0:
-                await message.channel.send("その曲はないみたい")
-            elif len(items) == 1: #1曲のときのみ再生する
-                filename = items[0]['name']
-                if not os.path.exists(filename):
-                    request = service.files().get_media(fileId=items[0]['id']) #httpリクエストを返す
-                    fh = io.FileIO(filename, "wb")
-                    downloader = MediaIoBaseDownload(fh, request)
-                    await message.channel.send("ダウンロードしてくるからちょっと待ってて！")
-                    done = False
-                    while done is False:
-                        status, done = downloader.next_chunk()
-                        print ("Download %d%%." % int(status.progress() * 100))
-
-                audio_source = discord.FFmpegPCMAudio(filename)
-                audiofile_list.append(filename)
-                if not voice: #ボイチャ接続
-                    voice = await voice_channel.connect()
-                # 再生中、一時停止中はキューに入れる
-                if audio_queue.empty() and not voice.is_playing() and not voice.is_paused():
-                    await message.channel.send("**"+filename+"**を再生するよー♪")
-                    voice.play(audio_source,after=check_queue)
-                else:
-                    await message.channel.send("**"+filename+"**を再生リストに入れておくね！")
-                    audio_queue.put(audio_source)
-            elif len(items) >= 2: #10曲まで表示する
+            # Driveのライブラリ（手元のインデックス）とYouTubeを同時に探す（時間がかかりすぎたら打ち切る）
+            found = await resolver.resolve(search_word[1])
+            choice = found.play
+            if choice is not None and choice.source == 'folder':  # フォルダの中の曲を全部入れる
+                files = await drive_index.children(choice.ref)
+                if len(files) == 0:
+                    outbox.post(message.channel, "そのフォルダは空っぽみたい")
+                    return
+                tracks = [Track(f['name'], 'drive', f['id'], audio_cache.make_key('drive', f['id'])) for f in files]
+                await play_tracks(message, player, voice_channel, choice.title, tracks)
+            elif choice is not None and choice.source == 'youtube':
+                await play_youtube(message, player, voice_channel, choice.ref)
+            elif choice is not None:
+                key = audio_cache.make_key('drive', choice.ref)
+                await play_track(message, player, voice_channel, Track(choice.title, 'drive', choice.ref, key))
+            elif len(found.candidates) >= 2: #10曲まで表示する
                 msg = "**どれにするー？**\n----------------------------\n"
-                for item in items:
-                    msg += item['name'] + "\n"
+                for candidate in found.candidates:
+                    msg += candidate.title + "\n"
                 msg += "----------------------------"
-                await message.channel.send(msg)
-    
+                outbox.post(message.channel, msg)
+            elif found.timed_out:
+                outbox.post(message.channel, "探すのに時間がかかってるみたい…もう一回試してみて")
+            else:
+                outbox.post(message.channel, "その曲はないみたい")
+
 
     if message.content.startswith('/stop'):
-        # voice_client = message.guild.voice_client
-        if voice.is_playing():
-            await message.channel.send("曲、止めちゃうの？")
-            voice.stop()
+        if player.is_connected() and player.voice.is_playing():
+            outbox.post(message.channel, "曲、止めちゃうの？")
+            player.skip()
+        else:
+            outbox.post(message.channel, "もう止まってるよ？")
+
+
+    if message.content.startswith('/skip'):
+        if player.skip():
+            outbox.post(message.channel, "次の曲いくよー！")
+        else:
+            outbox.post(message.channel, "もう止まってるよ？")
+
+
+    # ex) /remove 3
+    if message.content.startswith('/remove'):
+        args = message.content.split(" ")
+        index = queue_index(player, args[1]) if len(args) >= 2 else None
+        if index is None:
+            outbox.post(message.channel, "/listの番号で教えてね")
+        else:
+            track = player.remove(index)
+            outbox.post(message.channel, "**"+track.title+"**を再生リストから外したよ")
+
+
+    # ex) /move 5 2
+    if message.content.startswith('/move'):
+        args = message.content.split(" ")
+        src = queue_index(player, args[1]) if len(args) >= 3 else None
+        dst = queue_index(player, args[2]) if len(args) >= 3 else None
+        if src is None or dst is None:
+            outbox.post(message.channel, "/listの番号で教えてね")
+        else:
+            track = player.move(src, dst)
+            outbox.post(message.channel, "**"+track.title+"**を"+args[2]+"番目にしたよ")
+
+
+    if message.content.startswith('/clear'):
+        if player.clear():
+            outbox.post(message.channel, "再生リストを空っぽにしたよ")
         else:
-            await message.channel.send("もう止まってるよ？")
+            outbox.post(message.channel, "静かだねぇ〜")
 
 
     if message.content.startswith('/pause'):
-        # voice_client = message.guild.voice_client
-        if voice.is_paused():
-            await message.channel.send("再開は/resumeだよー")
+        if not player.is_connected():
+            outbox.post(message.channel, "もう止まってるよ？")
+        elif player.voice.is_paused():
+            outbox.post(message.channel, "再開は/resumeだよー")
         else:
-            await message.channel.send("一時停止ｸﾞｻｧｰｯ!")
-            voice.pause()
+            outbox.post(message.channel, "一時停止ｸﾞｻｧｰｯ!")
+            player.voice.pause()
 
 
     if message.content.startswith('/resume'):
-        # voice_client = message.guild.voice_client
-        if voice.is_paused():
-            await message.channel.send("再開するよ！")
-            voice.resume()
+        if player.is_connected() and player.voice.is_paused():
+            outbox.post(message.channel, "再開するよ！")
+            player.voice.resume()
         else:
-            await message.channel.send("再生中だよー")
+            outbox.post(message.channel, "再生中だよー")
 
 
+    # ex) /list、/list 2（長いときはページに分ける）
     if message.content.startswith('/list'):
-        if audiofile_list != []:
-            msg = "今の再生リストはこんな感じだよー\n----------------------------\n"
-            for i in range(0,len(audiofile_list)):
-                msg += "**"+str(i+1)+".** "+audiofile_list[i] + "\n"
-            msg += "----------------------------"
-            await message.channel.send(msg)
+        tracks = player.tracks()
+        if tracks != []:
+            lines = ["**"+str(i+1)+".** "+track.title for i, track in enumerate(tracks)]
+            send_page(message, '/list', lines, "今の再生リストはこんな感じだよー\n----------------------------\n", "\n----------------------------")
         else:
-            await message.channel.send("静かだねぇ〜")
+            outbox.post(message.channel, "静かだねぇ〜")
 
 
     # ex) /search 3 <keyword>、/search <keyword>
     if message.content.startswith('/search'):
         msg = message.content.split(" ")
-        if msg[1].isnumeric():
+        if len(msg) >= 3 and msg[1].isnumeric():
             search_word = message.content.split(" ",2)[2]
-            num_img = int(msg[1])
-            if num_img > 5:
-                num_img = 5
-            elif num_img < 1:
-                num_img = 1
-        else:
+            num_img = min(max(int(msg[1]), 1), image_search.MAX_RESULTS)
+        elif len(msg) >= 2:
             search_word = message.content.split(" ",1)[1]
             num_img = 1
-        
+        else:
+            outbox.post(message.channel, "`/search <検索数> <検索文字列>`で探すよ！")
+            return
+
         print("search word : "+search_word)
-        param = {'q': search_word}
-        response = requests.get("http://images.google.com/images",params=param)
-        print(str(response.status_code)+response.reason)
-        response.raise_for_status() #ステータスコードが200番台以外なら例外起こす．
-        soup = BeautifulSoup(response.text, 'html.parser')
-        elements = soup.select("img[src*='http']")
-        # print(elements)
-        await message.channel.send(num_img + "件探してくるね！")
-        for i in range(num_img):
-            img = elements[i]
-            await message.channel.send(img.attrs['src'])
+        try:
+            urls = await image_search.search(search_word, num_img)
+        except Exception as e:
+            print(e)
+            outbox.post(message.channel, "画像を探しに行けなかった…")
+            return
+        # 1通のメッセージにまとめて送る
+        if urls:
+            outbox.post(message.channel, str(len(urls))+"件見つけてきたよ！\n"+"\n".join(urls))
+        else:
+            outbox.post(message.channel, "画像が見つからなかった…")
 
 
 
+    # ex) /profile mano、/profile 真乃、/profile noctchill
+    if message.content.startswith('/profile'):
+        args = message.content.split(" ", 1)
+        if len(args) < 2 or args[1].strip() == "":
+            outbox.post(message.channel, "`/profile <ローマ字> or <漢字>`で探すよ！")
+            return
+        found = profiles.lookup(args[1])
+        if len(found) == 0:
+            outbox.post(message.channel, "その子は知らないなぁ…")
+        elif len(found) == 1:
+            outbox.post(message.channel, profiles.format_profile(found[0]))
+        else:
+            msg = "**どの子かなー？**\n----------------------------\n"
+            for profile in found:
+                msg += profile.name.replace(" ", "") + "（" + profile.unit + "）\n"
+            msg += "----------------------------"
+            outbox.post(message.channel, msg)
+
+
     if message.content.startswith('/yuzu'):
-        await message.channel.send("なになに？柚とお話したいの？")
+        outbox.post(message.channel, "なになに？柚とお話したいの？")
 
 
     if message.content.startswith('/name'):
-        await message.channel.send(client.user.display_name)
+        outbox.post(message.channel, client.user.display_name)
         await client.user.edit(username="DJ_Citron")
-        await message.channel.send(client.user.display_name)
+        outbox.post(message.channel, client.user.display_name)
 
 
+    # このギルドのボイスチャンネルからだけ抜ける（他のギルドの再生は続ける）
     if message.content == '/bye':
-        await message.channel.send("じゃあねー♪")
-        voice_client = message.guild.voice_client
-        if voice_client:
-            await voice_client.disconnect()
-            print("ボイスチャンネルから切断しました")
-        print("ログアウトします")
-        await client.logout()
+        outbox.post(message.channel, "じゃあねー♪")
+        await player.disconnect()
+        remove_player(message.guild.id)
+        print("ボイスチャンネルから切断しました")
+
+
+    if message.content.split(" ")[0] == '/help':
+        lines = ["`"+name+"` : "+description for name, description in commands.commands.items()]
+        send_page(message, '/help', lines, "MUSICの使い方はこちら♪\n")
 
 
-    if message.content == '/help':
-        msg = "MUSICの使い方はこちら♪\n"
-        for i in commands.commands.items():
-            msg += "`"+i[0]+"` : "+i[1]+"\n"
-        await message.channel.send(msg)
+# Botがボイスチャンネルから切断されたらそのギルドのプレイヤーを捨てる
+@client.event
+async def on_voice_state_update(member: discord.Member, before: discord.VoiceState,
+                                after: discord.VoiceState) -> None:
+    if member.id == client.user.id and before.channel and not after.channel:
+        remove_player(member.guild.id)
+
 
+record_startup("import")
 
 
-# Botの起動とDiscordサーバーへの接続
-client.run(TOKEN)
+# ヘルスチェック用のHTTPサーバーを先に立ててから，Discordサーバーに接続する
+async def run() -> None:
+    runner = await health.start(client)
+    monitor = asyncio.ensure_future(metrics.monitor_event_loop())
+    try:
+        await client.start(os.environ['TOKEN'])
+    finally:
+        monitor.cancel()
+        await shutdown()
+        await image_search.close()
+        await runner.cleanup()
+
+
+# 今の再生位置を保存してから接続を閉じる（切断でプレイヤーが消えても保存は残る）
+async def shutdown() -> None:
+    await queue_store.store.close(players())
+    await outbox.drain()
+    if not client.is_closed():
+        await client.close()
+
+
+# Botの起動（discord.pyのClientが作られたときのイベントループで動かす）
+def main() -> None:
+    loop = asyncio.get_event_loop()
+    # Cloud Runは止めるときにSIGTERMを送ってくる．接続を閉じればrunが終わる
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, lambda: loop.create_task(shutdown()))
+        except NotImplementedError:
+            pass
+    # SIGHUPでプロフィールのデータを読み直す（ファイルを書き換えれば数秒で勝手にも読み直す）
+    if hasattr(signal, 'SIGHUP'):
+        loop.add_signal_handler(signal.SIGHUP, lambda: loop.run_in_executor(None, profiles.reload, True))
+    loop.run_until_complete(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+from collections import Counter, OrderedDict
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Any, Dict, Optional
+
+CACHE_DIR = os.environ.get("AUDIO_CACHE_DIR", "audio_cache")
+# キャッシュ全体の上限（バイト）．超えたら最後に使われたのが古い順に消す
+CACHE_MAX_BYTES = int(os.environ.get("AUDIO_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+TMP_SUFFIX = ".part"
+META_SUFFIX = ".json"
+_SAFE_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def make_key(kind: str, item_id: str) -> str:
+    """'drive'や'youtube'とそのIDからキャッシュのキーを作る"""
+    if not _SAFE_ID.match(item_id):
+        item_id = hashlib.sha1(item_id.encode()).hexdigest()
+    return kind + "-" + item_id
+
+
+class AudioCache:
+    """IDをキーにした，容量上限つきのLRUな音声ファイルキャッシュ
+
+    再生中・再生待ちのファイルはpinしておけば追い出されない．
+    最後に使った時刻はファイルのmtimeに残すので，再起動しても順番は変わらない．
+    """
+
+    def __init__(self, directory: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._pins: Counter = Counter()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self) -> None:
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(TMP_SUFFIX):
+                # 前回書きかけのまま落ちたファイル
+                os.remove(path)
+            elif name.endswith(META_SUFFIX):
+                continue
+            elif os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self.total += size
+        with self._lock:
+            self._evict()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def tmp_path(self, key: str) -> str:
+        return self.path(key) + TMP_SUFFIX
+
+    def get(self, key: str) -> Optional[str]:
+        """キャッシュにあればパスを返し，最近使ったことにする"""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.discard(key)
+            return None
+        return path
+
+    def acquire(self, key: str) -> Optional[str]:
+        """キャッシュにあればpinしてパスを返す．使い終わったらunpinする"""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._pins[key] += 1
+        path = self.get(key)
+        if path is None:
+            self.unpin(key)
+        return path
+
+    def get_meta(self, key: str) -> Dict[str, Any]:
+        """曲名など，キャッシュしたファイルについての情報"""
+        try:
+            with open(self.path(key) + META_SUFFIX) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def set_meta(self, key: str, meta: Dict[str, Any]) -> None:
+        tmp = self.path(key) + META_SUFFIX + TMP_SUFFIX
+        with open(tmp, "w") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, self.path(key) + META_SUFFIX)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def pin(self, key: str) -> None:
+        """使い終わるまで追い出されないようにする．まだ書き込み中のキーでもよい"""
+        with self._lock:
+            self._pins[key] += 1
+
+    def is_pinned(self, key: str) -> bool:
+        with self._lock:
+            return self._pins[key] > 0
+
+    def unpin(self, key: str) -> None:
+        with self._lock:
+            self._pins[key] -= 1
+            if self._pins[key] <= 0:
+                del self._pins[key]
+            self._evict()
+
+    def commit(self, key: str, tmp_path: str) -> str:
+        """書き終わった一時ファイルをキャッシュに入れる"""
+        path = self.path(key)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self.total += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+        return path
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.total, "max_bytes": self.max_bytes}
+
+    # 以下は_lockを持った状態で呼ぶ
+    def _evict(self) -> None:
+        for key in list(self._entries):
+            if self.total <= self.max_bytes:
+                return
+            if self._pins[key] <= 0:
+                self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        size = self._entries.pop(key, None)
+        if size is None:
+            return
+        self.total -= size
+        for path in (self.path(key), self.path(key) + META_SUFFIX):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+cache = AudioCache()
@@ -0,0 +1,327 @@
+"""ボットのオフラインベンチマーク
+
+偽のゲートウェイ（on_messageを直接呼ぶ）・偽のボイス接続・手元のDrive/YouTubeの
+代わり（benchmarks/stubs.py）でボットを動かし，次の値を測る．
+
+- コマンドごとの処理時間（p50/p99）
+- /playから最初の音声フレームが読まれるまでの時間（キャッシュなし/あり，Drive/YouTube）
+- キューの曲を流し切る速さ（曲/秒）と曲間
+- ギルドあたりのメモリ（曲を溜めたプレイヤー1つ分，tracemallocで測る）
+- クロスフェード中のミキサーの1フレームの処理時間（ギルドの数だけ同時に重ねる）
+
+/searchは外部の画像検索に出るので測らない．
+
+    python -m benchmarks.run --json bench.json
+    python -m benchmarks.run --baseline bench.json   # 遅くなっていたら終了コード1
+"""
+
+import argparse
+import asyncio
+from collections import defaultdict
+import contextlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from typing import Callable, Dict, List, Optional, Tuple
+
+from benchmarks import stubs
+
+# 大きいほど良い値（それ以外は小さいほど良い）
+HIGHER_IS_BETTER = ("tracks_per_second",)
+
+
+def setup_environment(workdir: str) -> None:
+    # ボットのモジュールは読み込み時に環境変数を読むので，importより先に設定する
+    os.environ.update({
+        "AUDIO_CACHE_DIR": os.path.join(workdir, "audio_cache"),
+        "DRIVE_INDEX_PATH": os.path.join(workdir, "drive_index.sqlite3"),
+        # ffmpegの代わりはOpusに変換できず，ラウドネスを測るためのデコードもできない
+        "AUDIO_CACHE_OPUS": "0",
+        "LOUDNESS": "0",
+        "DRIVE_INDEX_SYNC_INTERVAL": "3600",
+    })
+    if not os.environ.get("BENCH_REAL_FFMPEG"):
+        bin_dir = os.path.join(workdir, "bin")
+        os.makedirs(bin_dir)
+        os.environ["PATH"] = stubs.write_ffmpeg_shim(bin_dir) + os.pathsep + os.environ.get("PATH", "")
+
+
+def load_bot(server: stubs.DriveServer, extract_delay: float) -> Tuple[types.ModuleType, float]:
+    """app.pyを読み込み，youtube_dlとDriveを手元の代わりに差し替える．
+    読み込みにかかった秒数も返す（起動の速さの目安）"""
+    start = time.perf_counter()
+    import app
+    import_seconds = time.perf_counter() - start
+
+    from googleapiclient.discovery import build
+    import httplib2
+    import youtube_dl
+
+    import drive
+
+    stubs.FakeYoutubeDL.base_url = server.base_url
+    stubs.FakeYoutubeDL.extract_delay = extract_delay
+    youtube_dl.YoutubeDL = stubs.FakeYoutubeDL
+    service = build("drive", "v3", http=httplib2.Http(), static_discovery=True,
+                    client_options={"api_endpoint": server.base_url + "/drive/v3/"})
+    drive.get_service = lambda: service
+    drive.new_http = httplib2.Http
+    return app, import_seconds
+
+
+class Bench:
+    def __init__(self, app: types.ModuleType, args: argparse.Namespace) -> None:
+        import player
+
+        self.app = app
+        self.args = args
+        self.players = player._players
+        self.results: Dict[str, float] = {}
+        self._next_guild = 1
+        self._loop = asyncio.get_running_loop()
+        self._first_frame: Dict[int, "asyncio.Future[float]"] = {}
+
+    def guild(self, gate: Optional[threading.Event] = None) -> stubs.FakeGuild:
+        def voice(channel: stubs.FakeVoiceChannel) -> stubs.FakeVoiceClient:
+            return stubs.FakeVoiceClient(channel, realtime=self.args.realtime, gate=gate,
+                                         on_first_frame=self._on_first_frame)
+        guild = stubs.FakeGuild(self._next_guild, voice)
+        self._next_guild += 1
+        return guild
+
+    # 音声スレッドから呼ばれる
+    def _on_first_frame(self, voice: stubs.FakeVoiceClient) -> None:
+        now = time.perf_counter()
+        future = self._first_frame.get(voice.channel.guild.id)
+        if future is not None:
+            self._loop.call_soon_threadsafe(lambda: future.done() or future.set_result(now))
+
+    async def send(self, guild: stubs.FakeGuild, content: str) -> float:
+        start = time.perf_counter()
+        await self.app.on_message(stubs.message(guild, content))
+        return time.perf_counter() - start
+
+    async def wait_until(self, condition: Callable[[], bool], what: str, timeout: float = 120.0) -> None:
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise TimeoutError(what)
+            await asyncio.sleep(0.005)
+
+    def idle(self, guilds: List[stubs.FakeGuild]) -> bool:
+        for guild in guilds:
+            player = self.players.get(guild.id)
+            if player is not None and (player.queue or player.now_playing is not None):
+                return False
+        return True
+
+    async def downloads_settled(self) -> None:
+        import jobs
+
+        await self.wait_until(lambda: jobs.fetch.pending() == 0, "downloads")
+
+    async def messages_settled(self) -> None:
+        try:
+            import outbox
+        except ImportError:
+            return
+        await outbox.drain()
+
+    async def sync_index(self) -> None:
+        import drive_index
+
+        start = time.perf_counter()
+        count = await self._loop.run_in_executor(None, drive_index.index.sync)
+        self.results["drive_index_sync_seconds"] = time.perf_counter() - start
+        self.results["drive_index_files"] = count
+
+    async def commands(self) -> None:
+        """ギルドごとに決まった並びのコマンドを送り，コマンドごとの処理時間を集める"""
+        latencies: Dict[str, List[float]] = defaultdict(list)
+        guilds = [self.guild() for _ in range(self.args.guilds)]
+
+        async def session(index: int, guild: stubs.FakeGuild) -> None:
+            for r in range(self.args.rounds):
+                album = index
+                script = [
+                    "/help", "/list",
+                    "/play song-%d-%d" % (album, r % self.args.tracks),
+                    "/play album-%d" % album,
+                    "/list", "/move 2 3", "/remove 2",
+                    "/play https://www.youtube.com/watch?v=cmd%d_%d" % (index, r),
+                    "/pause", "/resume", "/skip", "/list", "/clear",
+                ]
+                for content in script:
+                    latencies[content.split()[0][1:]].append(await self.send(guild, content))
+        await asyncio.gather(*(session(i, g) for i, g in enumerate(guilds)))
+        await self.downloads_settled()
+        await self.messages_settled()
+        # 送信と編集を合わせた，コマンド1つあたりのDiscord APIの呼び出し数
+        calls = sum(len(g.text_channel.sent) + sum(m.edits for m in g.text_channel.sent) for g in guilds)
+        self.results["discord_calls_per_command"] = calls / sum(len(s) for s in latencies.values())
+        for command, samples in sorted(latencies.items()):
+            self.results["command_%s_p50_ms" % command] = stubs.percentile(samples, 50) * 1000
+            self.results["command_%s_p99_ms" % command] = stubs.percentile(samples, 99) * 1000
+        for guild in guilds:
+            await self.send(guild, "/bye")
+        await self.downloads_settled()
+
+    async def first_audio(self, name: str, requests: List[str]) -> None:
+        """/playしてから最初のフレームが読まれるまで（1ギルド1曲ずつ）"""
+        samples: List[float] = []
+        for content in requests:
+            guild = self.guild()
+            future = self._first_frame[guild.id] = self._loop.create_future()
+            start = time.perf_counter()
+            await self.app.on_message(stubs.message(guild, content))
+            samples.append(await asyncio.wait_for(future, 60) - start)
+            await self.wait_until(lambda: self.idle([guild]), "playback")
+            await self.send(guild, "/bye")
+        await self.downloads_settled()
+        self.results["first_audio_%s_p50_ms" % name] = stubs.percentile(samples, 50) * 1000
+        self.results["first_audio_%s_p99_ms" % name] = stubs.percentile(samples, 99) * 1000
+
+    async def queue(self) -> None:
+        """ギルドごとにアルバムを1枚ずつ入れ，溜めた状態のメモリと流し切る速さを測る"""
+        gate = threading.Event()
+        guilds = [self.guild(gate) for _ in range(self.args.guilds)]
+        first = self.args.albums - self.args.guilds
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for i, guild in enumerate(guilds):
+            await self.send(guild, "/play album-%d" % (first + i))
+        # 全ギルドで1曲目が始まり，先読みが終わるまで待つ
+        await self.wait_until(lambda: all(self.players[g.id].now_playing for g in guilds), "start")
+        await self.downloads_settled()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        self.results["memory_per_guild_kib"] = (after - before) / len(guilds) / 1024
+
+        start = time.perf_counter()
+        gate.set()
+        await self.wait_until(lambda: self.idle(guilds), "drain", timeout=600)
+        elapsed = time.perf_counter() - start
+        self.results["tracks_per_second"] = len(guilds) * self.args.tracks / elapsed
+        self.results["max_gap_ms"] = max(self.players[g.id].max_gap for g in guilds) * 1000
+        for guild in guilds:
+            await self.send(guild, "/bye")
+
+    def crossfade(self) -> None:
+        import mixer
+        a = self.args
+        # 3秒重ねる曲をギルドの数だけ用意して，全部が重なっている間を20msごとに回す
+        sources = [mixer.CrossfadeSource(stubs.PcmSource(500, seed=i), gain=0.8, seconds=3.0)
+                   for i in range(a.guilds)]
+        for source in sources:
+            while source.read() and not source.add(stubs.PcmSource(500, seed=-1), 0.9):
+                pass
+        samples = []
+        for _ in range(150):
+            for source in sources:
+                start = time.perf_counter()
+                source.read()
+                samples.append(time.perf_counter() - start)
+        self.results["crossfade_frame_p50_us"] = stubs.percentile(samples, 50) * 1e6
+        self.results["crossfade_frame_p99_us"] = stubs.percentile(samples, 99) * 1e6
+
+    async def run(self) -> Dict[str, float]:
+        await self.sync_index()
+        await self.commands()
+        a = self.args
+        # 前のシナリオで使っていないアルバムを使う（キャッシュに入っていない曲）
+        album = a.guilds
+        drive_songs = ["/play song-%d-%d" % (album + i // a.tracks, i % a.tracks) for i in range(a.samples)]
+        videos = ["/play https://www.youtube.com/watch?v=first%d" % i for i in range(a.samples)]
+        await self.first_audio("drive_cold", drive_songs)
+        await self.first_audio("drive_cached", drive_songs)
+        await self.first_audio("youtube_cold", videos)
+        await self.first_audio("youtube_cached", videos)
+        await self.queue()
+        self.crossfade()
+        self.results["max_rss_mib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return self.results
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    """baselineよりtolerance倍以上悪くなった項目を返す"""
+    regressions = []
+    for name, base in baseline.items():
+        value = results.get(name)
+        if value is None or not base:
+            continue
+        ratio = base / value if name in HIGHER_IS_BETTER else value / base
+        if ratio > tolerance:
+            regressions.append("%s: %.3f -> %.3f (x%.2f)" % (name, base, value, ratio))
+    return regressions
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline benchmark for the music bot")
+    parser.add_argument("--guilds", type=int, default=8, help="guilds playing at the same time")
+    parser.add_argument("--tracks", type=int, default=10, help="tracks per album (queue length)")
+    parser.add_argument("--rounds", type=int, default=3, help="command script repetitions per guild")
+    parser.add_argument("--samples", type=int, default=10, help="/play requests per first-audio case")
+    parser.add_argument("--size", type=int, default=1024 * 1024, help="bytes per audio file")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every stand-in request")
+    parser.add_argument("--extract-delay", type=float, default=0.05, help="seconds per youtube_dl extraction")
+    parser.add_argument("--realtime", action="store_true", help="consume audio at 20ms per frame")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own output")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare with results from an earlier --json run")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed slowdown against --baseline")
+    args = parser.parse_args(argv)
+    # 同時再生用・最初の音用・コマンド用でアルバムを分ける
+    args.albums = args.guilds * 2 + (args.samples + args.tracks - 1) // args.tracks
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    server = stubs.DriveServer(stubs.Library(args.albums, args.tracks, args.size), args.latency).start()
+    try:
+        setup_environment(workdir)
+        app, import_seconds = load_bot(server, args.extract_delay)
+
+        async def run() -> Dict[str, float]:
+            return await Bench(app, args).run()
+        # ボットのprintやログは結果の表に混ぜない
+        with open(os.devnull, "w") as devnull, contextlib.ExitStack() as stack:
+            if not args.verbose:
+                stack.enter_context(contextlib.redirect_stdout(devnull))
+            try:
+                results = asyncio.run(run())
+            finally:
+                from utils.logging import flush
+                flush()
+        results["startup_import_seconds"] = import_seconds
+        results["stand_in_requests"] = server.requests
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    width = max(len(name) for name in results)
+    for name, value in results.items():
+        print("%-*s %12.3f" % (width, name, value))
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = compare(results, json.load(fh), args.tolerance)
+        for line in regressions:
+            print("REGRESSION", line, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,406 @@
+"""ベンチマーク用の偽物たち．ネットワークにもDiscordにも出ずにボットを動かす
+
+- DriveServer: Drive API v3（files.list / files.get?alt=media / changes）と
+  YouTubeの音声ストリームの代わりをする，手元のHTTPサーバー
+- FakeYoutubeDL: youtube_dl.YoutubeDLの代わり（情報はDriveServerを指す）
+- write_ffmpeg_shim: 入力をそのまま標準出力に流すだけのffmpeg
+- Fake*: discord.pyのメッセージ・チャンネル・ボイス接続の代わり
+- PcmSource: 決まった長さのPCM（ノイズ）を返す音源（ミキサーを測る）
+"""
+
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import re
+import stat
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, TYPE_CHECKING
+from urllib.parse import parse_qs, urlparse
+import urllib.request
+
+if TYPE_CHECKING:
+    import discord
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+
+@dataclass
+class Library:
+    """Driveに置いてある体の音楽ライブラリ．albums個のフォルダにtracks曲ずつ"""
+    albums: int = 20
+    tracks: int = 10
+    size: int = 1024 * 1024
+    files: List[Dict[str, Any]] = field(default_factory=list)
+
+    def __post_init__(self) -> None:
+        for a in range(self.albums):
+            folder_id = "folder%04d" % a
+            self.files.append({"id": folder_id, "name": "album-%d" % a,
+                               "mimeType": FOLDER_MIME_TYPE, "parents": ["root"], "trashed": False})
+            for t in range(self.tracks):
+                self.files.append({"id": "file%04d%04d" % (a, t), "name": "song-%d-%d.mp3" % (a, t),
+                                   "mimeType": "audio/mpeg", "parents": [folder_id], "trashed": False})
+
+    def content(self, file_id: str) -> bytes:
+        # ファイルごとに中身を変える（キャッシュの取り違えに気づけるように）
+        seed = file_id.encode()
+        return (seed * (self.size // len(seed) + 1))[:self.size]
+
+
+def _matches(item: Dict[str, Any], q: str) -> bool:
+    for clause in q.split(" and "):
+        clause = clause.strip()
+        m = re.match(r"name contains '(.*)'$", clause)
+        if m and m.group(1).replace("\\'", "'").lower() not in item["name"].lower():
+            return False
+        m = re.match(r"'(.*)' in parents$", clause)
+        if m and m.group(1) not in item["parents"]:
+            return False
+        m = re.match(r"mimeType (!?=) '(.*)'$", clause)
+        if m and (item["mimeType"] == m.group(2)) != (m.group(1) == "="):
+            return False
+        m = re.match(r"\(mimeType contains '(.*)' or mimeType contains '(.*)'\)$", clause)
+        if m and not any(part in item["mimeType"] for part in m.groups()):
+            return False
+    return True
+
+
+class DriveServer:
+    """Drive APIとYouTubeの音声ストリームの代わりをするHTTPサーバー（別スレッドで動く）"""
+
+    def __init__(self, library: Library, latency: float = 0.0) -> None:
+        self.library = library
+        self.latency = latency
+        self.requests = 0
+        by_id = {f["id"]: f for f in library.files}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format: str, *args: object) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                path = url.path
+                if path.startswith("/media/"):
+                    return self._send_bytes(library.content(path.rsplit("/", 1)[1]))
+                if path == "/drive/v3/changes/startPageToken":
+                    return self._send_json({"startPageToken": "1"})
+                if path == "/drive/v3/changes":
+                    return self._send_json({"newStartPageToken": query.get("pageToken", "1"), "changes": []})
+                if path == "/drive/v3/files":
+                    return self._list(query)
+                m = re.match(r"/drive/v3/files/([^/]+)$", path)
+                if m and m.group(1) in by_id:
+                    if query.get("alt") == "media":
+                        return self._send_bytes(library.content(m.group(1)))
+                    return self._send_json(by_id[m.group(1)])
+                self._send_json({"error": {"code": 404, "message": "not found"}}, 404)
+
+            def _list(self, query: Dict[str, str]) -> None:
+                items = [f for f in library.files if _matches(f, query.get("q", ""))]
+                if query.get("orderBy") == "name":
+                    items.sort(key=lambda f: f["name"])
+                start = int(query.get("pageToken", 0))
+                size = int(query.get("pageSize", 100))
+                body: Dict[str, Any] = {"files": items[start:start + size]}
+                if start + size < len(items):
+                    body["nextPageToken"] = str(start + size)
+                self._send_json(body)
+
+            def _send_json(self, body: Dict[str, Any], status: int = 200) -> None:
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_bytes(self, data: bytes) -> None:
+                # MediaIoBaseDownloadはRangeで少しずつ取りに来る
+                m = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+                if m:
+                    first = int(m.group(1))
+                    last = min(int(m.group(2) or len(data) - 1), len(data) - 1)
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes %d-%d/%d" % (first, last, len(data)))
+                    data = data[first:last + 1]
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self.base_url = "http://127.0.0.1:%d" % self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="drive-standin", daemon=True)
+
+    def start(self) -> "DriveServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class FakeYoutubeDL:
+    """youtube_dl.YoutubeDLの代わり．動画の情報はDriveServerの/media/<id>を指す
+
+    base_urlとextract_delay（情報を取るのにかかる秒数の見立て）はクラスに設定する．
+    """
+
+    base_url = ""
+    extract_delay = 0.0
+    playlist_size = 20
+
+    def __init__(self, params: Optional[Dict[str, Any]] = None) -> None:
+        self.params = params or {}
+
+    def __enter__(self) -> "FakeYoutubeDL":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        pass
+
+    def extract_info(self, url: str, download: bool = True) -> Dict[str, Any]:
+        time.sleep(self.extract_delay)
+        query = parse_qs(urlparse(url).query)
+        if self.params.get("extract_flat") and "list" in query:
+            prefix = query["list"][0]
+            return {"_type": "playlist", "entries": [
+                {"id": "%s%03d" % (prefix, i), "title": "%s #%d" % (prefix, i)}
+                for i in range(self.playlist_size)
+            ]}
+        vid = query["v"][0]
+        return {
+            "id": vid,
+            "title": "video " + vid,
+            "ext": "webm",
+            "url": "%s/media/%s" % (self.base_url, vid),
+            # 本物と同じく重い項目も返す（youtube.slimで落ちることを確かめる）
+            "formats": [{"format_id": str(i), "url": "x" * 200} for i in range(30)],
+            "description": "x" * 2000,
+        }
+
+    def process_info(self, info: Dict[str, Any]) -> None:
+        with urllib.request.urlopen(info["url"]) as response, open(self.params["outtmpl"], "wb") as fh:
+            fh.write(response.read())
+
+
+FFMPEG_SHIM = '''#!%s
+# ベンチマーク用のffmpegの代わり．-iの入力をそのまま出力に流すだけ
+import shutil, sys, urllib.request
+args = sys.argv[1:]
+src, dst = args[args.index("-i") + 1], args[-1]
+if src in ("-", "pipe:0"):
+    reader = sys.stdin.buffer
+elif "://" in src:
+    reader = urllib.request.urlopen(src)
+else:
+    reader = open(src, "rb")
+writer = sys.stdout.buffer if dst in ("-", "pipe:1") else open(dst, "wb")
+try:
+    shutil.copyfileobj(reader, writer, 64 * 1024)
+except BrokenPipeError:
+    pass
+'''
+
+
+def write_ffmpeg_shim(directory: str) -> str:
+    """directoryにffmpegの代わりを置く．PATHの先頭にdirectoryを足して使う"""
+    path = os.path.join(directory, "ffmpeg")
+    with open(path, "w") as fh:
+        fh.write(FFMPEG_SHIM % sys.executable)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return directory
+
+
+class FakeVoiceClient:
+    """discord.VoiceClientの代わり．音源をスレッドで読み切ってからafterを呼ぶ
+
+    realtimeなら本物と同じく20msに1フレーム，そうでなければ読めるだけ速く読む．
+    gateが閉じている間は読み始めない（キューを溜めたまま止めておける）．
+    """
+
+    def __init__(self, channel: "FakeVoiceChannel", realtime: bool = False,
+                 gate: Optional[threading.Event] = None,
+                 on_first_frame: Optional[Callable[["FakeVoiceClient"], None]] = None) -> None:
+        self.channel = channel
+        self.realtime = realtime
+        self.gate = gate
+        self.on_first_frame = on_first_frame
+        self.frames = 0
+        self.played = 0
+        self._connected = True
+        self._source: Optional["discord.AudioSource"] = None
+        self._paused = False
+        self._stop = threading.Event()
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def is_playing(self) -> bool:
+        return self._source is not None and not self._paused
+
+    def is_paused(self) -> bool:
+        return self._source is not None and self._paused
+
+    def play(self, source: "discord.AudioSource", after: Callable[[Optional[Exception]], None]) -> None:
+        self._source = source
+        self._stop.clear()
+        threading.Thread(target=self._play, args=(source, after), daemon=True).start()
+
+    def _play(self, source: "discord.AudioSource", after: Callable[[Optional[Exception]], None]) -> None:
+        error: Optional[Exception] = None
+        first = True
+        try:
+            if self.gate is not None:
+                self.gate.wait()
+            while not self._stop.is_set():
+                frame = source.read()
+                if not frame:
+                    break
+                if first:
+                    first = False
+                    if self.on_first_frame:
+                        self.on_first_frame(self)
+                self.frames += 1
+                if self.realtime:
+                    time.sleep(0.02)
+        except Exception as e:
+            error = e
+        finally:
+            source.cleanup()
+            self._source = None
+            self.played += 1
+            after(error)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def pause(self) -> None:
+        self._paused = True
+
+    def resume(self) -> None:
+        self._paused = False
+
+    async def move_to(self, channel: "FakeVoiceChannel") -> None:
+        self.channel = channel
+
+    async def disconnect(self, force: bool = False) -> None:
+        self.stop()
+        self._connected = False
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild: "FakeGuild", voice_factory: Callable[["FakeVoiceChannel"], FakeVoiceClient]) -> None:
+        self.guild = guild
+        self.id = guild.id * 10
+        self.name = "voice"
+        self._voice_factory = voice_factory
+        self.voice: Optional[FakeVoiceClient] = None
+
+    async def connect(self, **kwargs: object) -> FakeVoiceClient:
+        self.voice = self._voice_factory(self)
+        return self.voice
+
+
+class FakeSentMessage:
+    def __init__(self, content: str) -> None:
+        self.content = content
+        self.edits = 0
+
+    async def edit(self, content: str = "", **kwargs: object) -> None:
+        self.content = content
+        self.edits += 1
+
+
+class FakeTextChannel:
+    """送られたメッセージを覚えておくだけのテキストチャンネル"""
+
+    def __init__(self, guild: "FakeGuild") -> None:
+        self.guild = guild
+        self.id = guild.id * 10 + 1
+        self.sent: List[FakeSentMessage] = []
+
+    async def send(self, content: str = "", **kwargs: object) -> FakeSentMessage:
+        message = FakeSentMessage(content)
+        self.sent.append(message)
+        return message
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, voice_factory: Callable[[FakeVoiceChannel], FakeVoiceClient]) -> None:
+        self.id = guild_id
+        self.name = "guild-%d" % guild_id
+        self.voice_channels = [FakeVoiceChannel(self, voice_factory)]
+        self.text_channel = FakeTextChannel(self)
+
+
+@dataclass
+class FakeVoiceState:
+    channel: FakeVoiceChannel
+
+
+@dataclass
+class FakeAuthor:
+    voice: Optional[FakeVoiceState]
+    bot: bool = False
+    id: int = 1
+    display_name: str = "bench"
+
+
+@dataclass
+class FakeMessage:
+    """ゲートウェイから届くメッセージの代わり（on_messageが見る項目だけ）"""
+    content: str
+    guild: FakeGuild
+    author: FakeAuthor
+    channel: FakeTextChannel
+
+
+def message(guild: FakeGuild, content: str) -> FakeMessage:
+    author = FakeAuthor(FakeVoiceState(guild.voice_channels[0]))
+    return FakeMessage(content, guild, author, guild.text_channel)
+
+
+class PcmSource:
+    """48kHz・16bitステレオのPCMを20msずつ，frames個だけ返す"""
+
+    def __init__(self, frames: int, seed: int = 0) -> None:
+        rng = random.Random(seed)
+        self.frame = bytes(rng.getrandbits(8) for _ in range(3840))
+        self.frames = frames
+
+    def read(self) -> bytes:
+        if self.frames == 0:
+            return b""
+        self.frames -= 1
+        return self.frame
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self) -> None:
+        pass
+
+
+def percentile(samples: List[float], p: float) -> float:
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
@@ -1,9 +1,13 @@
 commands = {
-    'play <曲名の一部> or <URL>': '再生キューに入れる．２曲以上見つかればその候補を表示．',
+    'play <曲名の一部> or <URL>': '再生キューに入れる．２曲以上見つかればその候補を表示．フォルダ名やプレイリストのURLなら全曲入れる．',
     'stop': '曲を終了する．',
+    'skip': '次の曲へ進む．',
     'pause': '一時停止する．',
     'resume': '再開する．',
     'list': '再生キューを表示する．',
+    'remove <番号>': '再生キューから曲を外す（番号は list のもの）．',
+    'move <番号> <移動先>': '再生キューの曲の順番を変える．',
+    'clear': '再生中の曲を残して再生キューを空にする．',
     'profile <ローマ字> or <漢字>': 'シャニマスアイドルのプロフィールを表示する．',
     'search <検索数> <検索文字列>': '<検索数>はなくてもよい（デフォルト１）．最大５件まで画像を表示する．',
     'yuzu': '柚',
@@ -0,0 +1,283 @@
+import asyncio
+from functools import lru_cache
+import io
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, TYPE_CHECKING
+
+import discord
+
+import audio_cache
+from audio_cache import cache
+import jobs
+import opus
+import outbox
+from utils import metrics
+
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+    import httplib2
+    from oauth2client.service_account import ServiceAccountCredentials
+
+# 再生を始めるまでにためておくバイト数とダウンロードの1チャンクの大きさ
+PREBUFFER_BYTES = int(os.environ.get("DRIVE_PREBUFFER_BYTES", 512 * 1024))
+CHUNK_SIZE = int(os.environ.get("DRIVE_CHUNK_SIZE", 1024 * 1024))
+# 進捗メッセージを書き換える間隔（秒）
+PROGRESS_INTERVAL = 2.0
+
+SCOPES = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+
+
+# -------------google drive 認証-------------------------------------------------
+# 起動を速くするため，認証とAPIクライアントの組み立ては最初に使うときまで遅らせる
+# （on_readyのあとにapp.warm_upが裏で済ませておく）
+def get_cred_config() -> Dict[str, str]:
+    secret = os.environ.get("CLOUD_CREDENTIALS_SECRET")
+    if secret:
+        return json.loads(secret)
+
+
+@lru_cache(maxsize=None)
+def get_credentials() -> "ServiceAccountCredentials":
+    from oauth2client.service_account import ServiceAccountCredentials
+    return ServiceAccountCredentials.from_json_keyfile_dict(get_cred_config(), SCOPES)
+
+
+@lru_cache(maxsize=None)
+def get_service() -> "Resource":
+    from googleapiclient.discovery import build
+    return build('drive', 'v3', credentials=get_credentials(), cache_discovery=False)
+# --------------------------------------------------------------------------------
+
+
+def new_http() -> "httplib2.Http":
+    """httplib2.Httpはスレッドセーフではないので，スレッドで使うときは都度作る"""
+    import httplib2
+    return get_credentials().authorize(httplib2.Http())
+
+
+def _quote(text: str) -> str:
+    return "'" + text.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def search_live(word: str, limit: int = 10, folders: bool = False) -> List[Dict[str, str]]:
+    """Driveに直接名前で検索する（ブロックするのでスレッドで呼ぶ）"""
+    mime_op = "=" if folders else "!="
+    results = get_service().files().list(
+        q="mimeType " + mime_op + " 'application/vnd.google-apps.folder' and trashed = false and name contains " + _quote(word),
+        pageSize=limit, fields="files(id, name)").execute(http=new_http())
+    return results.get('files', [])
+
+
+def children_live(folder_id: str) -> List[Dict[str, str]]:
+    """フォルダの中の音声・動画ファイルを名前順に返す（ブロックするのでスレッドで呼ぶ）"""
+    http = new_http()
+    items: List[Dict[str, str]] = []
+    page_token = None
+    while True:
+        results = get_service().files().list(
+            q=_quote(folder_id) + " in parents and (mimeType contains 'audio/' or mimeType contains 'video/') and trashed = false",
+            orderBy="name", pageSize=1000, pageToken=page_token,
+            fields="nextPageToken, files(id, name)").execute(http=http)
+        items.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return items
+
+
+def download_to(file_id: str, path: str) -> None:
+    """ファイルをpathにダウンロードする（ブロックするのでスレッドで呼ぶ）"""
+    from googleapiclient.http import MediaIoBaseDownload
+    request = get_service().files().get_media(fileId=file_id)
+    request.http = new_http()
+    with io.FileIO(path, "wb") as fh:
+        downloader = MediaIoBaseDownload(fh, request, chunksize=CHUNK_SIZE)
+        done = False
+        while done is False:
+            _, done = downloader.next_chunk()
+
+
+class DriveDownload:
+    """Driveのファイルを別スレッドでダウンロードし，途中からでも読めるようにする"""
+
+    def __init__(self, file_id: str, priority: int) -> None:
+        self.file_id = file_id
+        self.key = audio_cache.make_key("drive", file_id)
+        self.filename = cache.path(self.key)
+        self.part = cache.tmp_path(self.key)
+        self.written = 0
+        self.total: Optional[int] = None
+        self.done = False
+        self.error: Optional[Exception] = None
+        self._cond = threading.Condition()
+        self._loop = asyncio.get_running_loop()
+        self._waiters: List[asyncio.Future] = []
+        # 読み手がすぐ開けるように先に空ファイルを作っておく
+        open(self.part, "wb").close()
+        # 本体はダウンロード用のプールで動かす（次に鳴らす曲が優先）
+        self.task = jobs.wait(jobs.fetch.submit(self.key, self._run, priority=priority))
+        self.task.add_done_callback(self._finished)
+
+    def progress(self) -> float:
+        if self.done:
+            return 1.0
+        if not self.total:
+            return 0.0
+        return self.written / self.total
+
+    def _run(self) -> None:
+        started = time.monotonic()
+        try:
+            from googleapiclient.http import MediaIoBaseDownload
+            request = get_service().files().get_media(fileId=self.file_id)
+            request.http = new_http()
+            with io.FileIO(self.part, "wb") as fh:
+                downloader = MediaIoBaseDownload(fh, request, chunksize=CHUNK_SIZE)
+                done = False
+                while done is False:
+                    status, done = downloader.next_chunk()
+                    with self._cond:
+                        self.written = fh.tell()
+                        self.total = status.total_size
+                        self._cond.notify_all()
+                    self._loop.call_soon_threadsafe(self._notify)
+            cache.commit(self.key, self.part)
+            metrics.record_fetch("drive", self.written, time.monotonic() - started)
+        except Exception as e:
+            self.error = e
+            print(e)
+            if os.path.exists(self.part):
+                os.remove(self.part)
+        finally:
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+            self._loop.call_soon_threadsafe(self._notify)
+        # 変換は別のプールに任せて，ダウンロードの枠はすぐ空ける
+        if self.error is None:
+            opus.schedule_encode(self.key)
+
+    # イベントループのスレッドで，ダウンロードの仕事が終わったときに呼ばれる．
+    # ここで_downloadsから外すので，次のfetchは必ずプールに新しい仕事として入る
+    def _finished(self, task: "asyncio.Future[None]") -> None:
+        if task.cancelled() and not self.done:
+            # 始まる前に取り消された（キューから外された）
+            self.error = RuntimeError("download cancelled")
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+            if os.path.exists(self.part):
+                os.remove(self.part)
+            self._notify()
+        if _downloads.get(self.key) is self:
+            del _downloads[self.key]
+
+    # イベントループのスレッドで呼ばれる
+    def _notify(self) -> None:
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait_changed(self) -> None:
+        """次のチャンクが届く（または終わる）まで待つ"""
+        if self.done:
+            return
+        waiter = self._loop.create_future()
+        self._waiters.append(waiter)
+        await waiter
+
+    async def wait_ready(self, nbytes: int = PREBUFFER_BYTES) -> None:
+        """再生を始められるだけたまる（または終わる）まで待つ"""
+        while not self.done and self.written < nbytes:
+            await self.wait_changed()
+
+    def open_reader(self) -> io.RawIOBase:
+        return _GrowingReader(self)
+
+
+class _GrowingReader(io.RawIOBase):
+    """ダウンロード中のファイルを，追いつくまで待ちながら読むファイルオブジェクト"""
+
+    def __init__(self, download: DriveDownload) -> None:
+        self._download = download
+        try:
+            self._fh = open(download.part, "rb")
+        except FileNotFoundError:
+            # 開く直前にダウンロードが終わって名前が変わっていた
+            self._fh = open(download.filename, "rb")
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        download = self._download
+        while True:
+            data = self._fh.read(size)
+            if data:
+                return data
+            with download._cond:
+                download._cond.wait_for(
+                    lambda: download.done or download.written > self._fh.tell(),
+                    timeout=5,
+                )
+                if download.done and download.written <= self._fh.tell():
+                    return self._fh.read(size)
+
+    def close(self) -> None:
+        self._fh.close()
+        super().close()
+
+
+_downloads: Dict[str, DriveDownload] = {}
+
+
+def fetch(file_id: str, priority: int = jobs.PRIORITY_NOW) -> Optional[DriveDownload]:
+    """ダウンロードを始める．同じファイルをダウンロード中ならそれを返す
+    （より急ぐなら順番を繰り上げる）．すでにキャッシュにあればNone"""
+    key = audio_cache.make_key("drive", file_id)
+    if cache.get(key) is not None:
+        return None
+    download = _downloads.get(key)
+    if download is None:
+        download = _downloads[key] = DriveDownload(file_id, priority)
+    else:
+        jobs.fetch.prioritize(key, priority)
+    return download
+
+
+class _PipedAudio(discord.FFmpegPCMAudio):
+    """ダウンロード中のファイルをffmpegの標準入力に流す．止めたら読み手も閉じる"""
+
+    def __init__(self, reader: io.RawIOBase, offset: float = 0.0) -> None:
+        self._reader = reader
+        super().__init__(reader, pipe=True, before_options=opus.seek_options(offset))
+
+    def cleanup(self) -> None:
+        super().cleanup()
+        self._reader.close()
+
+
+def audio_source(file_id: str, download: Optional[DriveDownload], offset: float = 0.0) -> discord.AudioSource:
+    if download is None:
+        key = audio_cache.make_key("drive", file_id)
+        return opus.cached_source(key, cache.path(key), offset)
+    return _PipedAudio(download.open_reader(), offset)
+
+
+async def report_progress(download: DriveDownload, channel: discord.abc.Messageable) -> None:
+    """ダウンロードの進捗を1つのメッセージの1行を書き換えながら表示する"""
+    key = "download-" + download.key
+    outbox.status(channel, key, "ダウンロードしてくるからちょっと待ってて！")
+    last = time.monotonic()
+    while not download.done:
+        await download.wait_changed()
+        if time.monotonic() - last >= PROGRESS_INTERVAL and not download.done:
+            last = time.monotonic()
+            outbox.status(channel, key, "ダウンロード中… %d%%" % int(download.progress() * 100))
+    if download.error:
+        outbox.status(channel, key, "ダウンロードに失敗しちゃった…", final=True)
+    else:
+        outbox.status(channel, key, "ダウンロード完了！", final=True)
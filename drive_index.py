@@ -0,0 +1,228 @@
+import asyncio
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+import unicodedata
+
+import drive
+
+INDEX_PATH = os.environ.get("DRIVE_INDEX_PATH", "drive_index.sqlite3")
+# Driveの変更フィードを見に行く間隔（秒）
+SYNC_INTERVAL = int(os.environ.get("DRIVE_INDEX_SYNC_INTERVAL", 60))
+# 0ならDriveとは同期せず，ほかのプロセスが同期しているインデックスを読むだけにする（sharding.py）
+SYNC_ENABLED = os.environ.get("DRIVE_INDEX_SYNC", "1") != "0"
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+# 再生できるファイル（音声・動画）だけを選ぶ条件
+_PLAYABLE = "(mime_type LIKE 'audio/%' OR mime_type LIKE 'video/%')"
+
+FILE_FIELDS = "id, name, mimeType, parents, trashed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    name_norm TEXT NOT NULL,
+    mime_type TEXT NOT NULL,
+    parents TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS loudness (
+    id TEXT PRIMARY KEY,
+    loudness REAL,
+    peak REAL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def normalize(text: str) -> str:
+    """全角・半角や大文字・小文字の違いを吸収する"""
+    return unicodedata.normalize("NFKC", text).casefold().strip()
+
+
+def is_exact(name: str, word: str) -> bool:
+    """拡張子を除いたファイル名が検索語と同じならTrue"""
+    word = normalize(word)
+    return normalize(name) == word or normalize(os.path.splitext(name)[0]) == word
+
+
+def _escape_like(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class DriveIndex:
+    """Driveの音楽ライブラリを手元のSQLiteに写しておき，/playの検索に使う
+
+    最初に全件を取ってきたあとは，changes feedで差分だけを取り込む．
+    """
+
+    def __init__(self, path: str = INDEX_PATH) -> None:
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        # 同期するプロセスが書いている間も，ほかのプロセスが読めるようにする
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+        # 1回でも全件の同期が終わっていればTrue
+        self.refresh()
+
+    def refresh(self) -> bool:
+        """全件の同期が終わったかを読み直す（ほかのプロセスが同期しているとき）"""
+        self.ready = self._get_state("page_token") is not None
+        return self.ready
+
+    def _get_state(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def _upsert(self, files: Iterable[Dict[str, Any]]) -> None:
+        rows = []
+        removed = []
+        for f in files:
+            if f.get("trashed"):
+                removed.append((f["id"],))
+            else:
+                rows.append((f["id"], f["name"], normalize(f["name"]), f["mimeType"],
+                             ",".join(f.get("parents", []))))
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.executemany("DELETE FROM files WHERE id = ?", removed)
+
+    def _delete(self, file_ids: List[str]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM files WHERE id = ?", [(i,) for i in file_ids])
+
+    def _set_page_token(self, token: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO state VALUES ('page_token', ?)", (token,))
+        self.ready = True
+
+    def sync(self) -> int:
+        """Driveと同期する（ブロックするのでスレッドで呼ぶ）．取り込んだ件数を返す"""
+        http = drive.new_http()
+        service = drive.get_service()
+        files = service.files()
+        changes = service.changes()
+        token = self._get_state("page_token")
+        count = 0
+
+        if token is None:
+            # 一覧を取っている間の変更を取りこぼさないよう，先に開始トークンをもらう
+            start = changes.getStartPageToken().execute(http=http)["startPageToken"]
+            page_token = None
+            while True:
+                res = files.list(q="trashed = false", pageSize=1000, pageToken=page_token,
+                                 fields="nextPageToken, files(%s)" % FILE_FIELDS).execute(http=http)
+                self._upsert(res.get("files", []))
+                count += len(res.get("files", []))
+                page_token = res.get("nextPageToken")
+                if not page_token:
+                    break
+            self._set_page_token(start)
+            return count
+
+        while token:
+            res = changes.list(pageToken=token, pageSize=1000,
+                               fields="nextPageToken, newStartPageToken, "
+                                      "changes(fileId, removed, file(%s))" % FILE_FIELDS).execute(http=http)
+            self._delete([c["fileId"] for c in res.get("changes", []) if c.get("removed") or "file" not in c])
+            self._upsert([c["file"] for c in res.get("changes", []) if not c.get("removed") and "file" in c])
+            count += len(res.get("changes", []))
+            if "newStartPageToken" in res:
+                self._set_page_token(res["newStartPageToken"])
+                break
+            token = res["nextPageToken"]
+            self._set_page_token(token)
+        return count
+
+    def search(self, word: str, limit: int = 10, folders: bool = False) -> List[Dict[str, str]]:
+        """名前に検索語を含むファイルを，完全一致・前方一致・短い名前の順に返す"""
+        word = normalize(word)
+        mime_op = "=" if folders else "!="
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, name FROM files"
+                " WHERE mime_type " + mime_op + " ? AND name_norm LIKE ? ESCAPE '\\'"
+                " ORDER BY CASE WHEN name_norm = ? THEN 0"
+                "               WHEN name_norm LIKE ? ESCAPE '\\' THEN 1 ELSE 2 END,"
+                "          length(name), name"
+                " LIMIT ?",
+                (FOLDER_MIME_TYPE, "%" + _escape_like(word) + "%", word,
+                 _escape_like(word) + "%", limit),
+            ).fetchall()
+        return [{"id": row["id"], "name": row["name"]} for row in rows]
+
+    def children(self, folder_id: str) -> List[Dict[str, str]]:
+        """フォルダの中の音声・動画ファイルを名前順に返す（ジャケット画像やPDFは入れない）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, name FROM files"
+                " WHERE " + _PLAYABLE + " AND ',' || parents || ',' LIKE ? ESCAPE '\\'"
+                " ORDER BY name",
+                ("%," + _escape_like(folder_id) + ",%",),
+            ).fetchall()
+        return [{"id": row["id"], "name": row["name"]} for row in rows]
+
+    def get_loudness(self, file_id: str) -> Optional[Dict[str, Optional[float]]]:
+        """前に測ったラウドネスとピーク（loudness.py）"""
+        with self._lock:
+            row = self._conn.execute("SELECT loudness, peak FROM loudness WHERE id = ?", (file_id,)).fetchone()
+        return {"loudness": row["loudness"], "peak": row["peak"]} if row else None
+
+    def set_loudness(self, file_id: str, result: Dict[str, Optional[float]]) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO loudness VALUES (?, ?, ?)",
+                               (file_id, result["loudness"], result["peak"]))
+
+    def unmeasured(self) -> List[str]:
+        """まだラウドネスを測っていない音声・動画ファイル"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM files"
+                " WHERE " + _PLAYABLE + " AND id NOT IN (SELECT id FROM loudness) ORDER BY name",
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM files").fetchone()[0]
+
+
+index = DriveIndex()
+
+
+async def sync_forever() -> None:
+    """起動後にずっと回しておく同期タスク．SYNC_ENABLEDでなければ，
+    ほかのプロセスの最初の同期が終わるのを待つだけにする（Driveには問い合わせない）"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            if SYNC_ENABLED:
+                count = await loop.run_in_executor(None, index.sync)
+                if count:
+                    print("Drive index: %d件更新 (全%d件)" % (count, index.count()))
+            elif index.ready or index.refresh():
+                return
+        except Exception as e:
+            print(e)
+        await asyncio.sleep(SYNC_INTERVAL)
+
+
+async def search(word: str, limit: int = 10, folders: bool = False) -> List[Dict[str, str]]:
+    """インデックスで検索する．最初の同期が終わるまではDriveに直接聞く"""
+    if index.ready:
+        return index.search(word, limit, folders)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, drive.search_live, word, limit, folders)
+
+
+async def children(folder_id: str) -> List[Dict[str, str]]:
+    if index.ready:
+        return index.children(folder_id)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, drive.children_live, folder_id)
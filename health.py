@@ -0,0 +1,83 @@
+import math
+import os
+import time
+from typing import Any, Dict
+
+from aiohttp import web
+import discord
+
+from audio_cache import cache
+import drive_index
+import jobs
+import player
+from utils import metrics
+
+HOST = os.environ.get("HOST", "0.0.0.0")
+# Cloud Runが渡してくるポート
+PORT = int(os.environ.get("PORT", 8080))
+
+_started = time.monotonic()
+
+
+def snapshot(client: discord.Client) -> Dict[str, Any]:
+    """いまの状態をJSONにできる形で返す．ロックを長く持つものやI/Oは含めない"""
+    players = player.players()
+    latency = client.latency if client.is_ready() else None
+    return {
+        "ready": client.is_ready(),
+        "latency_ms": round(latency * 1000, 1) if latency is not None and math.isfinite(latency) else None,
+        "uptime_seconds": round(time.monotonic() - _started, 1),
+        "guilds": len(client.guilds),
+        "shard_count": client.shard_count,
+        "shard_ids": getattr(client, "shard_ids", None),
+        "voice_sessions": sum(1 for p in players if p.is_connected()),
+        "queued_tracks": sum(len(p.queue) for p in players),
+        "players": [
+            {
+                "guild": str(p.guild_id),
+                "connected": p.is_connected(),
+                "now_playing": p.now_playing.title if p.now_playing else None,
+                "queue": len(p.queue),
+            }
+            for p in players
+        ],
+        "cache": cache.stats(),
+        "drive_index_ready": drive_index.index.ready,
+        "jobs": {"fetch": jobs.fetch.pending(), "transcode": jobs.transcode.pending()},
+    }
+
+
+def make_app(client: discord.Client) -> web.Application:
+    """ヘルスチェック・状態・メトリクスを返すアプリ．ハンドラはどれもすぐ返る"""
+
+    async def live(request: web.Request) -> web.Response:
+        # イベントループが応答できていれば生きている
+        return web.Response(text="ok")
+
+    async def ready(request: web.Request) -> web.Response:
+        if client.is_ready() and not client.is_closed():
+            return web.Response(text="ready")
+        return web.Response(text="not ready", status=503)
+
+    async def status(request: web.Request) -> web.Response:
+        return web.json_response(snapshot(client))
+
+    async def metrics_text(request: web.Request) -> web.Response:
+        return web.Response(body=metrics.REGISTRY.render().encode(),
+                            headers={"Content-Type": metrics.CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/", live)
+    app.router.add_get("/healthz", live)
+    app.router.add_get("/readyz", ready)
+    app.router.add_get("/status", status)
+    app.router.add_get("/metrics", metrics_text)
+    return app
+
+
+async def start(client: discord.Client, host: str = HOST, port: int = PORT) -> web.AppRunner:
+    """ボットと同じイベントループでHTTPサーバーを動かす（スレッドは増やさない）"""
+    runner = web.AppRunner(make_app(client), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,89 @@
+import asyncio
+import codecs
+from html.parser import HTMLParser
+import os
+from typing import Dict, List, Optional, Tuple
+import unicodedata
+
+import aiohttp
+from cachetools import TTLCache
+
+from utils import metrics
+
+SEARCH_URL = "http://images.google.com/images"
+MAX_RESULTS = 5
+# 同じ検索語の結果をどれだけ覚えておくか
+CACHE_TTL = int(os.environ.get("IMAGE_SEARCH_CACHE_TTL", 3600))
+CACHE_SIZE = int(os.environ.get("IMAGE_SEARCH_CACHE_SIZE", 256))
+TIMEOUT = aiohttp.ClientTimeout(total=10)
+CHUNK_SIZE = 16 * 1024
+
+_cache: TTLCache = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+_pending: Dict[str, asyncio.Future] = {}
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def normalize(query: str) -> str:
+    """全角・半角，大文字・小文字，余分な空白の違いを同じ検索語として扱う"""
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+
+class ImageParser(HTMLParser):
+    """srcにhttpを含むimgタグをlimit個集めたら，それ以上は読まない"""
+
+    def __init__(self, limit: int) -> None:
+        super().__init__()
+        self.limit = limit
+        self.urls: List[str] = []
+
+    @property
+    def full(self) -> bool:
+        return len(self.urls) >= self.limit
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if tag != "img" or self.full:
+            return
+        src = dict(attrs).get("src")
+        if src and "http" in src:
+            self.urls.append(src)
+
+
+def _get_session() -> aiohttp.ClientSession:
+    # 接続を使い回すため，セッションはプロセスで1つにする
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=TIMEOUT)
+    return _session
+
+
+async def _fetch(query: str) -> List[str]:
+    parser = ImageParser(MAX_RESULTS)
+    async with _get_session().get(SEARCH_URL, params={"q": query}) as response:
+        response.raise_for_status()
+        decoder = codecs.getincrementaldecoder(response.charset or "utf-8")(errors="replace")
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            parser.feed(decoder.decode(chunk))
+            if parser.full:
+                break
+    return parser.urls
+
+
+async def search(query: str, num: int) -> List[str]:
+    """画像のURLを最大num件返す．同じ検索語はしばらくキャッシュから返す"""
+    key = normalize(query)
+    urls = _cache.get(key)
+    metrics.cache_result("image_search", urls is not None)
+    if urls is None:
+        # 同じ検索が同時に来たら1回の取得を待ち合わせる
+        future = _pending.get(key)
+        if future is None:
+            future = _pending[key] = asyncio.ensure_future(_fetch(query))
+            future.add_done_callback(lambda f: _pending.pop(key, None))
+        urls = await asyncio.shield(future)
+        _cache[key] = urls
+    return urls[:num]
+
+
+async def close() -> None:
+    if _session is not None and not _session.closed:
+        await _session.close()
@@ -0,0 +1,138 @@
+import asyncio
+from concurrent.futures import Future
+import itertools
+import os
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+# 優先度（小さいほど先）．次に鳴らす曲 > 先読み > 裏でのキャッシュ作り
+PRIORITY_NOW = 0
+PRIORITY_PREFETCH = 1
+PRIORITY_BACKGROUND = 2
+
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", 4))
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+
+T = TypeVar("T")
+
+
+class _Job:
+    def __init__(self, key: str, fn: Callable[..., Any], args: tuple, priority: int) -> None:
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.priority = priority
+        self.future: Future = Future()
+
+
+class JobPool:
+    """優先度つきで，同じキーの仕事は1つにまとめるスレッドプール
+
+    ダウンロードとffmpegの変換で別々のプールを使い，同時に動く数を
+    それぞれFETCH_WORKERS・TRANSCODE_WORKERSで抑える．
+    """
+
+    def __init__(self, name: str, workers: int) -> None:
+        self.name = name
+        self.workers = workers
+        self._queue: "queue.PriorityQueue[tuple]" = queue.PriorityQueue()
+        self._jobs: Dict[str, _Job] = {}
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._threads: List[threading.Thread] = []
+
+    def submit(self, key: str, fn: Callable[..., T], *args: object,
+               priority: int = PRIORITY_BACKGROUND) -> "Future[T]":
+        """仕事を入れる．同じキーの仕事が待ち・実行中ならそのFutureを返し，
+        より高い優先度で頼まれたら順番を繰り上げる．どのスレッドからでも呼べる"""
+        with self._lock:
+            self._start_workers()
+            job = self._jobs.get(key)
+            if job is None:
+                job = self._jobs[key] = _Job(key, fn, args, priority)
+            elif priority < job.priority and not job.future.running():
+                job.priority = priority
+            else:
+                return job.future
+            # 繰り上げたときは古いエントリが残るが，取り出したときに読み飛ばす
+            self._queue.put((job.priority, next(self._seq), job))
+            return job.future
+
+    def prioritize(self, key: str, priority: int) -> None:
+        """待っている仕事の順番を繰り上げる"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or priority >= job.priority or job.future.running():
+                return
+            job.priority = priority
+            self._queue.put((job.priority, next(self._seq), job))
+
+    def cancel(self, key: str) -> bool:
+        """まだ始まっていない仕事を取り消す"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or not job.future.cancel():
+                return False
+            del self._jobs[key]
+            return True
+
+    async def run(self, key: str, fn: Callable[..., T], *args: object, priority: int = PRIORITY_BACKGROUND) -> T:
+        """submitして結果を待つ．待っている側がキャンセルされても仕事自体は続ける"""
+        return await wait(self.submit(key, fn, *args, priority=priority))
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._jobs)
+
+    def _start_workers(self) -> None:
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name="%s-%d" % (self.name, len(self._threads)), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self) -> None:
+        while True:
+            priority, _, job = self._queue.get()
+            if priority != job.priority or not job.future.set_running_or_notify_cancel():
+                continue
+            error: Optional[BaseException] = None
+            try:
+                result = job.fn(*job.args)
+            except BaseException as e:
+                result, error = None, e
+            # 結果を知らせる前に外す（知らせを受けてすぐに同じキーで頼まれたら，新しい仕事にする）
+            with self._lock:
+                if self._jobs.get(job.key) is job:
+                    del self._jobs[job.key]
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+
+
+def wait(future: Future) -> "asyncio.Future[Any]":
+    """concurrent.futures.Futureをイベントループで待てるようにする．
+    asyncio.wrap_futureと違い，待つのをやめても元の仕事はキャンセルしない"""
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+
+    def done(f: Future) -> None:
+        loop.call_soon_threadsafe(_copy_result, f, waiter)
+    future.add_done_callback(done)
+    return waiter
+
+
+def _copy_result(source: Future, waiter: "asyncio.Future[Any]") -> None:
+    if waiter.done():
+        return
+    if source.cancelled():
+        waiter.cancel()
+    elif source.exception() is not None:
+        waiter.set_exception(source.exception())
+    else:
+        waiter.set_result(source.result())
+
+
+fetch = JobPool("fetch", FETCH_WORKERS)
+transcode = JobPool("transcode", TRANSCODE_WORKERS)
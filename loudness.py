@@ -0,0 +1,281 @@
+"""曲の音量（ラウドネス）をそろえる
+
+曲ごとに1回だけ，デコードした音声からITU-R BS.1770（EBU R128）の方法で
+積分ラウドネス（LUFS）とピーク（dBFS）を測り，キャッシュのメタデータ
+（DriveのファイルならDriveのインデックスにも）に残す．再生するときは
+そこから決めた固定のゲインをかけるだけで，再生のたびに測ることはない．
+
+測るのはCPUを使うので，別プロセスのプール（LOUDNESS_WORKERS）で動かす．
+Driveのライブラリ全体をまとめて測っておくこともできる．
+
+    python loudness.py          # まだ測っていないDriveの曲を全部測る
+"""
+
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# 0なら測らない（ゲインもかけない）
+LOUDNESS_ENABLED = os.environ.get("LOUDNESS", "1") != "0"
+# そろえる先のラウドネス（LUFS）と，かけるゲインの上限（dB）
+TARGET_LUFS = float(os.environ.get("LOUDNESS_TARGET", -14))
+MAX_GAIN_DB = float(os.environ.get("LOUDNESS_MAX_GAIN", 12))
+# ゲインをかけたあとのピークをこれ以下に抑える（dBFS）
+PEAK_CEILING_DB = -1.0
+WORKERS = int(os.environ.get("LOUDNESS_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+
+RATE = 48000
+# 100msの小ブロック（400msのブロックを75%ずつ重ねて動かすと，小ブロック4つ分の平均になる）
+HOP = RATE // 10
+# 一度にFFTする小ブロックの数（メモリを抑える）
+FFT_CHUNK = 256
+# ffmpegの出力を一度に読む小ブロックの数（6.4秒分，約2.5MB）
+READ_BLOCKS = 64
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+# BS.1770のKウェイティング（48kHz）．ハイシェルフとハイパスの2段のbiquad
+_K_FILTERS = (
+    ((1.53512485958697, -2.69169618940638, 1.19839281085285), (1.0, -1.69065929318241, 0.73248077421585)),
+    ((1.0, -2.0, 1.0), (1.0, -1.99004745483398, 0.99007225036621)),
+)
+
+_lock = threading.Lock()
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+@lru_cache(maxsize=None)
+def _weights(size: int) -> np.ndarray:
+    """size点のrfftの各ビンにかける重み（Kウェイティングの|H|^2とParsevalの係数）"""
+    z = np.exp(-1j * np.pi * np.arange(size // 2 + 1) / (size // 2))
+    power = np.ones(size // 2 + 1)
+    for b, a in _K_FILTERS:
+        power *= np.abs(np.polyval(b[::-1], z) / np.polyval(a[::-1], z)) ** 2
+    # 両端以外のビンは負の周波数の分も数える
+    power[1:-1] *= 2
+    if size % 2:
+        power[-1] *= 2
+    return power / (size * size)
+
+
+class Meter:
+    """48kHzのPCMを少しずつ受け取ってラウドネスとピークを測る
+
+    曲全体はメモリに置かず，ピークと100msの小ブロックごとのパワーだけを残す
+    （ゲートをかけるのにはブロックごとのパワーがあればよい）．"""
+
+    def __init__(self, channels: int = 2) -> None:
+        self._peak = 0.0
+        self._powers: List[np.ndarray] = []
+        # 小ブロックに満たずに残ったサンプル（次に受け取った分の前につなげる）
+        self._rest = np.empty((0, channels), dtype=np.float32)
+
+    def add(self, samples: np.ndarray) -> None:
+        """(サンプル数, チャンネル数)，-1〜1のfloatのPCMを足す"""
+        if samples.size:
+            self._peak = max(self._peak, float(np.abs(samples).max()))
+        if len(self._rest):
+            samples = np.concatenate((self._rest, samples))
+        count = len(samples) // HOP
+        self._rest = samples[count * HOP:]
+        if not count:
+            return
+        blocks = samples[:count * HOP].reshape(count, HOP, -1)
+        weights = _weights(HOP)[:, np.newaxis]
+        # 小ブロックごとの，Kウェイティング後の二乗平均（チャンネルは足す）
+        for start in range(0, count, FFT_CHUNK):
+            spectrum = np.fft.rfft(blocks[start:start + FFT_CHUNK], axis=1)
+            self._powers.append((np.abs(spectrum) ** 2 * weights).sum(axis=(1, 2)))
+
+    def result(self) -> Dict[str, Optional[float]]:
+        """短すぎたり無音だったりしてラウドネスが決まらなければloudnessはNone"""
+        result: Dict[str, Optional[float]] = {
+            "loudness": None,
+            "peak": round(20 * np.log10(self._peak), 2) if self._peak > 0 else None,
+        }
+        power = np.concatenate(self._powers) if self._powers else np.empty(0)
+        if len(power) < 4:
+            return result
+        z = np.convolve(power, np.full(4, 0.25), mode="valid")
+        with np.errstate(divide="ignore"):
+            level = -0.691 + 10 * np.log10(z)
+        gated = z[level > ABSOLUTE_GATE]
+        if not gated.size:
+            return result
+        threshold = -0.691 + 10 * np.log10(gated.mean()) + RELATIVE_GATE
+        gated = z[(level > ABSOLUTE_GATE) & (level > threshold)]
+        result["loudness"] = round(float(-0.691 + 10 * np.log10(gated.mean())), 2)
+        return result
+
+
+def measure(samples: np.ndarray) -> Dict[str, Optional[float]]:
+    """48kHzのPCM（(サンプル数, チャンネル数)，-1〜1のfloat）のラウドネスとピーク
+
+    Kウェイティングは小ブロックごとのFFTの上で周波数特性をかけて近似する．
+    短すぎたり無音だったりしてラウドネスが決まらなければloudnessはNone．"""
+    meter = Meter(samples.shape[1])
+    meter.add(samples)
+    return meter.result()
+
+
+def analyze(path: str) -> Dict[str, Optional[float]]:
+    """ファイルをデコードしながら測る（ブロックする．プールのプロセスで動かす）
+
+    ffmpegの出力はREAD_BLOCKS個の小ブロックずつ読むので，長い曲でもメモリは増えない．"""
+    meter = Meter(2)
+    frame = 2 * 4  # f32le・ステレオの1サンプル分のバイト数
+    with subprocess.Popen(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", path, "-vn",
+         "-f", "f32le", "-ac", "2", "-ar", str(RATE), "-"],
+        stdout=subprocess.PIPE,
+    ) as proc:
+        try:
+            while True:
+                data = proc.stdout.read(READ_BLOCKS * HOP * frame)
+                if not data:
+                    break
+                size = len(data) - len(data) % frame
+                meter.add(np.frombuffer(data[:size], dtype=np.float32).reshape(-1, 2))
+        except BaseException:
+            proc.kill()
+            raise
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return meter.result()
+
+
+def gain_db(meta: Dict[str, object]) -> float:
+    """測った値からかけるゲイン（dB）を決める．測っていなければ0"""
+    loudness = meta.get("loudness")
+    if not LOUDNESS_ENABLED or loudness is None:
+        return 0.0
+    gain = min(TARGET_LUFS - loudness, MAX_GAIN_DB)
+    peak = meta.get("peak")
+    if peak is not None:
+        # 上げすぎて割れないようにする
+        gain = min(gain, PEAK_CEILING_DB - peak)
+    return round(max(gain, -MAX_GAIN_DB), 2)
+
+
+def volume_options(gain: float) -> Optional[str]:
+    """ffmpegでgain（dB）をかけるオプション"""
+    return "-af volume=%.2fdB" % gain if abs(gain) >= 0.1 else None
+
+
+def pool() -> ProcessPoolExecutor:
+    """測る用のプロセスプール（最初に使うときに作る）"""
+    global _pool
+    with _lock:
+        if _pool is None:
+            # ボットはスレッドを持っているのでforkせず，このモジュールだけを読み込んだ
+            # サーバーから子プロセスを作る（app.pyを読み込み直さない）
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["loudness"])
+            _pool = ProcessPoolExecutor(WORKERS, mp_context=context)
+        return _pool
+
+
+def submit(path: str) -> "Future[Dict[str, Optional[float]]]":
+    return pool().submit(analyze, path)
+
+
+def _drive_id(key: str) -> Optional[str]:
+    return key[len("drive-"):] if key.startswith("drive-") else None
+
+
+def analyze_cached(key: str) -> bool:
+    """キャッシュにある曲をまだ測っていなければ測ってメタデータに残す（ブロックする）．
+    Driveの曲で，前に測った値がインデックスにあればそれを使う．測ったらTrue"""
+    if not LOUDNESS_ENABLED:
+        return False
+    # audio_cacheやdrive_indexは読み込むだけでファイルを触るので，プールの子プロセスでは読み込まない
+    from audio_cache import cache
+    import drive_index
+    path = cache.acquire(key)
+    if path is None:
+        return False
+    try:
+        if "loudness" in cache.get_meta(key):
+            return False
+        file_id = _drive_id(key)
+        result = drive_index.index.get_loudness(file_id) if file_id else None
+        if result is None:
+            result = submit(path).result()
+            if file_id:
+                drive_index.index.set_loudness(file_id, result)
+        # 測っている間にタイトルなどが書かれていても消さないよう，読み直してから足す
+        meta = cache.get_meta(key)
+        meta.update(result)
+        cache.set_meta(key, meta)
+        return True
+    except Exception as e:
+        print("ラウドネスを測れませんでした", key, repr(e))
+        # 再生のたびに測り直さないよう，測れなかったこともNoneとして残す（ゲインはかけない）
+        try:
+            meta = cache.get_meta(key)
+            meta.setdefault("loudness", None)
+            meta.setdefault("peak", None)
+            cache.set_meta(key, meta)
+        except Exception as e:
+            print("ラウドネスを測れなかったことを残せませんでした", key, repr(e))
+        return False
+    finally:
+        cache.unpin(key)
+
+
+def _backfill_one(file_id: str) -> bool:
+    import audio_cache
+    from audio_cache import cache
+    import drive
+    import drive_index
+    key = audio_cache.make_key("drive", file_id)
+    path = cache.acquire(key)
+    tmp = None
+    try:
+        if path is None:
+            # キャッシュにない曲はキャッシュに入れず，一時ファイルに落として測る
+            fd, tmp = tempfile.mkstemp(suffix=".part")
+            os.close(fd)
+            drive.download_to(file_id, tmp)
+            path = tmp
+        drive_index.index.set_loudness(file_id, submit(path).result())
+        return True
+    except Exception as e:
+        print("ラウドネスを測れませんでした", file_id, repr(e))
+        return False
+    finally:
+        if tmp is not None:
+            os.remove(tmp)
+        else:
+            cache.unpin(key)
+
+
+def backfill(fetch_workers: int = 4) -> int:
+    """Driveのライブラリのうちまだ測っていない曲をまとめて測る．
+    ダウンロードはスレッドで，測るのはプロセスのプールで並べて行う．測った曲数を返す"""
+    import drive_index
+    drive_index.index.sync()
+    file_ids: List[str] = drive_index.index.unmeasured()
+    print("%d曲を測ります" % len(file_ids))
+    done = 0
+    with ThreadPoolExecutor(fetch_workers) as executor:
+        for i, ok in enumerate(executor.map(_backfill_one, file_ids), 1):
+            done += ok
+            if i % 50 == 0:
+                print("%d/%d" % (i, len(file_ids)))
+    return done
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    # プールの子プロセスがanalyzeを見つけられるよう，__main__ではなくloudnessとして呼ぶ
+    import loudness
+    print("%d曲を測りました" % loudness.backfill(int(os.environ.get("FETCH_WORKERS", 4))))
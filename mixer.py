@@ -0,0 +1,164 @@
+from collections import deque
+import os
+import threading
+from typing import Callable, Deque, Optional
+
+import discord
+import numpy as np
+
+# 曲の終わりと次の曲の頭を重ねる秒数（0ならクロスフェードせず今まで通り1曲ずつ流す）
+CROSSFADE_SECONDS = float(os.environ.get("CROSSFADE_SECONDS", 0))
+
+# discord.pyに渡すPCMの1フレーム（48kHz・16bitステレオ・20ms）
+FRAME_SAMPLES = 960
+CHANNELS = 2
+FRAME_BYTES = FRAME_SAMPLES * CHANNELS * 2
+FRAME_SECONDS = 0.02
+
+# フレームの中の何サンプル目か（フェードの曲線をフレームごとにまとめて計算する）
+_SAMPLE_INDEX = np.arange(FRAME_SAMPLES, dtype=np.float32)[:, np.newaxis]
+_SILENCE = np.zeros((FRAME_SAMPLES, CHANNELS), dtype=np.float32)
+
+
+class _Input:
+    """ミキサーに入る1曲分．先の数フレームを読んでおく（曲の終わりを重ねるため）"""
+
+    def __init__(self, source: discord.AudioSource, gain: float) -> None:
+        self.source = source
+        self.gain = gain
+        self.frames: Deque[bytes] = deque()
+        self.eof = False
+        # 曲の終わりを知らせたか
+        self.ended = False
+        # Ogg/Opusのキャッシュはそのままでは混ぜられないのでPCMに戻す
+        self._decoder = discord.opus.Decoder() if source.is_opus() else None
+
+    def fill(self, count: int) -> None:
+        for _ in range(count):
+            if self.eof:
+                return
+            data = self.source.read()
+            if data and self._decoder is not None:
+                data = self._decoder.decode(data)
+            if not data:
+                self.eof = True
+                return
+            self.frames.append(data)
+
+    def pop(self) -> Optional[np.ndarray]:
+        if not self.frames:
+            return None
+        return _to_array(self.frames.popleft())
+
+    def pop_bytes(self) -> bytes:
+        return self.frames.popleft()
+
+    def cleanup(self) -> None:
+        self.source.cleanup()
+
+
+def _to_array(data: bytes) -> np.ndarray:
+    samples = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+    if samples.size < FRAME_SAMPLES * CHANNELS:
+        # 最後のフレームは短いことがあるので無音で埋める
+        samples = np.pad(samples, (0, FRAME_SAMPLES * CHANNELS - samples.size))
+    return samples.reshape(FRAME_SAMPLES, CHANNELS)
+
+
+def _to_bytes(samples: np.ndarray) -> bytes:
+    return np.clip(samples, -32768, 32767).astype(np.int16).tobytes()
+
+
+class CrossfadeSource(discord.AudioSource):
+    """今の曲の終わりと次の曲の頭を重ねて流すPCMの音源
+
+    今の曲の最後のfade_frames分を先に読んでおき，曲が終わったら（読み切ったら）
+    on_track_endで知らせる．その間に次の曲がaddされれば，残っているフレームに
+    重ねて等パワーの曲線でフェードする．来なければそのまま鳴らし切って終わる．
+
+    read()はdiscord.pyの音声スレッドから20msごとに呼ばれる．混ぜるのは1フレーム
+    （960サンプル×2チャンネル）ずつNumPyでまとめて計算し，サンプルごとのループは持たない．
+    """
+
+    def __init__(self, source: discord.AudioSource, gain: float = 1.0,
+                 seconds: float = CROSSFADE_SECONDS,
+                 on_track_end: Optional[Callable[[], None]] = None) -> None:
+        self.fade_frames = max(1, int(seconds / FRAME_SECONDS))
+        self.on_track_end = on_track_end
+        self._lock = threading.Lock()
+        self._main = _Input(source, gain)
+        self._outgoing: Optional[_Input] = None
+        self._fade_total = 0
+        self._fade_pos = 0
+        self._finished = False
+
+    def add(self, source: discord.AudioSource, gain: float = 1.0) -> bool:
+        """次の曲を重ねる．もう鳴り終わっていたらFalse（新しく再生し直す）"""
+        with self._lock:
+            if self._finished or not self._main.eof:
+                return False
+            if not self._main.frames:
+                # 重ねる残りがない（とても短い曲だった）ならそのまま入れ替える
+                self._main.cleanup()
+                self._main = _Input(source, gain)
+                return True
+            if self._outgoing is not None:
+                self._outgoing.cleanup()
+            self._outgoing = self._main
+            self._main = _Input(source, gain)
+            self._fade_total = len(self._outgoing.frames)
+            self._fade_pos = 0
+            return True
+
+    def read(self) -> bytes:
+        with self._lock:
+            main = self._main
+            # 先読みが足りないうちは2フレームずつ読んで，fade_frames分まで溜める
+            main.fill(2 if len(main.frames) < self.fade_frames else 1)
+            if main.eof and not main.frames and self._outgoing is None:
+                self._finished = True
+                self._end_track(main)
+                return b""
+            if main.eof:
+                self._end_track(main)
+            if self._outgoing is None:
+                # 重ねていなければ音量を変えるときだけ計算する
+                if main.gain == 1.0:
+                    return main.pop_bytes()
+                return _to_bytes(main.pop() * main.gain)
+            return _to_bytes(self._mix(main.pop()))
+
+    def _mix(self, head: Optional[np.ndarray]) -> np.ndarray:
+        outgoing = self._outgoing
+        tail = outgoing.pop()
+        # 0から1へ進むフェードの位置（サンプル単位）
+        t = (self._fade_pos * FRAME_SAMPLES + _SAMPLE_INDEX) / (self._fade_total * FRAME_SAMPLES)
+        self._fade_pos += 1
+        angle = np.minimum(t, 1.0) * (np.pi / 2)
+        mixed = _SILENCE
+        if tail is not None:
+            mixed = tail * (np.cos(angle) * outgoing.gain)
+        if head is not None:
+            mixed = mixed + head * (np.sin(angle) * self._main.gain)
+        if not outgoing.frames:
+            outgoing.cleanup()
+            self._outgoing = None
+        return mixed
+
+    def _end_track(self, track: _Input) -> None:
+        # 1曲につき1回だけ知らせる
+        if not track.ended:
+            track.ended = True
+            if self.on_track_end is not None:
+                self.on_track_end()
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self) -> None:
+        with self._lock:
+            self._finished = True
+            self._main.cleanup()
+            if self._outgoing is not None:
+                self._outgoing.cleanup()
+                self._outgoing = None
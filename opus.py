@@ -0,0 +1,114 @@
+import os
+import subprocess
+from typing import IO, Iterator, Optional
+
+import discord
+from discord.oggparse import OggStream
+
+from audio_cache import cache
+import jobs
+import loudness
+
+# キャッシュに入った曲をOgg/Opusに変換しておくか，そのときのビットレート
+OPUS_ENABLED = os.environ.get("AUDIO_CACHE_OPUS", "1") != "0"
+OPUS_BITRATE = os.environ.get("OPUS_BITRATE", "128k")
+OPUS_SUFFIX = ".opus"
+# 変換したファイルの1パケットの長さ（秒）
+FRAME_SECONDS = 0.02
+
+
+def encode_cached(key: str) -> bool:
+    """キャッシュにある曲を1回だけOgg/Opus（48kHz・ステレオ・20msフレーム）に変換して置き換える．
+    ブロックするのでスレッドで呼ぶ．変換したらTrue"""
+    if not OPUS_ENABLED:
+        return False
+    path = cache.acquire(key)
+    if path is None:
+        return False
+    try:
+        meta = cache.get_meta(key)
+        if meta.get("codec") == "opus":
+            return False
+        tmp = cache.tmp_path(key + OPUS_SUFFIX)
+        # 測ってあれば音量をそろえてから変換する（再生するときはそのまま送れる）
+        gain = loudness.gain_db(meta)
+        volume = ["-af", "volume=%.2fdB" % gain] if gain else []
+        subprocess.run(
+            ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", path, *volume,
+             "-vn", "-map_metadata", "-1", "-c:a", "libopus", "-b:a", OPUS_BITRATE,
+             "-ar", "48000", "-ac", "2", "-frame_duration", "20", "-application", "audio",
+             "-f", "ogg", tmp],
+            check=True,
+        )
+        # 中身を入れ替えてから印をつける（間に読んだ人はffmpegでデコードするので問題ない）
+        cache.commit(key, tmp)
+        meta["codec"] = "opus"
+        meta["baked_gain"] = gain
+        cache.set_meta(key, meta)
+        return True
+    except Exception as e:
+        print(e)
+        if os.path.exists(cache.tmp_path(key + OPUS_SUFFIX)):
+            os.remove(cache.tmp_path(key + OPUS_SUFFIX))
+        return False
+    finally:
+        cache.unpin(key)
+
+
+def prepare_cached(key: str) -> None:
+    """キャッシュに入った曲のラウドネスを測ってから，Ogg/Opusに変換する（ブロックする）"""
+    loudness.analyze_cached(key)
+    encode_cached(key)
+
+
+def schedule_encode(key: str) -> None:
+    """変換用のプールでprepare_cachedを動かす（同じ曲の変換は1つにまとめる）"""
+    if OPUS_ENABLED or loudness.LOUDNESS_ENABLED:
+        jobs.transcode.submit(key, prepare_cached, key, priority=jobs.PRIORITY_BACKGROUND)
+
+
+class OggOpusSource(discord.AudioSource):
+    """Ogg/OpusのファイルからOpusのパケットをそのまま渡す．
+    ffmpegもPCMからのエンコードも要らない"""
+
+    def __init__(self, path: str, offset: float = 0.0) -> None:
+        self._file: IO[bytes] = open(path, "rb")
+        self._packets: Iterator[bytes] = OggStream(self._file).iter_packets()
+        # 途中から再生するなら，その分のパケットを読み捨てる
+        self._skip = int(offset / FRAME_SECONDS)
+
+    def read(self) -> bytes:
+        for packet in self._packets:
+            # 先頭のヘッダ（OpusHead/OpusTags）は音声ではないので飛ばす
+            if packet.startswith((b"OpusHead", b"OpusTags")):
+                continue
+            if self._skip > 0:
+                self._skip -= 1
+                continue
+            return packet
+        return b""
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self) -> None:
+        self._file.close()
+
+
+def seek_options(offset: float) -> Optional[str]:
+    """offset秒から再生するためのffmpegの入力オプション"""
+    return "-ss %.2f" % offset if offset > 0 else None
+
+
+def cached_source(key: str, path: str, offset: float = 0.0) -> discord.AudioSource:
+    """キャッシュのファイルの音源．Opusに変換済みならそのまま送る．
+    測ったラウドネスのゲインが変換のときにかかっていなければffmpegでかける"""
+    meta = cache.get_meta(key)
+    if loudness.LOUDNESS_ENABLED and "loudness" not in meta:
+        # 前に入ったままでまだ測っていない曲は，次に流すときのために裏で測っておく
+        schedule_encode(key)
+    gain = loudness.gain_db(meta) - meta.get("baked_gain", 0.0)
+    if meta.get("codec") == "opus" and abs(gain) < 0.1:
+        return OggOpusSource(path, offset)
+    return discord.FFmpegPCMAudio(path, before_options=seek_options(offset),
+                                  options=loudness.volume_options(gain))
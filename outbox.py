@@ -0,0 +1,174 @@
+import asyncio
+import os
+from typing import Dict, List, Optional
+
+import discord
+
+from utils import metrics
+
+# Discordの1メッセージの上限
+MESSAGE_LIMIT = 2000
+# 最初の1通を送る前に，続けて来るメッセージを待つ秒数（同じコマンドの返事を1通にまとめる）
+COALESCE_SECONDS = float(os.environ.get("MESSAGE_COALESCE_SECONDS", 0.05))
+
+DISCORD_CALLS = metrics.REGISTRY.counter(
+    "bot_discord_messages_total", "Messages sent or edited by the bot", ["kind"]
+)
+
+
+class _Part:
+    """1通のメッセージの中の1行分（statusなら後から書き換える）"""
+
+    def __init__(self, text: str, key: Optional[str] = None) -> None:
+        self.text = text
+        self.key = key
+        self.message: Optional["_Sent"] = None
+
+
+class _Sent:
+    def __init__(self, message: discord.Message, parts: List[_Part]) -> None:
+        self.message = message
+        self.parts = parts
+        self.dirty = False
+
+
+def _render(parts: List[_Part]) -> str:
+    return "\n".join(part.text for part in parts)
+
+
+def split_text(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """limit文字を超える文字列を，なるべく行の切れ目で分ける"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    chunks.append(text)
+    return chunks
+
+
+def paginate(lines: List[str], header: str = "", footer: str = "", limit: int = MESSAGE_LIMIT) -> List[str]:
+    """header・lines・footerを，それぞれlimit文字に収まるページに分ける"""
+    # ページ番号（「(1/3) 続きは…」）を入れる分をあけておく
+    budget = limit - len(header) - len(footer) - 64
+    pages: List[List[str]] = [[]]
+    size = 0
+    for line in lines:
+        line = line[:budget]
+        if pages[-1] and size + len(line) + 1 > budget:
+            pages.append([])
+            size = 0
+        pages[-1].append(line)
+        size += len(line) + 1
+    return [header + "\n".join(page) + footer for page in pages]
+
+
+class Outbox:
+    """チャンネルごとの送信キュー
+
+    post/statusはすぐに返り，送信はチャンネルごとに1つのタスクが順番に行う．
+    送っている間（レート制限で待たされている間も）にたまったメッセージは
+    2000文字に収まる限り1通にまとめる．statusは同じkeyで呼ぶと，すでに送った
+    メッセージのその行を書き換える（書き換えもたまった分は最新の内容で1回だけ）．
+    """
+
+    def __init__(self, channel: discord.abc.Messageable) -> None:
+        self.channel = channel
+        self._pending: List[_Part] = []
+        self._statuses: Dict[str, _Part] = {}
+        self._dirty: List[_Sent] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def post(self, text: str) -> None:
+        for chunk in split_text(text):
+            self._pending.append(_Part(chunk))
+        self._start()
+
+    def status(self, key: str, text: str, final: bool = False) -> None:
+        """keyの行を出す（2回目からは書き換える）．finalなら以後は書き換えない"""
+        part = self._statuses.get(key)
+        if part is None:
+            part = _Part(text[:MESSAGE_LIMIT], key)
+            self._pending.append(part)
+            if not final:
+                self._statuses[key] = part
+        else:
+            part.text = text[:MESSAGE_LIMIT]
+            if part.message is not None and not part.message.dirty:
+                part.message.dirty = True
+                self._dirty.append(part.message)
+            if final:
+                del self._statuses[key]
+        self._start()
+
+    def idle(self) -> bool:
+        return not self._pending and not self._dirty
+
+    def _start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        await asyncio.sleep(COALESCE_SECONDS)
+        while not self.idle():
+            try:
+                await self._flush()
+            except discord.DiscordException as e:
+                print(e)
+
+    async def _flush(self) -> None:
+        dirty, self._dirty = self._dirty, []
+        for sent in dirty:
+            sent.dirty = False
+            DISCORD_CALLS.inc(kind="edit")
+            await sent.message.edit(content=_render(sent.parts))
+        while self._pending:
+            # 2000文字に収まるだけ取り出して1通にする
+            parts = [self._pending.pop(0)]
+            size = len(parts[0].text)
+            while self._pending and size + 1 + len(self._pending[0].text) <= MESSAGE_LIMIT:
+                size += 1 + len(self._pending[0].text)
+                parts.append(self._pending.pop(0))
+            DISCORD_CALLS.inc(kind="send")
+            message = await self.channel.send(_render(parts))
+            # 書き換えるかもしれない行があるメッセージだけ覚えておく
+            if any(part.key is not None for part in parts):
+                sent = _Sent(message, parts)
+                for part in parts:
+                    part.message = sent
+                    if part.key is not None and part.key not in self._statuses:
+                        # 送る前にfinalになった行は，最後の内容で送ったので書き換えない
+                        part.key = None
+                # 送っている間に書き換えられていたら，もう一度書き換える
+                if _render(parts) != getattr(message, "content", _render(parts)):
+                    sent.dirty = True
+                    self._dirty.append(sent)
+
+
+_outboxes: Dict[int, Outbox] = {}
+
+
+def get(channel: discord.abc.Messageable) -> Outbox:
+    box = _outboxes.get(channel.id)
+    if box is None:
+        box = _outboxes[channel.id] = Outbox(channel)
+    return box
+
+
+def post(channel: discord.abc.Messageable, text: str) -> None:
+    """channelに送る（待たない）．続けて送ったものは1通にまとまることがある"""
+    get(channel).post(text)
+
+
+def status(channel: discord.abc.Messageable, key: str, text: str, final: bool = False) -> None:
+    """進捗などの，同じメッセージを書き換えながら出す行"""
+    get(channel).status(key, text, final)
+
+
+async def drain(timeout: float = 10.0) -> None:
+    """たまっているメッセージを送り終わるまで待つ（止める前など）"""
+    tasks = [box._task for box in _outboxes.values() if box._task is not None and not box._task.done()]
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
@@ -0,0 +1,292 @@
+import asyncio
+from collections import deque
+from dataclasses import asdict, dataclass, fields
+import os
+import time
+from typing import Any, Deque, Dict, List, Optional
+
+import discord
+
+from audio_cache import cache
+import jobs
+import mixer
+import outbox
+import prefetch
+from queue_store import store
+from utils import metrics
+
+# 次の曲の音源がこの秒数で用意できなければ飛ばす（曲間が伸び続けないように）
+START_TIMEOUT = float(os.environ.get("TRACK_START_TIMEOUT", 15))
+
+
+@dataclass
+class Track:
+    """再生キューに入る1曲分の情報．音源（ffmpeg）はキューの先頭に来てから作る"""
+    title: str
+    # 'drive' か 'youtube'
+    kind: str
+    # DriveのファイルID，またはYouTubeのURL
+    ref: str
+    # キャッシュのキー（キューに入れるときにpinしておく）
+    cache_key: str
+    # YouTubeで解決済みの動画情報（youtube.slimで軽くしたもの．ストリームのURLを含む）
+    info: Optional[Dict[str, Any]] = None
+    # 途中から再生するときの位置（秒）．再起動の前に再生していた曲を続きから流す
+    offset: float = 0.0
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Track":
+        """保存したキューの行から戻す．今はないフィールド（前のgainなど）は読み飛ばす"""
+        names = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in data.items() if k in names})
+
+
+class GuildPlayer:
+    """ギルドごとのボイス接続・再生キュー・再生中の曲を持つ
+
+    曲の切り替えはイベントループ上のタスク（_run）が1曲ずつ行う．
+    discord.pyの音声スレッドからは曲の終わりを知らせるだけにする．
+    """
+
+    def __init__(self, guild_id: int) -> None:
+        self.guild_id = guild_id
+        self.voice: Optional[discord.VoiceClient] = None
+        self.queue: Deque[Track] = deque()
+        self.now_playing: Optional[Track] = None
+        # 最後に/playが送られてきたテキストチャンネル（進捗や失敗を知らせる）
+        self.channel: Optional[discord.abc.Messageable] = None
+        # 前の曲が終わってから次の曲が鳴りはじめるまでの秒数
+        self.last_gap: Optional[float] = None
+        self.max_gap = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup = asyncio.Event()
+        self._ended = asyncio.Event()
+        self._ended_at: Optional[float] = None
+        self._started_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        # クロスフェードするときに鳴らし続けるミキサー（mixer.CROSSFADE_SECONDS）
+        self._mixer: Optional[mixer.CrossfadeSource] = None
+
+    def is_connected(self) -> bool:
+        return self.voice is not None and self.voice.is_connected()
+
+    def is_active(self) -> bool:
+        """再生中または一時停止中ならTrue"""
+        return self.is_connected() and (self.voice.is_playing() or self.voice.is_paused())
+
+    async def connect(self, channel: discord.VoiceChannel) -> None:
+        if not self.is_connected():
+            self.voice = await channel.connect()
+        elif self.voice.channel != channel and not self.is_active():
+            await self.voice.move_to(channel)
+        self._wakeup.set()
+
+    def enqueue(self, track: Track) -> bool:
+        """曲を追加する．すぐに再生が始まる場合はTrueを返す"""
+        starting = self.now_playing is None and not self.queue
+        self.queue.append(track)
+        self._changed()
+        return starting
+
+    def tracks(self) -> List[Track]:
+        """再生中の曲とキューの曲を順番に返す"""
+        playing = [self.now_playing] if self.now_playing else []
+        return playing + list(self.queue)
+
+    def skip(self) -> bool:
+        """今の曲を止めて次の曲へ進む"""
+        if not self.is_active():
+            return False
+        self.voice.stop()
+        return True
+
+    def remove(self, index: int) -> Track:
+        """キューのindex番目（0始まり）の曲を取り除く"""
+        track = self.queue[index]
+        del self.queue[index]
+        _drop(track)
+        self._changed()
+        return track
+
+    def discard(self, track: Track) -> bool:
+        """キューにまだあればその曲を取り除く"""
+        for i, queued in enumerate(self.queue):
+            if queued is track:
+                self.remove(i)
+                return True
+        return False
+
+    def move(self, src: int, dst: int) -> Track:
+        """キューのsrc番目の曲をdst番目に移す（0始まり）"""
+        track = self.queue[src]
+        del self.queue[src]
+        self.queue.insert(dst, track)
+        self._changed()
+        return track
+
+    def clear(self) -> int:
+        """再生中の曲は残してキューを空にする"""
+        count = len(self.queue)
+        while self.queue:
+            _drop(self.queue.popleft())
+        store.mark_dirty(self)
+        return count
+
+    def position(self) -> float:
+        """再生中の曲のおおよその再生位置（秒．一時停止していた時間も含む）"""
+        if self.now_playing is None:
+            return 0.0
+        if self._started_at is None:
+            return self.now_playing.offset
+        return self.now_playing.offset + time.monotonic() - self._started_at
+
+    def snapshot(self) -> Dict[str, Any]:
+        """保存用に，キューと再生中の曲（と再生位置）を書き出す"""
+        now_playing = None
+        if self.now_playing is not None:
+            now_playing = dict(asdict(self.now_playing), offset=round(self.position(), 1))
+        return {
+            "voice_channel_id": self.voice.channel.id if self.is_connected() else None,
+            "text_channel_id": getattr(self.channel, "id", None),
+            "now_playing": now_playing,
+            "queue": [asdict(track) for track in self.queue],
+        }
+
+    def _changed(self) -> None:
+        store.mark_dirty(self)
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._loop = asyncio.get_running_loop()
+            self._task = self._loop.create_task(self._run())
+        # キューの並びが変わったので先読みし直す
+        prefetch.schedule(self)
+
+    async def _run(self) -> None:
+        while True:
+            if not self.queue or not self.is_connected():
+                # 曲が途切れたら曲間は測らない
+                self._ended_at = None
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            track = self.queue.popleft()
+            try:
+                await self._play(track)
+            except Exception as e:
+                # 1曲失敗してもギルドの再生は止めずに次の曲へ進む
+                print(track.title, repr(e))
+                self._notify("**"+track.title+"**は再生できなかったみたい…")
+
+    async def _play(self, track: Track) -> None:
+        self.now_playing = track
+        store.mark_dirty(self)
+        try:
+            source = await asyncio.wait_for(prefetch.open_source(track, self.channel), START_TIMEOUT)
+            if not self.is_connected():
+                source.cleanup()
+                raise RuntimeError("voice client disconnected")
+            self._ended.clear()
+            self._start(source, track)
+            self._started_at = time.monotonic()
+            if self._ended_at is not None:
+                self.last_gap = time.monotonic() - self._ended_at
+                self.max_gap = max(self.max_gap, self.last_gap)
+                metrics.TRACK_GAP_SECONDS.observe(self.last_gap)
+            # 次の曲たちを裏で取りに行っておく
+            prefetch.schedule(self)
+            await self._ended.wait()
+        finally:
+            self.now_playing = None
+            self._started_at = None
+            store.mark_dirty(self)
+            _release(track)
+
+    def _start(self, source: discord.AudioSource, track: Track) -> None:
+        if mixer.CROSSFADE_SECONDS <= 0:
+            self.voice.play(source, after=self._after)
+            return
+        # 前の曲の終わりがまだ鳴っていれば重ねる．鳴り終わっていたら新しく流す
+        if self._mixer is not None and self._mixer.add(source):
+            return
+        m = self._mixer = mixer.CrossfadeSource(source)
+        # 曲を読み切ったら（残りを鳴らしている間に）次の曲を用意し始める
+        m.on_track_end = lambda: self._loop.call_soon_threadsafe(self._track_ended, m, False)
+        self.voice.play(m, after=lambda error: self._after(error, m))
+
+    # discord.pyの音声スレッドから呼ばれる．イベントループに知らせるだけ
+    def _after(self, error: Optional[Exception], source: Optional[mixer.CrossfadeSource] = None) -> None:
+        if error:
+            print(error)
+        self._loop.call_soon_threadsafe(self._track_ended, source)
+
+    def _track_ended(self, source: Optional[mixer.CrossfadeSource] = None, stopped: bool = True) -> None:
+        # 前に使っていたミキサーが後から止まっても，今の曲は終わらせない
+        if source is not self._mixer:
+            return
+        if stopped:
+            self._mixer = None
+        self._ended_at = time.monotonic()
+        self._ended.set()
+
+    def _notify(self, content: str) -> None:
+        if self.channel is not None:
+            outbox.post(self.channel, content)
+
+    def close(self) -> None:
+        """キューを空にして（pinを外して）曲を切り替えるタスクを止める．
+        再生中の曲のpinはタスクが止まるときに外れる"""
+        self.clear()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def disconnect(self) -> None:
+        self.clear()
+        if self.voice is not None:
+            await self.voice.disconnect()
+        self.voice = None
+        self.close()
+
+
+_players: Dict[int, GuildPlayer] = {}
+
+metrics.REGISTRY.gauge(
+    "bot_queue_depth", "Tracks waiting in each guild's queue", ["guild"],
+    callback=lambda: {(str(guild_id),): len(p.queue) for guild_id, p in list(_players.items())},
+)
+
+
+def get_player(guild: discord.Guild) -> GuildPlayer:
+    """ギルドのプレイヤーを返す．なければ作る"""
+    player = _players.get(guild.id)
+    if player is None:
+        player = _players[guild.id] = GuildPlayer(guild.id)
+    return player
+
+
+def players() -> List[GuildPlayer]:
+    return list(_players.values())
+
+
+def remove_player(guild_id: int) -> None:
+    player = _players.pop(guild_id, None)
+    if player is not None:
+        # Discordにボイスから切られただけのときも，キャッシュのpinを残さない
+        player.close()
+    store.forget(guild_id)
+
+
+def _release(track: Track) -> None:
+    # 使い終わったキャッシュのファイルを追い出せるようにする
+    cache.unpin(track.cache_key)
+
+
+def _drop(track: Track) -> None:
+    """キューから外した曲のpinを外す．ほかのキューでも待っていなければ，
+    まだ始まっていない先読みも取り消して枠を空ける"""
+    _release(track)
+    if not cache.is_pinned(track.cache_key):
+        jobs.fetch.cancel(track.cache_key)
+        # キャッシュに入っている曲の変換は，次に流すときのために続ける
+        # （取り消すと，あとで再生するたびにffmpegでデコードすることになる）
+        if track.cache_key not in cache:
+            jobs.transcode.cancel(track.cache_key)
@@ -0,0 +1,82 @@
+import asyncio
+from itertools import islice
+import os
+from typing import Any, Dict, Optional, TYPE_CHECKING
+
+import discord
+
+from audio_cache import cache
+import drive
+import jobs
+import opus
+from utils import metrics
+import youtube
+
+if TYPE_CHECKING:
+    import player
+
+# キューの先頭から何曲先まで手元に持ってくるか（同時に取りに行く数はjobs.FETCH_WORKERSで抑える）
+PREFETCH_DEPTH = int(os.environ.get("PREFETCH_DEPTH", 3))
+
+# 取りに行っている最中の曲（キャッシュのキーごと．ギルドをまたいで1つにまとめる）
+_tasks: Dict[str, asyncio.Task] = {}
+
+
+def schedule(player: "player.GuildPlayer") -> None:
+    """キューの先頭からPREFETCH_DEPTH曲を裏でキャッシュに入れ始める"""
+    for track in islice(player.queue, PREFETCH_DEPTH):
+        key = track.cache_key
+        if key in cache or key in _tasks:
+            continue
+        task = _tasks[key] = asyncio.create_task(_prefetch(track))
+        task.add_done_callback(lambda t, key=key: _done(key, t))
+
+
+def _done(key: str, task: asyncio.Task) -> None:
+    _tasks.pop(key, None)
+    if not task.cancelled() and task.exception():
+        print(task.exception())
+
+
+async def _prefetch(track: "player.Track") -> None:
+    if track.kind == "drive":
+        download = drive.fetch(track.ref, jobs.PRIORITY_PREFETCH)
+        if download is not None:
+            await download.task
+    else:
+        await youtube.download(await _fresh_info(track), jobs.PRIORITY_PREFETCH)
+
+
+async def open_source(track: "player.Track", channel: Optional[discord.abc.Messageable] = None) -> discord.AudioSource:
+    """キューの先頭に来た曲の音源を作る．先読みが済んでいればファイルから，
+    まだなら途中まで落ちたファイルやストリームから再生する．
+
+    ffmpegのプロセスはここで初めて起動するので，キューが長くても待っている曲は
+    プロセスを持たない．"""
+    path = cache.get(track.cache_key)
+    metrics.cache_result("audio", path is not None)
+    if path is not None:
+        return opus.cached_source(track.cache_key, path, track.offset)
+
+    if track.kind == "drive":
+        # 先読み中ならそのダウンロードに相乗りする（まだ順番待ちなら先頭に回す）
+        download = drive.fetch(track.ref, jobs.PRIORITY_NOW)
+        if download is None:
+            return opus.cached_source(track.cache_key, cache.path(track.cache_key), track.offset)
+        if channel is not None and download.written == 0:
+            asyncio.create_task(drive.report_progress(download, channel))
+        await download.wait_ready()
+        if download.error:
+            raise download.error
+        return drive.audio_source(track.ref, download, track.offset)
+
+    info = await _fresh_info(track)
+    youtube.fill_cache(info)
+    return youtube.stream_source(info, track.offset)
+
+
+async def _fresh_info(track: "player.Track") -> Dict[str, Any]:
+    # キューで待っている間にストリームのURLの期限が切れていたら取り直す
+    if track.info is None or youtube.is_expired(track.info):
+        track.info = await youtube.resolve(track.ref)
+    return track.info
@@ -0,0 +1,194 @@
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import unicodedata
+
+# /profileで引くアイドルのデータ（name・kana・romaji・unit．detailsがあれば一緒に出す）
+PROFILE_DATA = os.environ.get("PROFILE_DATA", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           "data", "profiles.json"))
+# ファイルが書き換えられていないかを見に行く間隔（秒）．変わっていれば読み直す
+RELOAD_INTERVAL = 5.0
+# n-gramでの部分一致に必要な，検索語のbigramが重なる割合
+NGRAM_THRESHOLD = 0.5
+
+_SEPARATORS = re.compile(r"[\s・･'’\-_.,]+")
+# ローマ字の伸ばす音の書き方の違い（Yuukoku / Yukoku，Tooru / Tohru / Toru）
+_LONG_VOWELS = ((re.compile(r"ou|oo|oh(?![aiueo])"), "o"), (re.compile(r"uu"), "u"))
+
+
+@dataclass
+class Profile:
+    name: str
+    kana: str
+    romaji: str
+    unit: str = ""
+    # 好きに足せる項目（表示名 → 値）．足した順に表示する
+    details: Dict[str, str] = field(default_factory=dict)
+
+
+def normalize(text: str) -> str:
+    """全角・半角，大文字・小文字，カタカナ・ひらがな，区切りの違いを吸収する"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _SEPARATORS.sub("", text)
+    # カタカナはひらがなにそろえる
+    return "".join(chr(ord(c) - 0x60) if "ァ" <= c <= "ヶ" else c for c in text)
+
+
+def normalize_romaji(text: str) -> str:
+    text = normalize(text)
+    for pattern, repl in _LONG_VOWELS:
+        text = pattern.sub(repl, text)
+    return text
+
+
+def _is_ascii(text: str) -> bool:
+    return all(ord(c) < 128 for c in text)
+
+
+def _bigrams(text: str) -> Set[str]:
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def _keys(profile: Profile) -> Set[str]:
+    """1人分の検索キー．フルネーム（両方の順番）と，姓・名それぞれ"""
+    keys = set()
+    for text, norm in ((profile.name, normalize), (profile.kana, normalize), (profile.romaji, normalize_romaji)):
+        words = [norm(w) for w in text.split()]
+        keys.add("".join(words))
+        keys.add("".join(reversed(words)))
+        keys.update(words)
+    keys.discard("")
+    return keys
+
+
+class ProfileIndex:
+    """プロフィールの検索用インデックス（作ったあとは読むだけ）
+
+    - キー（正規化した漢字・かな・ローマ字）→ プロフィールの完全一致の表
+    - 並べたキーの配列（二分探索で前方一致）
+    - bigram → キーの転置インデックス（部分一致・多少の書き間違い）
+    """
+
+    def __init__(self, profiles: Iterable[Profile]) -> None:
+        self.profiles: List[Profile] = list(profiles)
+        self._exact: Dict[str, List[int]] = defaultdict(list)
+        self._units: Dict[str, List[int]] = defaultdict(list)
+        for i, profile in enumerate(self.profiles):
+            for key in _keys(profile):
+                self._exact[key].append(i)
+            if profile.unit:
+                self._units[normalize(profile.unit)].append(i)
+        self._sorted: List[str] = sorted(self._exact)
+        self._grams: Dict[str, List[str]] = defaultdict(list)
+        for key in self._sorted:
+            for gram in _bigrams(key):
+                self._grams[gram].append(key)
+
+    def __len__(self) -> int:
+        return len(self.profiles)
+
+    def lookup(self, query: str, limit: int = 10) -> List[Profile]:
+        """完全一致 → ユニット名 → 前方一致 → n-gramの部分一致の順に探す"""
+        key = normalize_romaji(query) if _is_ascii(query) else normalize(query)
+        if not key:
+            return []
+        for found in (self._exact.get(key), self._units.get(normalize(query))):
+            if found:
+                return [self.profiles[i] for i in found[:limit]]
+        found = self._prefix(key)
+        if not found:
+            found = self._ngram(key)
+        return [self.profiles[i] for i in found[:limit]]
+
+    def _prefix(self, key: str) -> List[int]:
+        result: List[int] = []
+        start = bisect_left(self._sorted, key)
+        for candidate in self._sorted[start:]:
+            if not candidate.startswith(key):
+                break
+            result.extend(i for i in self._exact[candidate] if i not in result)
+        return result
+
+    def _ngram(self, key: str) -> List[int]:
+        grams = _bigrams(key)
+        hits: Counter = Counter()
+        for gram in grams:
+            for candidate in self._grams.get(gram, ()):
+                hits[candidate] += 1
+        scores: Dict[int, float] = {}
+        for candidate, count in hits.items():
+            score = count / len(grams)
+            if score >= NGRAM_THRESHOLD:
+                for i in self._exact[candidate]:
+                    scores[i] = max(scores.get(i, 0.0), score)
+        return [i for i, _ in sorted(scores.items(), key=lambda item: (-item[1], item[0]))]
+
+
+def load(path: str = PROFILE_DATA) -> ProfileIndex:
+    with open(path, encoding="utf-8") as f:
+        return ProfileIndex(Profile(**item) for item in json.load(f))
+
+
+class _Loader:
+    """データを1回読んでインデックスにし，ファイルが変わったら読み直して差し替える"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.index: Optional[ProfileIndex] = None
+        self._mtime: Optional[float] = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> ProfileIndex:
+        now = time.monotonic()
+        if self.index is None or now - self._checked >= RELOAD_INTERVAL:
+            self._checked = now
+            self.reload()
+        return self.index
+
+    def reload(self, force: bool = False) -> Tuple[ProfileIndex, bool]:
+        """ファイルが変わっていれば（forceなら必ず）読み直す．読み直したらTrueも返す"""
+        with self._lock:
+            try:
+                mtime = os.path.getmtime(self.path)
+                if self.index is not None and mtime == self._mtime and not force:
+                    return self.index, False
+                index = load(self.path)
+            except (OSError, ValueError, TypeError) as e:
+                # 書きかけや壊れたファイルなら前のインデックスを使い続ける
+                if self.index is None:
+                    raise
+                print("プロフィールを読み込めませんでした", repr(e))
+                return self.index, False
+            self.index, self._mtime = index, mtime
+            return index, True
+
+
+_loader = _Loader(PROFILE_DATA)
+
+
+def lookup(query: str, limit: int = 10) -> List[Profile]:
+    return _loader.get().lookup(query, limit)
+
+
+def reload(force: bool = False) -> int:
+    """読み直して件数を返す（起動時やデータを差し替えたとき）"""
+    index, _ = _loader.reload(force)
+    return len(index)
+
+
+def format_profile(profile: Profile) -> str:
+    lines = ["**" + profile.name.replace(" ", "") + "**（" + profile.kana + " / " + profile.romaji + "）"]
+    if profile.unit:
+        lines.append("ユニット : " + profile.unit)
+    for label, value in profile.details.items():
+        lines.append(label + " : " + value)
+    return "\n".join(lines)
@@ -0,0 +1,210 @@
+import asyncio
+from contextlib import contextmanager
+import json
+import os
+import queue
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from MySQLdb.connections import Connection
+
+    import player
+
+# MySQLの接続先．MYSQL_HOSTがなければキューは保存しない
+MYSQL_HOST = os.environ.get("MYSQL_HOST")
+MYSQL_PORT = int(os.environ.get("MYSQL_PORT", 3306))
+MYSQL_USER = os.environ.get("MYSQL_USER", "root")
+MYSQL_PASSWORD = os.environ.get("MYSQL_PASSWORD", "")
+MYSQL_DATABASE = os.environ.get("MYSQL_DATABASE", "appmusic")
+POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE", 2))
+# 変わったキューをまとめて書き込む間隔（秒）
+FLUSH_INTERVAL = float(os.environ.get("QUEUE_FLUSH_INTERVAL", 2.0))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS guild_queues (
+    guild_id BIGINT UNSIGNED NOT NULL PRIMARY KEY,
+    voice_channel_id BIGINT UNSIGNED NULL,
+    text_channel_id BIGINT UNSIGNED NULL,
+    state MEDIUMTEXT NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+)
+"""
+UPSERT = (
+    "INSERT INTO guild_queues (guild_id, voice_channel_id, text_channel_id, state) "
+    "VALUES (%s, %s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE voice_channel_id = VALUES(voice_channel_id), "
+    "text_channel_id = VALUES(text_channel_id), state = VALUES(state)"
+)
+
+
+def _connect() -> "Connection":
+    # mysqlclientは使うときだけ読み込む（保存しないなら要らない）
+    import MySQLdb
+    return MySQLdb.connect(host=MYSQL_HOST, port=MYSQL_PORT, user=MYSQL_USER, passwd=MYSQL_PASSWORD,
+                           db=MYSQL_DATABASE, charset="utf8mb4", autocommit=False)
+
+
+class ConnectionPool:
+    """MySQLの接続を最大size本まで作って使い回す（スレッドから使う）"""
+
+    def __init__(self, connect: Callable[[], "Connection"], size: int = POOL_SIZE) -> None:
+        self._connect = connect
+        self._idle: "queue.LifoQueue[Connection]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self) -> Iterator["Connection"]:
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            except Exception:
+                # 切れた接続かもしれないので捨てて，次は作り直す
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                raise
+            else:
+                self._idle.put(conn)
+
+
+class QueueStore:
+    """ギルドごとのキューと再生中の曲をMySQLに書き残す（write-behind）
+
+    キューが変わったらmark_dirtyで印をつけるだけにして，FLUSH_INTERVALごとに
+    変わったギルドの分だけを1つのトランザクションでまとめて書く．
+    再生やコマンドの処理がデータベースを待つことはない．
+    """
+
+    def __init__(self, connect: Optional[Callable[[], "Connection"]] = None, flush_interval: float = FLUSH_INTERVAL) -> None:
+        if connect is None and MYSQL_HOST:
+            connect = _connect
+        self.enabled = connect is not None
+        self._pool = ConnectionPool(connect) if connect is not None else None
+        self.flush_interval = flush_interval
+        # guild_id → プレイヤー（Noneなら消す）
+        self._dirty: Dict[int, Optional["player.GuildPlayer"]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+        self._schema_ready = False
+
+    def mark_dirty(self, p: "player.GuildPlayer") -> None:
+        if not self.enabled or self._closed:
+            return
+        self._dirty[p.guild_id] = p
+        self._start()
+
+    def forget(self, guild_id: int) -> None:
+        """プレイヤーを捨てたギルドの保存も消す"""
+        if not self.enabled or self._closed:
+            return
+        self._dirty[guild_id] = None
+        self._start()
+
+    def _start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._flush_forever())
+
+    async def _flush_forever(self) -> None:
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print("キューを保存できませんでした", repr(e))
+
+    async def flush(self) -> None:
+        """印のついたギルドを書き込む．スナップショットはイベントループで取る"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        rows = []
+        removed = []
+        for guild_id, p in dirty.items():
+            state = p.snapshot() if p is not None else None
+            if state is None or (state["now_playing"] is None and not state["queue"]):
+                removed.append(guild_id)
+            else:
+                rows.append((guild_id, state.pop("voice_channel_id"), state.pop("text_channel_id"),
+                             json.dumps(state, ensure_ascii=False)))
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._write, rows, removed)
+        except Exception:
+            # 書けなかった分は，そのあと変わっていなければ次の回にもう一度書く
+            for guild_id, p in dirty.items():
+                self._dirty.setdefault(guild_id, p)
+            raise
+
+    def _ensure_schema(self, conn: "Connection") -> None:
+        if not self._schema_ready:
+            with conn.cursor() as cursor:
+                cursor.execute(SCHEMA)
+            self._schema_ready = True
+
+    def _write(self, rows: List[tuple], removed: List[int]) -> None:
+        with self._pool.connection() as conn:
+            self._ensure_schema(conn)
+            with conn.cursor() as cursor:
+                if rows:
+                    cursor.executemany(UPSERT, rows)
+                if removed:
+                    cursor.execute("DELETE FROM guild_queues WHERE guild_id IN (%s)"
+                                   % ", ".join(["%s"] * len(removed)), removed)
+            conn.commit()
+
+    def _query(self, sql: str, args: tuple = ()) -> List[tuple]:
+        with self._pool.connection() as conn:
+            self._ensure_schema(conn)
+            with conn.cursor() as cursor:
+                cursor.execute(sql, args)
+                result = list(cursor.fetchall())
+            conn.commit()
+            return result
+
+    async def saved_guilds(self) -> List[int]:
+        """キューが保存されているギルド"""
+        if not self.enabled:
+            return []
+        rows = await asyncio.get_running_loop().run_in_executor(
+            None, self._query, "SELECT guild_id FROM guild_queues")
+        return [int(row[0]) for row in rows]
+
+    async def load(self, guild_id: int) -> Optional[Dict[str, Any]]:
+        """保存されているキュー（{'voice_channel_id', 'text_channel_id', 'now_playing', 'queue'}）"""
+        if not self.enabled:
+            return None
+        rows = await asyncio.get_running_loop().run_in_executor(
+            None, self._query,
+            "SELECT voice_channel_id, text_channel_id, state FROM guild_queues WHERE guild_id = %s",
+            (guild_id,))
+        if not rows:
+            return None
+        voice_channel_id, text_channel_id, state = rows[0]
+        result = json.loads(state)
+        result["voice_channel_id"] = voice_channel_id
+        result["text_channel_id"] = text_channel_id
+        return result
+
+    async def close(self, players: Iterable["player.GuildPlayer"] = ()) -> None:
+        """止める前に今の再生位置を書いてから，それ以上は書かない
+        （切断でプレイヤーが消えても保存は消さない）"""
+        if not self.enabled or self._closed:
+            return
+        for p in players:
+            self._dirty[p.guild_id] = p
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+        try:
+            await self.flush()
+        except Exception as e:
+            print("キューを保存できませんでした", repr(e))
+
+
+store = QueueStore()
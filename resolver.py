@@ -0,0 +1,159 @@
+import asyncio
+from dataclasses import dataclass, field
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+import drive_index
+from utils import metrics
+import youtube
+
+# /playの検索語で探すのにかける時間の上限（秒）．過ぎたらそれまでに見つかった分で決める
+SEARCH_DEADLINE = float(os.environ.get("SEARCH_DEADLINE", 3.0))
+# Driveがこの秒数たっても答えなければ，YouTubeの検索も始める（見つからなかったときはすぐ始める）
+HEDGE_DELAY = float(os.environ.get("SEARCH_HEDGE_DELAY", 0.3))
+# 0ならYouTubeは検索しない（今まで通りDriveだけ）
+YOUTUBE_SEARCH = os.environ.get("YOUTUBE_SEARCH", "1") != "0"
+
+SEARCH_REQUESTS = metrics.REGISTRY.counter(
+    "bot_search_requests_total", "/play searches by backend and outcome", ["backend", "outcome"]
+)
+SEARCH_SECONDS = metrics.REGISTRY.histogram(
+    "bot_search_seconds", "Time until a search backend answered", ["backend"]
+)
+
+
+@dataclass
+class Candidate:
+    source: str  # 'drive'・'folder'・'youtube'
+    ref: str  # DriveのファイルID・フォルダID，または動画のURL
+    title: str
+
+
+@dataclass
+class Result:
+    # すぐ再生するもの（フォルダなら中の曲を全部）
+    play: Optional[Candidate] = None
+    # 1つに決められなかったときに選んでもらう候補
+    candidates: List[Candidate] = field(default_factory=list)
+    # 答えを出した検索先
+    backend: Optional[str] = None
+    # 時間内に答えなかった検索先
+    timed_out: List[str] = field(default_factory=list)
+
+
+# 検索先：検索語 → 見つかったもの（なければNone）
+Search = Callable[[str], Awaitable[Optional[Result]]]
+# (名前, 検索, 何秒たったら前の検索先を待たずに始めるか) を優先順に並べる
+Backend = Tuple[str, Search, float]
+
+
+async def search_drive(word: str) -> Optional[Result]:
+    """Driveのライブラリから探す（名前が完全に一致すればそれを再生）"""
+    items, folders = await asyncio.gather(
+        drive_index.search(word), drive_index.search(word, folders=True))
+    if items and drive_index.is_exact(items[0]['name'], word):
+        return Result(play=Candidate('drive', items[0]['id'], items[0]['name']))
+    if folders and (drive_index.is_exact(folders[0]['name'], word) or (not items and len(folders) == 1)):
+        # フォルダの名前ならその中の曲を全部入れる
+        return Result(play=Candidate('folder', folders[0]['id'], folders[0]['name']))
+    if not items:
+        return None
+    if len(items) == 1:
+        return Result(play=Candidate('drive', items[0]['id'], items[0]['name']))
+    return Result(candidates=[Candidate('drive', item['id'], item['name']) for item in items])
+
+
+async def search_youtube(word: str) -> Optional[Result]:
+    """YouTubeで探して一番上の動画を再生する"""
+    entries = await youtube.search(word)
+    if not entries:
+        return None
+    return Result(play=Candidate('youtube', entries[0]['url'], entries[0]['title']))
+
+
+def default_backends() -> List[Backend]:
+    backends: List[Backend] = [('drive', search_drive, 0.0)]
+    if YOUTUBE_SEARCH:
+        backends.append(('youtube', search_youtube, HEDGE_DELAY))
+    return backends
+
+
+async def _run(name: str, search: Search, word: str) -> Optional[Result]:
+    started = time.monotonic()
+    try:
+        result = await search(word)
+    except asyncio.CancelledError:
+        SEARCH_REQUESTS.inc(backend=name, outcome="cancelled")
+        raise
+    except Exception as e:
+        # 1つの検索先が失敗しても，ほかの検索先の答えで決める
+        print(name, "で検索できませんでした", repr(e))
+        SEARCH_REQUESTS.inc(backend=name, outcome="error")
+        return None
+    SEARCH_SECONDS.observe(time.monotonic() - started, backend=name)
+    SEARCH_REQUESTS.inc(backend=name, outcome="found" if result is not None else "empty")
+    if result is not None:
+        result.backend = name
+    return result
+
+
+def _pick(backends: Sequence[Backend], tasks: Dict[str, "asyncio.Task[Optional[Result]]"]) -> Optional[Result]:
+    """優先順に見て答えが決まればそれを返す．上の検索先の答えをまだ待っているならNone"""
+    for name, _, _ in backends:
+        task = tasks.get(name)
+        if task is None or not task.done():
+            return None
+        result = task.result()
+        if result is not None:
+            return result
+    return Result()
+
+
+async def resolve(word: str, backends: Optional[Sequence[Backend]] = None,
+                  deadline: float = SEARCH_DEADLINE) -> Result:
+    """検索語をいくつかの検索先で同時に探し，決められたところですぐ返す
+
+    - 上の検索先で見つかればそれを使い，下の検索先の答えは待たない
+    - 下の検索先は，上の検索先が見つけられなかったとき，またはdelay秒たっても
+      答えないときに始める（速い検索先だけで決まるときは遅い検索先に問い合わせない）
+    - deadlineを過ぎたら，それまでに見つかったうち一番上のものを使う
+
+    決まった時点で残りの検索はキャンセルする（スレッドで動いている問い合わせ自体は
+    止まらないが，その答えは待たない）．
+    """
+    if backends is None:
+        backends = default_backends()
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    tasks: Dict[str, "asyncio.Task[Optional[Result]]"] = {}
+    try:
+        while True:
+            result = _pick(backends, tasks)
+            if result is not None:
+                return result
+            elapsed = loop.time() - started
+            if elapsed >= deadline:
+                break
+            wake = deadline
+            for i, (name, search, delay) in enumerate(backends):
+                if name in tasks:
+                    continue
+                if elapsed >= delay or all(n in tasks and tasks[n].done() for n, _, _ in backends[:i]):
+                    tasks[name] = loop.create_task(_run(name, search, word))
+                else:
+                    wake = min(wake, delay)
+            pending = [task for task in tasks.values() if not task.done()]
+            await asyncio.wait(pending, timeout=wake - elapsed, return_when=asyncio.FIRST_COMPLETED)
+        # 間に合わなかった検索先は諦め，答えたもののうち一番上を使う
+        result = Result()
+        for name, _, _ in backends:
+            task = tasks.get(name)
+            if task is not None and task.done() and task.result() is not None:
+                result = task.result()
+                break
+        result.timed_out = [name for name, task in tasks.items() if not task.done()]
+        return result
+    finally:
+        for task in tasks.values():
+            task.cancel()
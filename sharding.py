@@ -0,0 +1,185 @@
+"""シャーディング（ギルドを複数のゲートウェイ接続・プロセスに分ける）
+
+SHARD_COUNTを設定しなければ，今まで通り1つのClientで動く．
+
+    # 1プロセスで全シャードを動かす（"auto"ならDiscordのおすすめの数）
+    SHARD_COUNT=auto python app.py
+    # 8シャードを4プロセスに分ける（1プロセス2シャード）
+    SHARD_COUNT=8 SHARD_PROCESSES=4 python sharding.py
+
+ランチャーは各プロセスに受け持つシャード（SHARD_IDS）と，プロセスごとの
+ポート・キャッシュの置き場所を渡し，落ちたら起動し直す．Driveのインデックスは
+全プロセスで1つを共有し，Driveと同期するのは0番目のプロセスだけにする．
+"""
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+import urllib.request
+
+import discord
+
+# 全体のシャード数（数字か"auto"）と，このプロセスが受け持つシャード（"0-3" や "0,2,4"）
+SHARD_COUNT = os.environ.get("SHARD_COUNT")
+SHARD_IDS = os.environ.get("SHARD_IDS")
+# ランチャーが起動するプロセスの数
+SHARD_PROCESSES = int(os.environ.get("SHARD_PROCESSES", 1))
+# 落ちたプロセスを起動し直すまでの秒数（続けて落ちるたびに倍にする）
+RESTART_DELAY = 5.0
+RESTART_DELAY_MAX = 300.0
+GATEWAY_URL = "https://discord.com/api/v10/gateway/bot"
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+def intents() -> discord.Intents:
+    """使うイベントだけを受け取る（プレゼンスやメンバーのイベントは使わない）"""
+    result = discord.Intents.none()
+    # ギルドとチャンネルの情報，ボイスチャンネルへの接続と誰がどこにいるか
+    result.guilds = True
+    result.voice_states = True
+    # サーバーのテキストチャンネルのコマンド（DMは無視している）
+    result.guild_messages = True
+    # discord.py 2.0からはメッセージの本文も明示的に頼む必要がある
+    if hasattr(result, "message_content"):
+        result.message_content = True
+    return result
+
+
+def parse_shard_ids(text: str) -> List[int]:
+    """"0-3" や "0,2,4-5" をシャード番号のリストにする"""
+    ids: List[int] = []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            ids.extend(range(int(first), int(last) + 1))
+        else:
+            ids.append(int(part))
+    return ids
+
+
+def make_client() -> discord.Client:
+    """環境変数に合わせてClient（シャーディングするならAutoShardedClient）を作る"""
+    if not SHARD_COUNT:
+        return discord.Client(intents=intents())
+    # autoならログインするときにDiscordにおすすめの数を聞く
+    count = None if SHARD_COUNT == "auto" else int(SHARD_COUNT)
+    shard_ids = parse_shard_ids(SHARD_IDS) if SHARD_IDS else None
+    if shard_ids is not None and count is None:
+        raise ValueError("SHARD_IDS needs a numeric SHARD_COUNT")
+    return discord.AutoShardedClient(intents=intents(), shard_count=count, shard_ids=shard_ids)
+
+
+def recommended_shards(token: str) -> int:
+    """Discordがおすすめするシャード数"""
+    request = urllib.request.Request(GATEWAY_URL, headers={"Authorization": "Bot " + token})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return int(json.load(response)["shards"])
+
+
+def plan(shard_count: int, processes: int) -> List[List[int]]:
+    """シャードをなるべく均等に，連続した番号でプロセスに分ける"""
+    processes = max(1, min(processes, shard_count))
+    base, extra = divmod(shard_count, processes)
+    groups: List[List[int]] = []
+    first = 0
+    for i in range(processes):
+        size = base + (1 if i < extra else 0)
+        groups.append(list(range(first, first + size)))
+        first += size
+    return groups
+
+
+def worker_env(index: int, shard_count: int, shard_ids: List[int], processes: int,
+               base: Dict[str, str]) -> Dict[str, str]:
+    """index番目のプロセスの環境変数．キャッシュやポートはプロセスごとに分ける"""
+    env = dict(base)
+    env["SHARD_COUNT"] = str(shard_count)
+    env["SHARD_IDS"] = "%d-%d" % (shard_ids[0], shard_ids[-1])
+    # 0番目のプロセスがCloud Runのヘルスチェック（PORT）に答える
+    env["PORT"] = str(int(base.get("PORT", 8080)) + index)
+    cache_dir = base.get("AUDIO_CACHE_DIR", "audio_cache")
+    env["AUDIO_CACHE_DIR"] = os.path.join(cache_dir, "worker-%d" % index)
+    # キャッシュの上限（audio_cacheの既定は2GiB）もプロセスで分け合う
+    env["AUDIO_CACHE_MAX_BYTES"] = str(int(base.get("AUDIO_CACHE_MAX_BYTES", 2 * 1024 ** 3)) // processes)
+    # Driveのインデックスは分けない．0番目のプロセスだけが同期し（一覧と変更フィードを
+    # 取るのは1プロセス分で済む），ほかのプロセスは同じファイルを読む
+    if index > 0:
+        env["DRIVE_INDEX_SYNC"] = "0"
+    # 変換のスレッドはプロセスの数で割って，全体でCPUの数を超えないようにする
+    if "TRANSCODE_WORKERS" not in base:
+        env["TRANSCODE_WORKERS"] = str(max(1, (os.cpu_count() or 2) // 2 // processes))
+    return env
+
+
+class _Worker:
+    def __init__(self, index: int, env: Dict[str, str]) -> None:
+        self.index = index
+        self.env = env
+        self.process: Optional[subprocess.Popen] = None
+        self.started_at = 0.0
+        self.delay = RESTART_DELAY
+        self.restart_at = 0.0
+
+    def start(self) -> None:
+        print("シャード%sを起動します（worker %d）" % (self.env["SHARD_IDS"], self.index))
+        self.process = subprocess.Popen([sys.executable, APP_PATH], env=self.env)
+        self.started_at = time.monotonic()
+
+
+def main() -> int:
+    """シャードをSHARD_PROCESSES個のプロセスに分けて起動し，見張る"""
+    if not SHARD_COUNT or SHARD_COUNT == "auto":
+        shard_count = recommended_shards(os.environ["TOKEN"])
+    else:
+        shard_count = int(SHARD_COUNT)
+    groups = plan(shard_count, SHARD_PROCESSES)
+    workers = [_Worker(i, worker_env(i, shard_count, ids, len(groups), dict(os.environ)))
+               for i, ids in enumerate(groups)]
+
+    stopping = False
+
+    def stop(signum: int, frame: object) -> None:
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for worker in workers:
+        worker.start()
+    while not stopping:
+        time.sleep(1)
+        now = time.monotonic()
+        for worker in workers:
+            if worker.process is not None and worker.process.poll() is not None:
+                # しばらく動いていたなら待ち時間を戻す
+                if now - worker.started_at > RESTART_DELAY_MAX:
+                    worker.delay = RESTART_DELAY
+                print("worker %d が終了しました（%d）．%d秒後に起動し直します"
+                      % (worker.index, worker.process.returncode, worker.delay))
+                worker.process = None
+                worker.restart_at = now + worker.delay
+                worker.delay = min(worker.delay * 2, RESTART_DELAY_MAX)
+            elif worker.process is None and now >= worker.restart_at:
+                worker.start()
+
+    # 子プロセスにもSIGTERMを送って，接続を閉じ終わるのを待つ
+    running = [w.process for w in workers if w.process is not None]
+    for process in running:
+        process.terminate()
+    for process in running:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
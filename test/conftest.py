@@ -12,18 +12,63 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import flask
-from flask.testing import FlaskClient
+import asyncio
+import os
+import shutil
+import tempfile
+from typing import Iterator, Tuple
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
 import pytest
 
-from app import app as flask_app
+
+_tmp_dir = tempfile.mkdtemp(prefix="appmusic-test-")
+
+
+def pytest_configure(config: pytest.Config) -> None:
+    # audio_cacheとdrive_indexは読み込むときにファイルを作ったり片付けたりするので，
+    # テストのモジュールを読み込む前に一時ディレクトリへ向けておく
+    # （リポジトリや，近くで動いているボットのキャッシュには触らない）
+    os.environ["AUDIO_CACHE_DIR"] = os.path.join(_tmp_dir, "audio_cache")
+    os.environ["DRIVE_INDEX_PATH"] = os.path.join(_tmp_dir, "drive_index.sqlite3")
+
+
+def pytest_unconfigure(config: pytest.Config) -> None:
+    shutil.rmtree(_tmp_dir, ignore_errors=True)
+
+
+class HealthClient:
+    """health.make_appのアプリに，テストからふつうの関数としてリクエストを送る"""
+
+    def __init__(self, app: web.Application) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._client = TestClient(TestServer(app), loop=self._loop)
+        self._loop.run_until_complete(self._client.start_server())
+
+    def request(self, method: str, path: str) -> Tuple[int, str]:
+        async def send() -> Tuple[int, str]:
+            async with self._client.request(method, path) as res:
+                return res.status, await res.text()
+        return self._loop.run_until_complete(send())
+
+    def get(self, path: str) -> Tuple[int, str]:
+        return self.request("GET", path)
+
+    def close(self) -> None:
+        self._loop.run_until_complete(self._client.close())
+        self._loop.close()
 
 
 @pytest.fixture
-def app() -> None:
-    yield flask_app
+def app() -> web.Application:
+    from app import client as bot_client
+    import health
+    return health.make_app(bot_client)
 
 
 @pytest.fixture
-def client(app: flask.app.Flask) -> FlaskClient:
-    return app.test_client()
+def client(app: web.Application) -> Iterator[HealthClient]:
+    client = HealthClient(app)
+    yield client
+    client.close()
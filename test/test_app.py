@@ -12,15 +12,172 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import flask
-from flask.testing import FlaskClient
+import asyncio
+import json
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
 
+import pytest
 
-def test_get_index(app: flask.app.Flask, client: FlaskClient) -> None:
-    res = client.get("/")
-    assert res.status_code == 200
+from test.conftest import HealthClient
 
 
-def test_post_index(app: flask.app.Flask, client: FlaskClient) -> None:
-    res = client.post("/")
-    assert res.status_code == 405
+def test_get_index(client: HealthClient) -> None:
+    status, text = client.get("/")
+    assert status == 200
+    assert text == "ok"
+
+
+def test_post_index(client: HealthClient) -> None:
+    status, _ = client.request("POST", "/")
+    assert status == 405
+
+
+def test_not_ready_before_gateway(client: HealthClient) -> None:
+    status, _ = client.get("/readyz")
+    assert status == 503
+
+
+def test_status_snapshot(client: HealthClient) -> None:
+    status, text = client.get("/status")
+    assert status == 200
+    body = json.loads(text)
+    assert body["ready"] is False
+    assert body["guilds"] == 0
+    assert body["voice_sessions"] == 0
+    assert {"entries", "bytes", "max_bytes"} <= set(body["cache"])
+
+
+def test_metrics(client: HealthClient) -> None:
+    status, text = client.get("/metrics")
+    assert status == 200
+    assert "# TYPE bot_command_seconds histogram" in text
+
+
+class FakeStore:
+    """保存されているキューを返すだけのqueue_store.store"""
+
+    enabled = True
+
+    def __init__(self, state: Optional[Dict[str, Any]]) -> None:
+        self.state = state
+        self.loads = 0
+
+    async def load(self, guild_id: int) -> Optional[Dict[str, Any]]:
+        self.loads += 1
+        return self.state
+
+
+def test_failed_restore_does_not_block_commands(monkeypatch: pytest.MonkeyPatch) -> None:
+    import app
+    import outbox
+    import queue_store
+
+    # 前の版で保存された，今のTrackには戻せない行
+    store = FakeStore({"voice_channel_id": None, "text_channel_id": None,
+                       "now_playing": None, "queue": [{"title": "曲", "kind": "drive"}]})
+    monkeypatch.setattr(queue_store, "store", store)
+    monkeypatch.setattr(app, "restore_tasks", {})
+    posted: List[str] = []
+    monkeypatch.setattr(outbox, "post", lambda channel, text: posted.append(text))
+    guild = SimpleNamespace(id=1, get_channel=lambda channel_id: None)
+    author = SimpleNamespace(bot=False, voice=None)
+
+    async def send(content: str) -> None:
+        await app.handle_message(SimpleNamespace(content=content, guild=guild, channel=None, author=author))
+
+    async def main() -> None:
+        await send("/list")
+        await send("/list")
+
+    try:
+        asyncio.run(main())
+    finally:
+        app.remove_player(guild.id)
+    # 戻せなかったことは1回だけ試して，どちらのコマンドにも答える
+    assert store.loads == 1
+    assert posted == ["静かだねぇ〜", "静かだねぇ〜"]
+
+
+def test_chat_does_not_create_a_player(monkeypatch: pytest.MonkeyPatch) -> None:
+    import app
+    import outbox
+    import player
+    import queue_store
+
+    store = FakeStore(None)
+    monkeypatch.setattr(queue_store, "store", store)
+    monkeypatch.setattr(app, "restore_tasks", {})
+    monkeypatch.setattr(outbox, "post", lambda channel, text: None)
+    guild = SimpleNamespace(id=2, get_channel=lambda channel_id: None)
+    author = SimpleNamespace(bot=False, voice=None)
+
+    async def send(content: str) -> None:
+        await app.handle_message(SimpleNamespace(content=content, guild=guild, channel=None, author=author))
+
+    asyncio.run(send("こんにちは"))
+    asyncio.run(send("/help"))
+    assert all(p.guild_id != guild.id for p in player.players())
+    assert store.loads == 0
+
+    try:
+        asyncio.run(send("/list"))
+        assert any(p.guild_id == guild.id for p in player.players())
+    finally:
+        app.remove_player(guild.id)
+
+
+class FakeVoiceChannel:
+    def __init__(self, error: Optional[BaseException] = None) -> None:
+        self.error = error
+        self.members: List[Any] = []
+
+    async def connect(self) -> SimpleNamespace:
+        if self.error is not None:
+            raise self.error
+        # 曲を切り替えるタスクが再生し始めないよう，つながっていないふりをする
+        return SimpleNamespace(is_connected=lambda: False, channel=self)
+
+
+@pytest.mark.parametrize("error", [None, asyncio.TimeoutError()])
+def test_restores_saved_queue_only_for_listeners(monkeypatch: pytest.MonkeyPatch,
+                                                 error: Optional[BaseException]) -> None:
+    import app
+    import outbox
+    import player
+    import prefetch
+    import queue_store
+
+    track = {"title": "曲", "kind": "drive", "ref": "abc", "cache_key": "drive-restore"}
+    store = FakeStore({"voice_channel_id": None, "text_channel_id": None, "now_playing": None, "queue": [track]})
+    monkeypatch.setattr(queue_store, "store", store)
+    monkeypatch.setattr(app, "restore_tasks", {})
+    monkeypatch.setattr(outbox, "post", lambda channel, text: None)
+    prefetched: List[int] = []
+    monkeypatch.setattr(prefetch, "schedule", lambda p: prefetched.append(p.guild_id))
+    guild = SimpleNamespace(id=3, get_channel=lambda channel_id: None)
+    voice_channel = FakeVoiceChannel(error)
+
+    async def main() -> None:
+        # 誰も聞いていなければ，プレイヤーも作らずダウンロードもpinもしない
+        await app.restore_queue(guild)
+        assert all(p.guild_id != guild.id for p in player.players())
+        assert not app.cache.is_pinned("drive-restore")
+        assert prefetched == []
+        # /playでボイスチャンネルに入るときに戻す（つなげなければ諦めてコマンドを続ける）
+        await app.restore_queue(guild, voice_channel)
+        await app.restore_queue(guild, voice_channel)
+
+    try:
+        asyncio.run(main())
+        assert store.loads == 2
+        if error is None:
+            assert [t.title for t in player.get_player(guild).queue] == ["曲"]
+            assert app.cache.is_pinned("drive-restore")
+            assert prefetched
+        else:
+            assert not app.cache.is_pinned("drive-restore")
+            assert prefetched == []
+    finally:
+        app.remove_player(guild.id)
+    assert not app.cache.is_pinned("drive-restore")
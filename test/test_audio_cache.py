@@ -0,0 +1,68 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+from audio_cache import AudioCache, make_key
+
+
+def put(cache: AudioCache, key: str, size: int) -> None:
+    with open(cache.tmp_path(key), "wb") as f:
+        f.write(b"x" * size)
+    cache.commit(key, cache.tmp_path(key))
+
+
+def test_make_key() -> None:
+    assert make_key("drive", "1AbC_-9") == "drive-1AbC_-9"
+    assert make_key("youtube", "../etc") != "youtube-../etc"
+
+
+def test_evicts_least_recently_used(tmp_path: str) -> None:
+    cache = AudioCache(str(tmp_path), max_bytes=250)
+    put(cache, "a", 100)
+    put(cache, "b", 100)
+    assert cache.get("a")
+    put(cache, "c", 100)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert not os.path.exists(cache.path("b"))
+    assert cache.stats()["bytes"] == 200
+
+
+def test_pinned_entries_are_not_evicted(tmp_path: str) -> None:
+    cache = AudioCache(str(tmp_path), max_bytes=150)
+    put(cache, "a", 100)
+    assert cache.acquire("a")
+    put(cache, "b", 100)
+    assert "a" in cache
+    assert "b" not in cache
+
+    cache.unpin("a")
+    put(cache, "c", 100)
+    assert "a" not in cache
+
+
+def test_survives_restart(tmp_path: str) -> None:
+    cache = AudioCache(str(tmp_path), max_bytes=1000)
+    put(cache, "a", 10)
+    cache.set_meta("a", {"title": "曲"})
+    open(cache.tmp_path("b"), "wb").close()
+
+    reopened = AudioCache(str(tmp_path), max_bytes=1000)
+    assert reopened.get("a") == cache.path("a")
+    assert reopened.get_meta("a") == {"title": "曲"}
+    assert reopened.stats() == {"entries": 1, "bytes": 10, "max_bytes": 1000}
+    assert not os.path.exists(cache.tmp_path("b"))
@@ -0,0 +1,49 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import urllib.parse
+import urllib.request
+
+from benchmarks import stubs
+from benchmarks.run import compare
+
+
+def test_compare_flags_regressions_only() -> None:
+    baseline = {"command_play_p99_ms": 10.0, "tracks_per_second": 20.0, "max_gap_ms": 5.0}
+    results = {"command_play_p99_ms": 30.0, "tracks_per_second": 19.0, "max_gap_ms": 1.0}
+    regressions = compare(results, baseline, 1.5)
+    assert len(regressions) == 1
+    assert regressions[0].startswith("command_play_p99_ms")
+    assert compare({"tracks_per_second": 5.0}, baseline, 1.5)
+
+
+def test_drive_stand_in_lists_and_serves_ranges() -> None:
+    library = stubs.Library(albums=2, tracks=3, size=1000)
+    server = stubs.DriveServer(library).start()
+    try:
+        q = "'folder0001' in parents and mimeType != 'application/vnd.google-apps.folder'"
+        url = server.base_url + "/drive/v3/files?" + urllib.parse.urlencode({"q": q, "orderBy": "name"})
+        with urllib.request.urlopen(url) as response:
+            names = [f["name"] for f in json.load(response)["files"]]
+        assert names == ["song-1-0.mp3", "song-1-1.mp3", "song-1-2.mp3"]
+
+        request = urllib.request.Request(server.base_url + "/drive/v3/files/file00010002?alt=media",
+                                         headers={"Range": "bytes=100-199"})
+        with urllib.request.urlopen(request) as response:
+            assert response.status == 206
+            assert response.headers["Content-Range"] == "bytes 100-199/1000"
+            assert response.read() == library.content("file00010002")[100:200]
+    finally:
+        server.stop()
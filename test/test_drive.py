@@ -0,0 +1,158 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import io
+import os
+import time
+from types import SimpleNamespace
+from typing import Iterator, List, Optional, Tuple
+
+import googleapiclient.http
+import pytest
+
+from audio_cache import cache
+import drive
+import opus
+import outbox
+
+CHUNK = 1000
+CONTENT = bytes(range(256)) * 20  # 5チャンクと少し
+
+
+class FakeDownloader:
+    """MediaIoBaseDownloadの代わりに，CONTENTを少しずつ間をあけて書く"""
+
+    # この数のチャンクを書いたら失敗する（Noneなら最後まで書く）
+    fail_after: Optional[int] = None
+    delay = 0.02
+
+    def __init__(self, fh: io.FileIO, request: object, chunksize: int) -> None:
+        self._fh = fh
+        self._chunks = 0
+
+    def next_chunk(self) -> Tuple[SimpleNamespace, bool]:
+        time.sleep(self.delay)
+        if self.fail_after is not None and self._chunks >= self.fail_after:
+            raise IOError("connection reset")
+        start = self._chunks * CHUNK
+        self._fh.write(CONTENT[start:start + CHUNK])
+        self._chunks += 1
+        return SimpleNamespace(total_size=len(CONTENT)), start + CHUNK >= len(CONTENT)
+
+
+@pytest.fixture
+def encoded(monkeypatch: pytest.MonkeyPatch) -> Iterator[List[str]]:
+    """Driveの代わりにFakeDownloaderでダウンロードする．変換を頼まれたキーを返す"""
+    service = SimpleNamespace(files=lambda: SimpleNamespace(
+        get_media=lambda fileId: SimpleNamespace(http=None)))
+    monkeypatch.setattr(drive, "get_service", lambda: service)
+    monkeypatch.setattr(drive, "new_http", lambda: None)
+    monkeypatch.setattr(googleapiclient.http, "MediaIoBaseDownload", FakeDownloader)
+    monkeypatch.setattr(FakeDownloader, "fail_after", None)
+    keys: List[str] = []
+    monkeypatch.setattr(opus, "schedule_encode", keys.append)
+    yield keys
+    for key in keys:
+        cache.discard(key)
+
+
+def read_all(reader: io.RawIOBase) -> bytes:
+    data = b""
+    while True:
+        chunk = reader.read(300)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def test_reader_waits_for_chunks_while_downloading(encoded: List[str]) -> None:
+    async def run() -> None:
+        download = drive.fetch("growing")
+        assert download is not None
+        assert drive.fetch("growing") is download
+        await download.wait_ready(CHUNK)
+        assert not download.done
+        assert 0 < download.progress() < 1
+        # ダウンロードが追いつくまで待ちながら最後まで読める
+        reader = download.open_reader()
+        data = await asyncio.get_running_loop().run_in_executor(None, read_all, reader)
+        reader.close()
+        assert data == CONTENT
+        await download.task
+        assert download.progress() == 1.0
+        assert "drive-growing" not in drive._downloads
+
+    asyncio.run(run())
+    assert cache.get("drive-growing") is not None
+    assert encoded == ["drive-growing"]
+
+
+def test_reader_ends_early_when_the_download_fails(encoded: List[str],
+                                                   monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(FakeDownloader, "fail_after", 2)
+
+    async def run() -> None:
+        download = drive.fetch("broken")
+        assert download is not None
+        reader = download.open_reader()
+        # 届いた分だけ読んで，待ち続けずに終わる
+        data = await asyncio.get_running_loop().run_in_executor(None, read_all, reader)
+        reader.close()
+        assert data == CONTENT[:2 * CHUNK]
+        await download.task
+        assert isinstance(download.error, IOError)
+        assert not os.path.exists(download.part)
+
+    asyncio.run(run())
+    assert cache.get("drive-broken") is None
+    assert encoded == []
+
+
+def test_reader_opens_the_cached_file_after_rename(encoded: List[str]) -> None:
+    async def run() -> None:
+        download = drive.fetch("renamed")
+        assert download is not None
+        await download.task
+        # 読み手を開く前に.partが本体に名前を変えていた
+        assert not os.path.exists(download.part)
+        reader = download.open_reader()
+        assert read_all(reader) == CONTENT
+        reader.close()
+
+    asyncio.run(run())
+    assert encoded == ["drive-renamed"]
+
+
+@pytest.mark.parametrize("fail_after, last", [(None, "ダウンロード完了！"), (3, "ダウンロードに失敗しちゃった…")])
+def test_progress_edits_one_status_line(encoded: List[str], monkeypatch: pytest.MonkeyPatch,
+                                        fail_after: Optional[int], last: str) -> None:
+    monkeypatch.setattr(FakeDownloader, "fail_after", fail_after)
+    monkeypatch.setattr(drive, "PROGRESS_INTERVAL", 0.0)
+    lines: List[Tuple[str, str, bool]] = []
+    monkeypatch.setattr(outbox, "status", lambda channel, key, text, final=False: lines.append((key, text, final)))
+
+    async def run() -> None:
+        download = drive.fetch("progress-%s" % fail_after)
+        assert download is not None
+        await drive.report_progress(download, SimpleNamespace())
+
+    asyncio.run(run())
+    # 1つの行を書き換えていき，最後の1回だけfinalにする
+    assert len({key for key, _, _ in lines}) == 1
+    assert lines[0][1] == "ダウンロードしてくるからちょっと待ってて！"
+    percents = [int(text[len("ダウンロード中… "):-1]) for _, text, _ in lines[1:-1]]
+    assert percents and percents == sorted(percents)
+    assert lines[-1][1:] == (last, True)
+    assert not any(final for _, _, final in lines[:-1])
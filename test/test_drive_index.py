@@ -0,0 +1,129 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+import pytest
+
+import drive
+import drive_index
+from drive_index import DriveIndex, FOLDER_MIME_TYPE, is_exact
+
+
+def response(body: Dict[str, Any]) -> SimpleNamespace:
+    return SimpleNamespace(execute=lambda http=None: body)
+
+
+class FakeDriveService:
+    def __init__(self, files: List[Dict[str, Any]]) -> None:
+        self.library = files
+        self.changes_pages: List[Dict[str, Any]] = []
+
+    def files(self) -> SimpleNamespace:
+        return SimpleNamespace(list=lambda **kw: response({"files": self.library}))
+
+    def changes(self) -> SimpleNamespace:
+        return SimpleNamespace(
+            getStartPageToken=lambda: response({"startPageToken": "1"}),
+            list=lambda pageToken, **kw: response(self.changes_pages.pop(0)),
+        )
+
+
+def audio(file_id: str, name: str) -> Dict[str, Any]:
+    return {"id": file_id, "name": name, "mimeType": "audio/mpeg", "parents": ["root"]}
+
+
+@pytest.fixture
+def service(monkeypatch: pytest.MonkeyPatch) -> FakeDriveService:
+    fake = FakeDriveService([
+        audio("1", "夜想.mp3"),
+        audio("2", "Hello World.mp3"),
+        audio("3", "hello.mp3"),
+        audio("4", "it's mine.mp3"),
+        {"id": "5", "name": "hello folder", "mimeType": FOLDER_MIME_TYPE},
+    ])
+    monkeypatch.setattr(drive, "get_service", lambda: fake)
+    monkeypatch.setattr(drive, "new_http", lambda: None)
+    return fake
+
+
+def test_full_sync_and_ranked_search(tmp_path: str, service: FakeDriveService) -> None:
+    index = DriveIndex(str(tmp_path) + "/index.sqlite3")
+    assert not index.ready
+    assert index.sync() == 5
+    assert index.ready
+
+    assert [f["id"] for f in index.search("ＨＥＬＬＯ")] == ["3", "2"]
+    assert [f["id"] for f in index.search("it's")] == ["4"]
+    assert [f["id"] for f in index.search("hello", folders=True)] == ["5"]
+    assert index.search("%") == []
+    assert [f["id"] for f in index.children("root")] == ["2", "3", "4", "1"]
+    assert is_exact("hello.mp3", "Hello")
+
+
+def test_children_are_only_playable_files(tmp_path: str, service: FakeDriveService) -> None:
+    service.library = service.library + [
+        {"id": "6", "name": "jacket.jpg", "mimeType": "image/jpeg", "parents": ["root"]},
+        {"id": "7", "name": "booklet.pdf", "mimeType": "application/pdf", "parents": ["root"]},
+        {"id": "8", "name": "live.mp4", "mimeType": "video/mp4", "parents": ["root"]},
+    ]
+    index = DriveIndex(str(tmp_path) + "/index.sqlite3")
+    index.sync()
+    assert [f["id"] for f in index.children("root")] == ["2", "3", "4", "8", "1"]
+    assert "6" not in index.unmeasured()
+
+
+def test_readers_share_the_synced_index(tmp_path: str, service: FakeDriveService,
+                                        monkeypatch: pytest.MonkeyPatch) -> None:
+    path = str(tmp_path) + "/index.sqlite3"
+    writer = DriveIndex(path)
+    reader = DriveIndex(path)
+    monkeypatch.setattr(drive_index, "index", reader)
+    monkeypatch.setattr(drive_index, "SYNC_ENABLED", False)
+    monkeypatch.setattr(drive_index, "SYNC_INTERVAL", 0)
+    # 同期しないプロセスはDriveに問い合わせない
+    monkeypatch.setattr(reader, "sync", lambda: pytest.fail("reader synced with Drive"))
+    assert not reader.ready
+
+    async def run() -> None:
+        waiting = asyncio.ensure_future(drive_index.sync_forever())
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        writer.sync()
+        await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(run())
+    assert reader.ready
+    assert [f["id"] for f in reader.search("hello")] == ["3", "2"]
+
+
+def test_incremental_sync(tmp_path: str, service: FakeDriveService) -> None:
+    index = DriveIndex(str(tmp_path) + "/index.sqlite3")
+    index.sync()
+    service.changes_pages = [
+        {"nextPageToken": "2", "changes": [{"fileId": "1", "removed": True}]},
+        {"newStartPageToken": "3", "changes": [
+            {"fileId": "6", "file": audio("6", "夜想曲.mp3")},
+            {"fileId": "3", "file": dict(audio("3", "hello.mp3"), trashed=True)},
+        ]},
+    ]
+    assert index.sync() == 3
+    assert [f["id"] for f in index.search("夜想")] == ["6"]
+    assert [f["id"] for f in index.search("hello")] == ["2"]
+
+    reopened = DriveIndex(str(tmp_path) + "/index.sqlite3")
+    assert reopened.ready
+    assert reopened.count() == 4
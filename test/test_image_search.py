@@ -0,0 +1,54 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from typing import List
+
+import pytest
+
+import image_search
+from image_search import ImageParser
+
+
+def test_parser_stops_after_limit() -> None:
+    parser = ImageParser(2)
+    parser.feed('<img src="/logo.png"><img src="https://a/1.jpg">')
+    assert not parser.full
+    parser.feed('<img src="https://a/2.jpg"><img src="https://a/3.jpg">')
+    assert parser.full
+    assert parser.urls == ["https://a/1.jpg", "https://a/2.jpg"]
+
+
+def test_search_is_cached_by_normalized_query(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls: List[str] = []
+
+    async def fetch(query: str) -> List[str]:
+        calls.append(query)
+        await asyncio.sleep(0.01)
+        return ["https://a/%d.jpg" % i for i in range(3)]
+
+    monkeypatch.setattr(image_search, "_fetch", fetch)
+    image_search._cache.clear()
+
+    async def run() -> None:
+        first, second = await asyncio.gather(
+            image_search.search("Shiny  Colors", 5),
+            image_search.search("ｓｈｉｎｙ colors", 1),
+        )
+        assert len(first) == 3
+        assert second == ["https://a/0.jpg"]
+        assert await image_search.search("shiny colors", 2) == first[:2]
+
+    asyncio.run(run())
+    assert calls == ["Shiny  Colors"]
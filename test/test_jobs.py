@@ -0,0 +1,84 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+from typing import List
+
+import jobs
+from jobs import JobPool
+
+
+def test_priority_dedupe_and_bump() -> None:
+    pool = JobPool("test", 1)
+    gate = threading.Event()
+    order: List[str] = []
+
+    def work(name: str) -> str:
+        order.append(name)
+        return name
+
+    pool.submit("gate", gate.wait)
+    a = pool.submit("a", work, "a", priority=jobs.PRIORITY_BACKGROUND)
+    b = pool.submit("b", work, "b", priority=jobs.PRIORITY_PREFETCH)
+    c = pool.submit("c", work, "c", priority=jobs.PRIORITY_BACKGROUND)
+    assert pool.submit("a", work, "a", priority=jobs.PRIORITY_BACKGROUND) is a
+    # 次に鳴らす曲になったので繰り上げる
+    assert pool.submit("c", work, "c", priority=jobs.PRIORITY_NOW) is c
+    assert pool.cancel("b")
+
+    gate.set()
+    assert a.result(timeout=5) == "a"
+    assert c.result(timeout=5) == "c"
+    assert b.cancelled()
+    assert order == ["c", "a"]
+    assert pool.pending() == 0
+
+
+def test_waiter_cancellation_does_not_cancel_job() -> None:
+    pool = JobPool("test", 1)
+    gate = threading.Event()
+
+    async def run() -> None:
+        future = pool.submit("slow", lambda: gate.wait() and "done")
+        try:
+            await asyncio.wait_for(jobs.wait(future), 0.01)
+        except asyncio.TimeoutError:
+            pass
+        assert not future.cancelled()
+        again = jobs.wait(pool.submit("slow", lambda: "again"))
+        gate.set()
+        assert await again == "done"
+
+    asyncio.run(run())
+
+
+def test_resubmit_from_done_callback_runs_again() -> None:
+    pool = JobPool("test", 1)
+    runs: List[int] = []
+    second = []
+    resubmitted = threading.Event()
+
+    def resubmit(f: object) -> None:
+        # 終わったと知らされてすぐに同じキーで頼むと，終わった仕事ではなく新しい仕事になる
+        second.append(pool.submit("k", runs.append, 2))
+        resubmitted.set()
+
+    first = pool.submit("k", runs.append, 1)
+    first.add_done_callback(resubmit)
+    # resultは，done callbackが呼ばれる前に返ることがある
+    assert resubmitted.wait(timeout=1)
+    second[0].result(timeout=1)
+    assert second[0] is not first
+    assert runs == [1, 2]
@@ -0,0 +1,53 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+from typing import List, Tuple
+
+import google.auth
+import pytest
+
+from utils import metadata
+from utils.logging import QueueLogger, trace_modifier
+
+
+def test_queue_logger_writes_in_order() -> None:
+    out = io.StringIO()
+    logger = QueueLogger(out)
+    for i in range(100):
+        logger.info("line %d" % i)
+    logger.flush()
+    assert out.getvalue().splitlines() == ["line %d" % i for i in range(100)]
+    assert logger.dropped == 0
+
+
+def test_trace_modifier_outside_request() -> None:
+    event = {"message": "hello"}
+    assert trace_modifier(None, "info", dict(event)) == event
+
+
+def test_project_id_resolved_once(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls: List[int] = []
+
+    def default() -> Tuple[None, str]:
+        calls.append(1)
+        return None, "project"
+    monkeypatch.setattr(google.auth, "default", default)
+    metadata.get_project_id.cache_clear()
+    try:
+        assert metadata.get_project_id() == "project"
+        assert metadata.get_project_id() == "project"
+        assert len(calls) == 1
+    finally:
+        metadata.get_project_id.cache_clear()
@@ -0,0 +1,179 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import Future
+import io
+import subprocess
+from typing import List, Optional
+
+import numpy as np
+import pytest
+
+import audio_cache
+import drive_index
+import loudness
+
+
+def sine(seconds: float, db: float = 0.0, hz: float = 1000.0) -> np.ndarray:
+    t = np.arange(int(seconds * loudness.RATE)) / loudness.RATE
+    wave = (10 ** (db / 20) * np.sin(2 * np.pi * hz * t)).astype(np.float32)
+    return np.stack([wave, wave], axis=1)
+
+
+def test_measures_a_sine_like_bs1770() -> None:
+    # 0dBFSの1kHzのサイン波は1チャンネルで-3.01LKFS，2チャンネルなら0
+    result = loudness.measure(sine(10))
+    assert result["loudness"] == pytest.approx(0.0, abs=0.2)
+    assert result["peak"] == pytest.approx(0.0, abs=0.01)
+
+    assert loudness.measure(sine(10, -20))["loudness"] == pytest.approx(-20.0, abs=0.2)
+    # Kウェイティングで低い音は軽く数える
+    assert loudness.measure(sine(10, hz=30))["loudness"] < -3
+
+
+def test_gates_silence_and_short_clips() -> None:
+    quiet_then_loud = np.concatenate([np.zeros((loudness.RATE * 10, 2), np.float32), sine(10, -20)])
+    assert loudness.measure(quiet_then_loud)["loudness"] == pytest.approx(-20.0, abs=0.2)
+    assert loudness.measure(np.zeros((loudness.RATE * 5, 2), np.float32)) == {"loudness": None, "peak": None}
+    assert loudness.measure(sine(0.2))["loudness"] is None
+
+
+def test_meter_matches_measuring_the_whole_track() -> None:
+    samples = np.concatenate([np.zeros((loudness.RATE * 3, 2), np.float32), sine(7, -12, hz=440)])
+    meter = loudness.Meter()
+    # 小ブロックの境目とずれた大きさで少しずつ渡す
+    for start in range(0, len(samples), 12345):
+        meter.add(samples[start:start + 12345])
+    assert meter.result() == loudness.measure(samples)
+
+
+class FakeStdout(io.BytesIO):
+    def __init__(self, output: bytes) -> None:
+        super().__init__(output)
+        self.reads: List[int] = []
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        self.reads.append(-1 if size is None else size)
+        return super().read(size)
+
+
+class FakeFFmpeg:
+    """ffmpegの代わりにPCMを返すsubprocess.Popen"""
+
+    def __init__(self, output: bytes, returncode: int = 0) -> None:
+        self.stdout = FakeStdout(output)
+        self.returncode = returncode
+        self.args: List[str] = []
+
+    def __call__(self, args: List[str], stdout: int) -> "FakeFFmpeg":
+        self.args = args
+        return self
+
+    def __enter__(self) -> "FakeFFmpeg":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        pass
+
+    def kill(self) -> None:
+        pass
+
+
+def test_analyze_reads_ffmpeg_output_in_blocks(monkeypatch: pytest.MonkeyPatch) -> None:
+    samples = sine(20, -20)
+    ffmpeg = FakeFFmpeg(samples.tobytes())
+    monkeypatch.setattr(loudness.subprocess, "Popen", ffmpeg)
+    assert loudness.analyze("song.mp3") == loudness.measure(samples)
+    # 曲全体を一度に読まない
+    assert max(ffmpeg.stdout.reads) == loudness.READ_BLOCKS * loudness.HOP * 8
+    assert len(ffmpeg.stdout.reads) > 2
+
+    monkeypatch.setattr(loudness.subprocess, "Popen", FakeFFmpeg(b"", returncode=1))
+    with pytest.raises(subprocess.CalledProcessError):
+        loudness.analyze("broken.mp3")
+
+
+def test_gain_moves_towards_the_target_without_clipping() -> None:
+    assert loudness.gain_db({}) == 0.0
+    assert loudness.gain_db({"loudness": -8.0, "peak": 0.0}) == loudness.TARGET_LUFS + 8.0
+    # 静かでもピークが高ければ上げすぎない
+    assert loudness.gain_db({"loudness": -24.0, "peak": -3.0}) == 2.0
+    assert loudness.gain_db({"loudness": -60.0, "peak": -50.0}) == loudness.MAX_GAIN_DB
+
+
+def test_analyzes_cached_tracks_once(tmp_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    cache = audio_cache.AudioCache(str(tmp_path) + "/cache")
+    index = drive_index.DriveIndex(str(tmp_path) + "/index.sqlite3")
+    monkeypatch.setattr(audio_cache, "cache", cache)
+    monkeypatch.setattr(drive_index, "index", index)
+    analyzed: List[str] = []
+
+    def submit(path: str) -> Future:
+        analyzed.append(path)
+        future: Future = Future()
+        future.set_result({"loudness": -9.5, "peak": -0.2})
+        return future
+    monkeypatch.setattr(loudness, "submit", submit)
+
+    for key in ("drive-abc", "youtube-xyz"):
+        with open(cache.tmp_path(key), "wb") as f:
+            f.write(b"audio")
+        cache.commit(key, cache.tmp_path(key))
+    cache.set_meta("youtube-xyz", {"title": "曲"})
+
+    assert loudness.analyze_cached("drive-abc")
+    assert loudness.analyze_cached("youtube-xyz")
+    assert not loudness.analyze_cached("drive-abc")
+    assert len(analyzed) == 2
+    assert cache.get_meta("youtube-xyz") == {"title": "曲", "loudness": -9.5, "peak": -0.2}
+    assert index.get_loudness("abc") == {"loudness": -9.5, "peak": -0.2}
+
+    # キャッシュから追い出されても，Driveの曲は測り直さない
+    cache.discard("drive-abc")
+    with open(cache.tmp_path("drive-abc"), "wb") as f:
+        f.write(b"audio")
+    cache.commit("drive-abc", cache.tmp_path("drive-abc"))
+    assert loudness.analyze_cached("drive-abc")
+    assert len(analyzed) == 2
+    assert cache.get_meta("drive-abc")["loudness"] == -9.5
+
+
+def test_remembers_tracks_that_cannot_be_measured(tmp_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    cache = audio_cache.AudioCache(str(tmp_path) + "/cache")
+    monkeypatch.setattr(audio_cache, "cache", cache)
+    analyzed: List[str] = []
+
+    def submit(path: str) -> Future:
+        analyzed.append(path)
+        future: Future = Future()
+        future.set_exception(RuntimeError("ffmpeg failed"))
+        return future
+    monkeypatch.setattr(loudness, "submit", submit)
+
+    with open(cache.tmp_path("youtube-xyz"), "wb") as f:
+        f.write(b"audio")
+    cache.commit("youtube-xyz", cache.tmp_path("youtube-xyz"))
+    cache.set_meta("youtube-xyz", {"title": "曲"})
+
+    assert not loudness.analyze_cached("youtube-xyz")
+    assert cache.get_meta("youtube-xyz") == {"title": "曲", "loudness": None, "peak": None}
+    assert loudness.gain_db(cache.get_meta("youtube-xyz")) == 0.0
+    # 測れなかった曲は，次に再生されても測り直さない
+    assert not loudness.analyze_cached("youtube-xyz")
+    assert len(analyzed) == 1
+
+
+def test_measures_in_the_process_pool() -> None:
+    result = loudness.pool().submit(loudness.measure, sine(2, -10)).result(timeout=60)
+    assert result["loudness"] == pytest.approx(-10.0, abs=0.2)
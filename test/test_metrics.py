@@ -0,0 +1,48 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from utils.metrics import Registry
+
+
+def test_render_prometheus_text() -> None:
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests", ["cache", "result"])
+    registry.gauge("depth", "Depth", ["guild"], callback=lambda: {("1",): 3})
+    latency = registry.histogram("latency_seconds", "Latency", ["command"], buckets=(0.1, 1.0))
+
+    requests.inc(cache="audio", result="hit")
+    requests.inc(2, cache="audio", result="miss")
+    latency.observe(0.05, command="play")
+    latency.observe(0.5, command="play")
+    latency.observe(3.0, command="play")
+    assert registry.counter("requests_total", "Requests", ["cache", "result"]) is requests
+
+    text = registry.render()
+    assert '# TYPE requests_total counter' in text
+    assert 'requests_total{cache="audio",result="miss"} 2.0' in text
+    assert 'depth{guild="1"} 3.0' in text
+    assert 'latency_seconds_bucket{command="play",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{command="play",le="1.0"} 2' in text
+    assert 'latency_seconds_bucket{command="play",le="+Inf"} 3' in text
+    assert 'latency_seconds_count{command="play"} 3' in text
+    assert 'latency_seconds_sum{command="play"} 3.55' in text
+
+
+def test_time_observes_block() -> None:
+    registry = Registry()
+    latency = registry.histogram("latency_seconds", "Latency", ["command"])
+    with latency.time(command="list"):
+        pass
+    assert latency.count(command="list") == 1
+    assert latency.count(command="play") == 0
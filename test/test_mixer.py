@@ -0,0 +1,162 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from types import SimpleNamespace
+from typing import Callable, List, Optional
+
+import numpy as np
+import pytest
+
+import mixer
+from mixer import CrossfadeSource
+import player
+from player import Track
+import prefetch
+
+
+class PcmSource:
+    """同じ値のサンプルをframes個のフレームだけ返すPCMの音源"""
+
+    def __init__(self, value: int, frames: int) -> None:
+        self.frame = np.full(mixer.FRAME_SAMPLES * mixer.CHANNELS, value, dtype=np.int16).tobytes()
+        self.frames = frames
+        self.closed = False
+
+    def read(self) -> bytes:
+        if self.frames == 0:
+            return b""
+        self.frames -= 1
+        return self.frame
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self) -> None:
+        self.closed = True
+
+
+def level(frame: bytes) -> int:
+    return int(np.frombuffer(frame, dtype=np.int16)[0])
+
+
+def read_all(source: CrossfadeSource) -> List[bytes]:
+    frames = []
+    while True:
+        frame = source.read()
+        if not frame:
+            return frames
+        frames.append(frame)
+
+
+def test_plays_through_without_a_next_track() -> None:
+    ended: List[bool] = []
+    first = PcmSource(1000, 20)
+    source = CrossfadeSource(first, seconds=0.1, on_track_end=lambda: ended.append(True))
+    frames = read_all(source)
+    assert len(frames) == 20
+    assert frames[0] == first.frame
+    assert ended == [True]
+    assert not source.add(PcmSource(1000, 5))
+
+
+def test_gain_is_applied() -> None:
+    source = CrossfadeSource(PcmSource(1000, 3), gain=0.5, seconds=0.1)
+    assert [level(f) for f in read_all(source)] == [500, 500, 500]
+
+
+def test_crossfades_into_the_next_track() -> None:
+    first = PcmSource(10000, 100)
+    second = PcmSource(10000, 50)
+    ended: List[bool] = []
+    source = CrossfadeSource(first, seconds=0.1, on_track_end=lambda: ended.append(True))
+    assert not source.add(second)
+    frames = []
+    while not ended:
+        frames.append(source.read())
+    assert source.add(second)
+    frames += read_all(source)
+
+    # 重ねた分（0.1秒=5フレーム前後）だけ短くなる
+    assert 144 <= len(frames) <= 146
+    levels = [level(f) for f in frames]
+    overlap = [x for x in levels if x != 10000]
+    assert overlap and max(overlap) <= 14143
+    assert levels[-1] == 10000
+    assert first.closed
+
+
+class FakeVoice:
+    def __init__(self) -> None:
+        self.source: Optional[CrossfadeSource] = None
+        self.after: Optional[Callable] = None
+        self.plays = 0
+
+    def is_connected(self) -> bool:
+        return True
+
+    def is_playing(self) -> bool:
+        return self.source is not None
+
+    def is_paused(self) -> bool:
+        return False
+
+    def play(self, source: CrossfadeSource, after: Callable) -> None:
+        self.source = source
+        self.after = after
+        self.plays += 1
+
+    def stop(self) -> None:
+        after, self.source = self.after, None
+        if after:
+            after(None)
+
+    async def disconnect(self) -> None:
+        self.stop()
+
+
+def test_player_hands_the_next_track_to_the_mixer(monkeypatch: pytest.MonkeyPatch) -> None:
+    opened: List[str] = []
+
+    async def open_source(track: Track, channel: object = None) -> PcmSource:
+        opened.append(track.title)
+        return PcmSource(1000, 30)
+
+    monkeypatch.setattr(mixer, "CROSSFADE_SECONDS", 0.1)
+    monkeypatch.setattr(prefetch, "open_source", open_source)
+    monkeypatch.setattr(prefetch, "schedule", lambda p: None)
+
+    async def run() -> None:
+        p = player.get_player(SimpleNamespace(id=21))
+        p.voice = FakeVoice()
+        p.enqueue(Track("a", "drive", "a", "drive-a"))
+        p.enqueue(Track("b", "drive", "b", "drive-b"))
+        for _ in range(20):
+            await asyncio.sleep(0.001)
+        source = p.voice.source
+        for _ in range(30):
+            source.read()
+        for _ in range(20):
+            await asyncio.sleep(0.001)
+
+        assert opened == ["a", "b"]
+        assert p.now_playing.title == "b"
+        # 同じミキサーのまま次の曲に移る
+        assert p.voice.plays == 1
+        levels = [level(f) for f in read_all(source)]
+        assert levels[-1] == 1000
+        await p.disconnect()
+
+    asyncio.run(run())
+    player.remove_player(21)
@@ -0,0 +1,42 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+from typing import List
+
+from opus import OggOpusSource
+
+
+def ogg_page(packets: List[bytes], pagenum: int) -> bytes:
+    segments = b""
+    for packet in packets:
+        segments += b"\xff" * (len(packet) // 255) + bytes([len(packet) % 255])
+    header = struct.pack("<BBQIIIB", 0, 0, 0, 1, pagenum, 0, len(segments))
+    return b"OggS" + header + segments + b"".join(packets)
+
+
+def test_passes_opus_packets_through(tmp_path: str) -> None:
+    frames = [bytes([i]) * (100 + i) for i in range(5)] + [b"x" * 300]
+    path = str(tmp_path) + "/track.opus"
+    with open(path, "wb") as f:
+        f.write(ogg_page([b"OpusHead" + b"\x01" * 11], 0))
+        f.write(ogg_page([b"OpusTags" + b"\x00" * 8], 1))
+        f.write(ogg_page(frames[:3], 2))
+        f.write(ogg_page(frames[3:], 3))
+
+    source = OggOpusSource(path)
+    assert source.is_opus()
+    assert [source.read() for _ in frames] == frames
+    assert source.read() == b""
+    source.cleanup()
@@ -0,0 +1,113 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import itertools
+from typing import List
+
+import outbox
+
+_ids = itertools.count(1000)
+
+
+class SentMessage:
+    def __init__(self, content: str) -> None:
+        self.content = content
+        self.edits: List[str] = []
+
+    async def edit(self, content: str = "") -> None:
+        await asyncio.sleep(0.01)
+        self.content = content
+        self.edits.append(content)
+
+
+class Channel:
+    """送るのに少し時間がかかる（レート制限で待たされている）チャンネル"""
+
+    def __init__(self, delay: float = 0.01) -> None:
+        self.id = next(_ids)
+        self.delay = delay
+        self.sent: List[SentMessage] = []
+
+    async def send(self, content: str) -> SentMessage:
+        message = SentMessage(content)
+        await asyncio.sleep(self.delay)
+        self.sent.append(message)
+        return message
+
+
+def test_merges_messages_queued_while_sending() -> None:
+    async def run() -> None:
+        channel = Channel(delay=0.05)
+        outbox.post(channel, "1曲目を再生するよー♪")
+        outbox.post(channel, "2曲目を再生リストに入れておくね！")
+        await asyncio.sleep(0.07)
+        for i in range(5):
+            outbox.post(channel, "曲%d" % i)
+        await outbox.drain()
+        assert [m.content for m in channel.sent] == [
+            "1曲目を再生するよー♪\n2曲目を再生リストに入れておくね！",
+            "曲0\n曲1\n曲2\n曲3\n曲4",
+        ]
+
+    asyncio.run(run())
+
+
+def test_keeps_messages_under_the_limit() -> None:
+    async def run() -> None:
+        channel = Channel()
+        outbox.post(channel, "\n".join("%04d" % i + "x" * 95 for i in range(50)))
+        outbox.post(channel, "end")
+        await outbox.drain()
+        assert all(len(m.content) <= outbox.MESSAGE_LIMIT for m in channel.sent)
+        assert len(channel.sent) == 3
+        assert "\n".join(m.content for m in channel.sent).count("x" * 95) == 50
+
+    asyncio.run(run())
+
+
+def test_status_is_edited_in_place() -> None:
+    async def run() -> None:
+        channel = Channel()
+        outbox.post(channel, "**曲**を再生するよー♪")
+        outbox.status(channel, "dl", "ダウンロードしてくるからちょっと待ってて！")
+        await outbox.drain()
+        for percent in (10, 40, 70):
+            outbox.status(channel, "dl", "ダウンロード中… %d%%" % percent)
+        outbox.status(channel, "dl", "ダウンロード完了！", final=True)
+        await outbox.drain()
+
+        assert len(channel.sent) == 1
+        message = channel.sent[0]
+        assert message.content == "**曲**を再生するよー♪\nダウンロード完了！"
+        # たまった書き換えは最新の内容で1回にまとめる
+        assert len(message.edits) == 1
+
+        # finalのあとは新しい行として出す
+        outbox.status(channel, "dl", "ダウンロードしてくるからちょっと待ってて！")
+        await outbox.drain()
+        assert len(channel.sent) == 2
+        assert len(message.edits) == 1
+
+    asyncio.run(run())
+
+
+def test_paginate() -> None:
+    lines = ["**%d.** %s" % (i, "曲" * 50) for i in range(1, 101)]
+    pages = outbox.paginate(lines, "header\n", "\nfooter")
+    assert len(pages) > 1
+    assert all(len(page) + 64 <= outbox.MESSAGE_LIMIT for page in pages)
+    assert all(page.startswith("header\n") and page.endswith("\nfooter") for page in pages)
+    assert sum(page.count("**") for page in pages) == 200
+    assert outbox.paginate([], "empty") == ["empty"]
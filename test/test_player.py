@@ -0,0 +1,257 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+from types import SimpleNamespace
+from typing import Callable, List, Optional
+
+import pytest
+
+from audio_cache import cache
+import jobs
+import player
+from player import Track
+import prefetch
+
+
+class FakeSource:
+    def __init__(self, title: str) -> None:
+        self.title = title
+
+    def cleanup(self) -> None:
+        pass
+
+
+class FakeVoice:
+    def __init__(self) -> None:
+        self.source = None
+        self.after: Optional[Callable] = None
+
+    def is_connected(self) -> bool:
+        return True
+
+    def is_playing(self) -> bool:
+        return self.source is not None
+
+    def is_paused(self) -> bool:
+        return False
+
+    def play(self, source: FakeSource, after: Callable) -> None:
+        self.source = source
+        self.after = after
+
+    def stop(self) -> None:
+        after, self.source = self.after, None
+        if after:
+            # discord.pyと同じく別スレッドから呼ぶ
+            threading.Thread(target=after, args=(None,)).start()
+
+    async def disconnect(self) -> None:
+        self.stop()
+
+    @property
+    def playing(self) -> Optional[str]:
+        return self.source.title if self.source else None
+
+
+opened: List[str] = []
+
+
+@pytest.fixture(autouse=True)
+def fake_sources(monkeypatch: pytest.MonkeyPatch) -> None:
+    opened.clear()
+
+    async def open_source(track: Track, channel: object = None) -> FakeSource:
+        if track.title == "broken":
+            raise ValueError("broken track")
+        opened.append(track.title)
+        return FakeSource(track.title)
+
+    monkeypatch.setattr(prefetch, "open_source", open_source)
+    monkeypatch.setattr(prefetch, "schedule", lambda p: None)
+
+
+def make_player(guild_id: int) -> player.GuildPlayer:
+    p = player.get_player(SimpleNamespace(id=guild_id))
+    p.voice = FakeVoice()
+    return p
+
+
+def track(title: str) -> Track:
+    return Track(title, "drive", title, "drive-" + title)
+
+
+async def settle() -> None:
+    for _ in range(20):
+        await asyncio.sleep(0.001)
+
+
+def test_players_are_per_guild() -> None:
+    async def run() -> None:
+        a = make_player(1)
+        b = make_player(2)
+        assert a is not b
+        assert player.get_player(SimpleNamespace(id=1)) is a
+
+        assert a.enqueue(track("a1"))
+        assert not a.enqueue(track("a2"))
+        assert b.enqueue(track("b1"))
+        await settle()
+
+        assert [t.title for t in a.tracks()] == ["a1", "a2"]
+        assert [t.title for t in b.tracks()] == ["b1"]
+
+        a.skip()
+        await settle()
+        assert a.voice.playing == "a2"
+        assert b.voice.playing == "b1"
+        assert a.last_gap is not None
+
+        await a.disconnect()
+        await b.disconnect()
+
+    asyncio.run(run())
+    player.remove_player(1)
+    player.remove_player(2)
+
+
+def test_queued_tracks_do_not_open_sources() -> None:
+    async def run() -> None:
+        p = make_player(3)
+        for i in range(50):
+            p.enqueue(track(str(i)))
+        await settle()
+        assert opened == ["0"]
+        assert len(p.tracks()) == 50
+
+        p.skip()
+        await settle()
+        assert opened == ["0", "1"]
+        await p.disconnect()
+
+    asyncio.run(run())
+    player.remove_player(3)
+
+
+def test_reorder_remove_and_failures() -> None:
+    async def run() -> None:
+        p = make_player(4)
+        for title in ["1", "broken", "2", "3", "4"]:
+            p.enqueue(track(title))
+        await settle()
+        assert p.voice.playing == "1"
+
+        p.move(3, 1)
+        assert [t.title for t in p.queue] == ["broken", "4", "2", "3"]
+        assert p.remove(2).title == "2"
+
+        # 失敗する曲があっても次の曲に進む
+        p.skip()
+        await settle()
+        assert p.voice.playing == "4"
+
+        assert p.clear() == 1
+        p.skip()
+        await settle()
+        assert p.now_playing is None
+        assert p.voice.playing is None
+        await p.disconnect()
+
+    asyncio.run(run())
+    player.remove_player(4)
+
+
+def test_forced_disconnect_releases_pins() -> None:
+    async def run() -> None:
+        p = make_player(5)
+        for title in ["p1", "p2", "p3"]:
+            cache.pin("drive-" + title)
+            p.enqueue(track(title))
+        await settle()
+        assert p.voice.playing == "p1"
+
+        # Discordにボイスから切られた（on_voice_state_update）
+        player.remove_player(5)
+        await settle()
+        assert p._task.done()
+        assert not any(cache._pins.get("drive-" + title) for title in ["p1", "p2", "p3"])
+        assert 5 not in player._players
+
+    asyncio.run(run())
+
+
+def test_dropped_tracks_cancel_pending_jobs(monkeypatch: pytest.MonkeyPatch) -> None:
+    pool = jobs.JobPool("test-fetch", 1)
+    monkeypatch.setattr(jobs, "fetch", pool)
+    gate = threading.Event()
+    pool.submit("gate", gate.wait)
+
+    async def run() -> None:
+        p = make_player(6)
+        futures = {}
+        for title in ["q1", "q2", "q3", "q4"]:
+            cache.pin("drive-" + title)
+            p.enqueue(track(title))
+            futures[title] = pool.submit("drive-" + title, lambda: None)
+        # q3は別のギルドのキューでも待っている
+        cache.pin("drive-q3")
+        await settle()
+
+        p.remove(0)
+        assert futures["q2"].cancelled()
+        p.clear()
+        assert futures["q4"].cancelled()
+        assert not futures["q3"].cancelled()
+        assert not futures["q1"].cancelled()
+        await p.disconnect()
+
+    asyncio.run(run())
+    gate.set()
+    cache.unpin("drive-q3")
+    player.remove_player(6)
+
+
+def test_dropped_tracks_keep_converting_cached_files(monkeypatch: pytest.MonkeyPatch) -> None:
+    pool = jobs.JobPool("test-transcode", 1)
+    monkeypatch.setattr(jobs, "transcode", pool)
+    gate = threading.Event()
+    pool.submit("gate", gate.wait)
+    with open(cache.tmp_path("drive-cached"), "wb") as f:
+        f.write(b"audio")
+    cache.commit("drive-cached", cache.tmp_path("drive-cached"))
+
+    async def run() -> None:
+        p = make_player(7)
+        futures = {}
+        # 先頭の曲は再生が始まってキューから出る
+        for title in ["first", "cached", "evicted"]:
+            cache.pin("drive-" + title)
+            p.enqueue(track(title))
+            futures[title] = pool.submit("drive-" + title, lambda: None)
+        await settle()
+
+        p.clear()
+        # 変換しておけば次からはOpusのまま送れるので，キャッシュにある曲の変換は取り消さない
+        assert not futures["cached"].cancelled()
+        assert futures["evicted"].cancelled()
+        assert not futures["first"].cancelled()
+        await p.disconnect()
+
+    try:
+        asyncio.run(run())
+    finally:
+        gate.set()
+        cache.discard("drive-cached")
+        player.remove_player(7)
@@ -0,0 +1,71 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+from typing import List
+
+import pytest
+
+import profiles
+
+
+def names(query: str) -> List[str]:
+    return [p.name for p in profiles.lookup(query)]
+
+
+@pytest.mark.parametrize("query", ["真乃", "櫻木真乃", "櫻木 真乃", "まの", "マノ", "ｻｸﾗｷﾞﾏﾉ",
+                                   "mano", "Sakuragi Mano", "MANO SAKURAGI", "sakuragi_mano"])
+def test_finds_by_kanji_kana_and_romaji(query: str) -> None:
+    assert names(query) == ["櫻木 真乃"]
+
+
+def test_romaji_long_vowels() -> None:
+    assert names("Yuukoku") == ["幽谷 霧子"]
+    assert names("tooru") == names("tohru") == names("toru") == ["浅倉 透"]
+    assert names("Ohsaki") == ["大崎 甘奈", "大崎 甜花"]
+
+
+def test_prefix_unit_and_ngram_matches() -> None:
+    assert names("hina") == ["市川 雛菜"]
+    assert names("ちよ") == ["園田 智代子"]
+    assert len(names("noctchill")) == 4
+    assert len(names("L'Antica")) == 5
+    # 1文字抜けていても近いものを出す
+    assert names("madka")[0] == "樋口 円香"
+    assert names("zzz") == []
+    assert names("  ") == []
+
+
+def test_reloads_when_the_file_changes(tmp_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    path = os.path.join(str(tmp_path), "profiles.json")
+    with open(path, "w") as f:
+        json.dump([{"name": "七草 はづき", "kana": "ななくさ はづき", "romaji": "Nanakusa Hazuki"}], f)
+    loader = profiles._Loader(path)
+    monkeypatch.setattr(profiles, "_loader", loader)
+    monkeypatch.setattr(profiles, "RELOAD_INTERVAL", 0.0)
+    assert names("hazuki") == ["七草 はづき"]
+
+    with open(path, "w") as f:
+        json.dump([{"name": "七草 にちか", "kana": "ななくさ にちか", "romaji": "Nanakusa Nichika",
+                    "unit": "SHHis", "details": {"メモ": "テスト"}}], f)
+    os.utime(path, (1, 1))
+    assert names("hazuki") == []
+    assert "メモ : テスト" in profiles.format_profile(profiles.lookup("nichika")[0])
+
+    # 壊れたファイルに書き換えられても前のデータで答え続ける
+    with open(path, "w") as f:
+        f.write("[{")
+    os.utime(path, (2, 2))
+    assert names("nichika") == ["七草 にちか"]
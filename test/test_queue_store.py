@@ -0,0 +1,168 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from player import GuildPlayer, Track
+from queue_store import QueueStore
+
+
+class FakeCursor:
+    def __init__(self, db: "FakeDatabase") -> None:
+        self.db = db
+        self.result: List[Tuple] = []
+
+    def __enter__(self) -> "FakeCursor":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        pass
+
+    def execute(self, sql: str, args: Sequence[int] = ()) -> None:
+        self.db.statements.append(sql.split()[0])
+        if sql.startswith("DELETE"):
+            for guild_id in args:
+                self.db.rows.pop(guild_id, None)
+        elif sql.startswith("SELECT guild_id"):
+            self.result = [(guild_id,) for guild_id in self.db.rows]
+        elif sql.startswith("SELECT"):
+            row = self.db.rows.get(args[0])
+            self.result = [row] if row else []
+
+    def executemany(self, sql: str, rows: List[Tuple]) -> None:
+        self.db.statements.append("INSERT")
+        for guild_id, voice_channel_id, text_channel_id, state in rows:
+            self.db.rows[guild_id] = (voice_channel_id, text_channel_id, state)
+
+    def fetchall(self) -> List[Tuple]:
+        return self.result
+
+
+class FakeDatabase:
+    def __init__(self) -> None:
+        self.rows: Dict[int, Tuple] = {}
+        self.statements: List[str] = []
+        self.connections = 0
+        self.commits = 0
+        self.fail = False
+
+    def connect(self) -> "FakeDatabase":
+        self.connections += 1
+        return self
+
+    def cursor(self) -> FakeCursor:
+        if self.fail:
+            raise OSError("gone away")
+        return FakeCursor(self)
+
+    def commit(self) -> None:
+        self.commits += 1
+
+    def close(self) -> None:
+        pass
+
+
+def make_player(guild_id: int, titles: List[str], playing: Optional[str] = None) -> GuildPlayer:
+    p = GuildPlayer(guild_id)
+    p.queue.extend(Track(t, "drive", t, "drive:" + t) for t in titles)
+    if playing is not None:
+        p.now_playing = Track(playing, "youtube", "https://youtu.be/x", "youtube:x", {"id": "x"}, offset=30.0)
+    return p
+
+
+def test_writes_are_batched_behind_the_hot_path() -> None:
+    async def run() -> None:
+        db = FakeDatabase()
+        store = QueueStore(db.connect, flush_interval=0.01)
+        first = make_player(1, ["a", "b"], playing="now")
+        second = make_player(2, ["c"])
+        for _ in range(10):
+            store.mark_dirty(first)
+            store.mark_dirty(second)
+        # 印をつけただけではまだ書かない
+        assert db.rows == {}
+        await asyncio.sleep(0.1)
+
+        assert set(db.rows) == {1, 2}
+        assert db.commits == 1
+        assert db.connections == 1
+        assert db.statements.count("INSERT") == 1
+        state = json.loads(db.rows[1][2])
+        assert [t["title"] for t in state["queue"]] == ["a", "b"]
+        assert state["now_playing"]["offset"] == 30.0
+
+    asyncio.run(run())
+
+
+def test_round_trip_and_forget() -> None:
+    async def run() -> None:
+        db = FakeDatabase()
+        store = QueueStore(db.connect, flush_interval=0.01)
+        p = make_player(1, ["a"], playing="now")
+        store.mark_dirty(p)
+        await store.flush()
+
+        state = await store.load(1)
+        assert state is not None
+        restored = Track.from_dict(state["now_playing"])
+        assert restored.info == {"id": "x"}
+        assert restored.offset == 30.0
+        assert [Track.from_dict(t).cache_key for t in state["queue"]] == ["drive:a"]
+        assert await store.saved_guilds() == [1]
+
+        store.forget(1)
+        await store.flush()
+        assert await store.load(1) is None
+
+    asyncio.run(run())
+
+
+def test_restores_rows_saved_with_old_fields() -> None:
+    # 前の版はgainも保存していた
+    row = {"title": "a", "kind": "drive", "ref": "a", "cache_key": "drive:a", "info": None, "offset": 0.0, "gain": 1.0}
+    assert Track.from_dict(row) == Track("a", "drive", "a", "drive:a")
+
+
+def test_failed_write_is_retried_and_close_keeps_rows() -> None:
+    async def run() -> None:
+        db = FakeDatabase()
+        store = QueueStore(db.connect, flush_interval=0.01)
+        p = make_player(1, ["a"])
+        store.mark_dirty(p)
+        db.fail = True
+        try:
+            await store.flush()
+        except OSError:
+            pass
+        db.fail = False
+        await store.close([p])
+        assert 1 in db.rows
+        # 止めたあとの切断でプレイヤーが消えても保存は消さない
+        store.forget(1)
+        await store.flush()
+        assert 1 in db.rows
+
+    asyncio.run(run())
+
+
+def test_disabled_without_connection() -> None:
+    async def run() -> None:
+        store = QueueStore()
+        store.mark_dirty(make_player(1, ["a"]))
+        assert await store.load(1) is None
+        assert await store.saved_guilds() == []
+
+    asyncio.run(run())
@@ -0,0 +1,118 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from typing import Dict, List, Optional
+
+import pytest
+
+import drive_index
+import resolver
+from resolver import Candidate, Result
+
+
+def backend(name: str, delay: float, result: Optional[Result], calls: List[str]) -> resolver.Search:
+    async def search(word: str) -> Optional[Result]:
+        calls.append(name)
+        await asyncio.sleep(delay)
+        return result
+    return search
+
+
+def found(ref: str) -> Result:
+    return Result(play=Candidate("drive", ref, ref))
+
+
+def test_fast_drive_answer_skips_youtube() -> None:
+    calls: List[str] = []
+    backends = [("drive", backend("drive", 0.0, found("a"), calls), 0.0),
+                ("youtube", backend("youtube", 0.0, found("b"), calls), 0.2)]
+    result = asyncio.run(resolver.resolve("a", backends, deadline=1.0))
+    assert result.play.ref == "a" and result.backend == "drive"
+    assert calls == ["drive"]
+
+
+def test_youtube_starts_when_drive_has_nothing() -> None:
+    calls: List[str] = []
+    backends = [("drive", backend("drive", 0.0, None, calls), 0.0),
+                ("youtube", backend("youtube", 0.0, found("b"), calls), 10.0)]
+    result = asyncio.run(resolver.resolve("b", backends, deadline=1.0))
+    assert result.play.ref == "b" and result.backend == "youtube"
+    assert calls == ["drive", "youtube"]
+
+
+def test_slow_drive_is_hedged_but_still_preferred() -> None:
+    calls: List[str] = []
+    backends = [("drive", backend("drive", 0.1, found("a"), calls), 0.0),
+                ("youtube", backend("youtube", 0.0, found("b"), calls), 0.02)]
+    result = asyncio.run(resolver.resolve("a", backends, deadline=1.0))
+    assert calls == ["drive", "youtube"]
+    assert result.play.ref == "a"
+
+
+def test_deadline_cancels_slow_backend() -> None:
+    calls: List[str] = []
+    cancelled: List[str] = []
+
+    async def hang(word: str) -> Optional[Result]:
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(word)
+            raise
+        return None
+
+    backends = [("drive", hang, 0.0), ("youtube", backend("youtube", 0.0, found("b"), calls), 0.01)]
+
+    async def run() -> Result:
+        result = await resolver.resolve("x", backends, deadline=0.1)
+        await asyncio.sleep(0)
+        return result
+
+    result = asyncio.run(asyncio.wait_for(run(), 1.0))
+    assert result.play.ref == "b"
+    assert result.timed_out == ["drive"]
+    assert cancelled == ["x"]
+
+
+def test_nothing_in_time() -> None:
+    async def fail(word: str) -> Optional[Result]:
+        raise RuntimeError("quota")
+
+    async def hang(word: str) -> Optional[Result]:
+        await asyncio.sleep(10)
+        return None
+
+    result = asyncio.run(resolver.resolve("x", [("drive", fail, 0.0), ("youtube", hang, 0.0)], deadline=0.05))
+    assert result.play is None and not result.candidates
+    assert result.timed_out == ["youtube"]
+    result = asyncio.run(resolver.resolve("x", [("drive", fail, 0.0)], deadline=0.05))
+    assert result.timed_out == []
+
+
+def test_search_drive_ranking(monkeypatch: pytest.MonkeyPatch) -> None:
+    library: Dict[bool, List[Dict[str, str]]] = {
+        False: [{"id": "1", "name": "夜明けの晩に.mp3"}, {"id": "2", "name": "夜明けの晩に (inst).mp3"}],
+        True: [{"id": "f", "name": "アルバム"}],
+    }
+
+    async def search(word: str, limit: int = 10, folders: bool = False) -> List[Dict[str, str]]:
+        return [item for item in library[folders] if drive_index.normalize(word) in drive_index.normalize(item["name"])]
+
+    monkeypatch.setattr(drive_index, "search", search)
+    assert asyncio.run(resolver.search_drive("夜明けの晩に")).play.ref == "1"
+    assert [c.ref for c in asyncio.run(resolver.search_drive("夜明け")).candidates] == ["1", "2"]
+    assert asyncio.run(resolver.search_drive("inst")).play.ref == "2"
+    assert asyncio.run(resolver.search_drive("アルバム")).play.source == "folder"
+    assert asyncio.run(resolver.search_drive("なし")) is None
@@ -0,0 +1,59 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import sharding
+
+
+def test_intents_are_minimal() -> None:
+    intents = sharding.intents()
+    assert intents.guilds and intents.voice_states and intents.guild_messages
+    assert not intents.members
+    assert not intents.presences
+    assert not intents.typing
+    assert not intents.dm_messages
+
+
+def test_parse_shard_ids() -> None:
+    assert sharding.parse_shard_ids("0-3") == [0, 1, 2, 3]
+    assert sharding.parse_shard_ids("0, 2,4-5") == [0, 2, 4, 5]
+
+
+def test_plan_splits_evenly() -> None:
+    assert sharding.plan(8, 3) == [[0, 1, 2], [3, 4, 5], [6, 7]]
+    assert sharding.plan(2, 4) == [[0], [1]]
+
+
+def test_worker_env_separates_state() -> None:
+    base = {"PORT": "8080", "AUDIO_CACHE_MAX_BYTES": "1000", "TRANSCODE_WORKERS": "2"}
+    env = sharding.worker_env(1, 8, [4, 5, 6, 7], 2, base)
+    assert env["SHARD_COUNT"] == "8"
+    assert env["SHARD_IDS"] == "4-7"
+    assert env["PORT"] == "8081"
+    assert env["AUDIO_CACHE_DIR"].endswith("worker-1")
+    assert env["AUDIO_CACHE_MAX_BYTES"] == "500"
+    # Driveのインデックスは共有して，0番目のプロセスだけが同期する
+    assert "DRIVE_INDEX_PATH" not in env
+    assert env["DRIVE_INDEX_SYNC"] == "0"
+    assert "DRIVE_INDEX_SYNC" not in sharding.worker_env(0, 8, [0, 1, 2, 3], 2, base)
+    assert env["TRANSCODE_WORKERS"] == "2"
+
+
+def test_make_client_sharded(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(sharding, "SHARD_COUNT", "4")
+    monkeypatch.setattr(sharding, "SHARD_IDS", "2-3")
+    client = sharding.make_client()
+    assert client.shard_count == 4
+    assert client.shard_ids == [2, 3]
@@ -14,12 +14,10 @@
 
 import os
 
-import flask
-from flask.testing import FlaskClient
 import requests
 
 
-def test_system(app: flask.app.Flask, client: FlaskClient) -> None:
+def test_system() -> None:
 
     BASE_URL = os.environ.get("BASE_URL")
     assert BASE_URL, "Cloud Run service URL not found"
@@ -29,4 +27,8 @@ def test_system(app: flask.app.Flask, client: FlaskClient) -> None:
 
     resp = requests.get(BASE_URL, headers={"Authorization": f"Bearer {ID_TOKEN}"})
     assert resp.status_code == 200
-    assert resp.text == "Hello, World!"
+    assert resp.text == "ok"
+
+    resp = requests.get(BASE_URL + "/status", headers={"Authorization": f"Bearer {ID_TOKEN}"})
+    assert resp.status_code == 200
+    assert "guilds" in resp.json()
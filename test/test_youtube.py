@@ -0,0 +1,94 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+from typing import Any, Dict, List
+
+import pytest
+
+import youtube
+
+
+def test_video_id() -> None:
+    assert youtube.video_id("https://www.youtube.com/watch?v=abc123&t=1") == "abc123"
+    assert youtube.video_id("https://youtu.be/abc123?si=x") == "abc123"
+    assert youtube.video_id("https://www.youtube.com/shorts/abc123") == "abc123"
+    assert youtube.video_id("https://www.youtube.com/") is None
+
+
+def test_is_playlist_url() -> None:
+    assert youtube.is_playlist_url("https://www.youtube.com/playlist?list=PL123")
+    assert not youtube.is_playlist_url("https://www.youtube.com/watch?v=abc&list=PL123")
+    assert not youtube.is_playlist_url("https://www.youtube.com/watch?v=abc")
+
+
+def test_slim_and_expiry() -> None:
+    expire = int(time.time()) + 3600
+    info = {
+        "id": "abc123",
+        "title": "曲",
+        "url": "https://rr1.googlevideo.com/videoplayback?expire=%d" % expire,
+        "formats": [{}] * 100,
+        "thumbnails": [{}] * 10,
+    }
+    slim = youtube.slim(info)
+    assert set(slim) == {"id", "title", "url"}
+    assert not youtube.is_expired(slim)
+
+    slim["url"] = "https://rr1.googlevideo.com/videoplayback?expire=%d" % (time.time() + 10)
+    assert youtube.is_expired(slim)
+
+
+def test_resolve_is_cached(monkeypatch: pytest.MonkeyPatch) -> None:
+    calls: List[str] = []
+    expire = int(time.time()) + 3600
+
+    def extract(url: str) -> Dict[str, Any]:
+        calls.append(url)
+        return {
+            "id": "abc123",
+            "title": "曲",
+            "url": "https://rr1.googlevideo.com/videoplayback?expire=%d" % expire,
+        }
+
+    monkeypatch.setattr(youtube, "_extract", extract)
+    youtube._resolved.clear()
+
+    async def run() -> None:
+        first, second = await asyncio.gather(
+            youtube.resolve("https://www.youtube.com/watch?v=abc123"),
+            youtube.resolve("https://youtu.be/abc123"),
+        )
+        assert first["title"] == second["title"] == "曲"
+        assert youtube.cached_info("https://youtu.be/abc123") is not None
+        await youtube.resolve("https://www.youtube.com/watch?v=abc123&t=10")
+
+    asyncio.run(run())
+    assert len(calls) == 1
+
+
+def test_search_returns_watch_urls(monkeypatch: pytest.MonkeyPatch) -> None:
+    def extract(word: str, limit: int) -> Dict[str, Any]:
+        assert limit == 2
+        return {"_type": "playlist", "entries": [
+            {"id": "v1", "title": word + " MV"}, {"id": None}, {"id": "v2", "title": None}, {"id": "v3"},
+        ]}
+
+    monkeypatch.setattr(youtube, "_extract_search", extract)
+    entries = asyncio.run(youtube.search("曲", 2))
+    assert entries == [
+        {"id": "v1", "title": "曲 MV", "url": youtube.watch_url("v1")},
+        {"id": "v2", "title": "v2", "url": youtube.watch_url("v2")},
+    ]
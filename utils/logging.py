@@ -12,13 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Dict
+import atexit
+import os
+import queue
+import sys
+import threading
+from typing import Dict, List, Optional, TextIO
 
-from flask import request
 import structlog
 
 from utils import metadata
 
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+LOG_BATCH_SIZE = 256
+
 
 def field_name_modifier(
     logger: structlog._loggers.PrintLogger, log_method: str, event_dict: Dict
@@ -45,10 +52,12 @@ def trace_modifier(
     """Adds Tracing correlation
     https://cloud.google.com/run/docs/logging#correlate-logs
     """
-    # Only attempt to get the context if in a request
-    if request:
+    # Only attempt to get the context if in a request (the bot never is).
+    # Flask is not imported here: if nothing else loaded it, there is no request.
+    flask = sys.modules.get("flask")
+    if flask is not None and flask.has_request_context():
 
-        trace_header = request.headers.get("X-Cloud-Trace-Context")
+        trace_header = flask.request.headers.get("X-Cloud-Trace-Context")
         # Only append the trace if it exists in the request
         if trace_header:
             trace = trace_header.split("/")
@@ -59,6 +68,61 @@ def trace_modifier(
     return event_dict
 
 
+class QueueLogger:
+    """A structlog logger that hands rendered lines to a background writer thread,
+    so a log call never blocks on stdout. Lines are dropped, and counted,
+    if the writer falls LOG_QUEUE_SIZE lines behind."""
+
+    def __init__(self, file: Optional[TextIO] = None, maxsize: int = LOG_QUEUE_SIZE) -> None:
+        self._file = file
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue(maxsize)
+        self._flushed = threading.Condition()
+        self._written = 0
+        self._queued = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._write_forever, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def msg(self, message: str) -> None:
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self._queued += 1
+
+    log = debug = info = warn = warning = msg
+    err = error = critical = exception = fatal = failure = msg
+
+    def flush(self, timeout: float = 5.0) -> None:
+        """Wait until everything queued so far has been written"""
+        target = self._queued
+        with self._flushed:
+            self._flushed.wait_for(lambda: self._written >= target, timeout)
+
+    def _write_forever(self) -> None:
+        while True:
+            batch: List[str] = [self._queue.get()]
+            # Write whatever else is already waiting in one call
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            file = self._file or sys.stdout
+            try:
+                file.write("\n".join(batch) + "\n")
+                file.flush()
+            except (OSError, ValueError):
+                pass
+            with self._flushed:
+                self._written += len(batch)
+                self._flushed.notify_all()
+
+
+_queue_logger = QueueLogger()
+
+
 def getJSONLogger() -> structlog._config.BoundLoggerLazyProxy:
     """Create a JSON logger using the field name and trace modifiers created above"""
     # extend using https://www.structlog.org/en/stable/processors.html
@@ -72,6 +136,8 @@ def getJSONLogger() -> structlog._config.BoundLoggerLazyProxy:
             structlog.processors.JSONRenderer(),
         ],
         wrapper_class=structlog.stdlib.BoundLogger,
+        logger_factory=lambda *args: _queue_logger,
+        cache_logger_on_first_use=True,
     )
     return structlog.get_logger()
 
@@ -79,11 +145,8 @@ def getJSONLogger() -> structlog._config.BoundLoggerLazyProxy:
 logger = getJSONLogger()
 
 
+@atexit.register
 def flush() -> None:
-    # Setting PYTHONUNBUFFERED in Dockerfile/Buildpack ensured no buffering
-
-    # https://docs.python.org/3/library/logging.html#logging.shutdown
-    # When the logging module is imported, it registers this
-    # function as an exit handler (see atexit), so normally
-    # there’s no need to do that manually.
-    pass
+    # Lines are written from a background thread, so wait for the queue
+    # to drain before the process exits
+    _queue_logger.flush()
@@ -12,22 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import google.auth
-import requests
+from functools import lru_cache
+
+# google.auth and requests are imported where they are used, so that
+# importing this module (via utils.logging) stays cheap at startup
 
 METADATA_URI = "http://metadata.google.internal/computeMetadata/v1/"
 
 
+@lru_cache(maxsize=None)
 def get_project_id() -> str:
     """Use the 'google-auth-library' to make a request to the metadata server or
-    default to Application Default Credentials in your local environment."""
+    default to Application Default Credentials in your local environment.
+    Resolved once per process, since it cannot change while running."""
+    import google.auth
+
     _, project = google.auth.default()
     return project
 
 
+@lru_cache(maxsize=None)
 def get_service_region() -> str:
-    """Get region from local metadata server
+    """Get region from local metadata server, once per process
     Region in format: projects/PROJECT_NUMBER/regions/REGION"""
+    import requests
+
     slug = "instance/region"
     data = requests.get(METADATA_URI + slug, headers={"Metadata-Flavor": "Google"})
     return data.content
@@ -36,6 +45,9 @@ def get_service_region() -> str:
 def authenticated_request(url: str, method: str) -> str:
     """Make a request with an ID token to a protected service
     https://cloud.google.com/functions/docs/securing/authenticating#functions-bearer-token-example-python"""
+    import google.auth.transport.requests
+    import google.oauth2.id_token
+    import requests
 
     auth_req = google.auth.transport.requests.Request()
     id_token = google.oauth2.id_token.fetch_id_token(auth_req, url)
@@ -0,0 +1,244 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
+from urllib.parse import parse_qs, urlparse
+
+from cachetools import TTLCache
+import discord
+
+import audio_cache
+from audio_cache import cache
+import jobs
+import opus
+from utils import metrics
+
+# youtube_dlは読み込みが重いので，動画を扱うときに初めてimportする
+if TYPE_CHECKING:
+    import youtube_dl
+
+YDL_OPTS = {
+    'format': 'bestaudio/best',
+    'noplaylist': True,
+    'quiet': True,
+    'no_warnings': True,
+}
+# プレイリストから一度に入れる曲数の上限と，曲の情報を同時に取りに行く数
+PLAYLIST_LIMIT = int(os.environ.get("PLAYLIST_LIMIT", 500))
+RESOLVE_CONCURRENCY = int(os.environ.get("YOUTUBE_RESOLVE_CONCURRENCY", 4))
+# /playの検索語でYouTubeを検索するときに取ってくる件数
+SEARCH_LIMIT = int(os.environ.get("YOUTUBE_SEARCH_LIMIT", 5))
+
+# キューに置いておく間は要らない，大きな項目（フォーマット一覧やサムネイルなど）
+HEAVY_INFO_KEYS = (
+    'formats', 'thumbnails', 'thumbnail', 'subtitles', 'automatic_captions',
+    'requested_subtitles', 'description', 'tags', 'categories', 'chapters',
+    'http_headers_all', 'requested_formats',
+)
+# ストリームのURLの期限が切れる何秒前から取り直すか
+EXPIRE_MARGIN = 60
+
+# ストリームが途中で切れたときにffmpegがつなぎ直すようにする
+FFMPEG_BEFORE_OPTIONS = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+FFMPEG_OPTIONS = '-vn'
+
+YOUTUBE_PREFIXES = (
+    'https://www.youtube.com',
+    'https://youtube.com',
+    'https://m.youtube.com',
+    'https://music.youtube.com',
+    'https://youtu.be',
+)
+
+
+def is_youtube_url(text: str) -> bool:
+    return text.startswith(YOUTUBE_PREFIXES)
+
+
+def video_id(url: str) -> Optional[str]:
+    """URLから動画IDを取り出す（ネットワークには出ない）"""
+    parsed = urlparse(url)
+    if parsed.netloc == 'youtu.be':
+        return parsed.path.lstrip('/').split('/')[0] or None
+    ids = parse_qs(parsed.query).get('v')
+    if ids:
+        return ids[0]
+    parts = parsed.path.strip('/').split('/')
+    if len(parts) == 2 and parts[0] in ('shorts', 'embed', 'live'):
+        return parts[1]
+    return None
+
+
+def is_playlist_url(url: str) -> bool:
+    """プレイリストのURL（/playlist?list=... や，動画IDのないlist付きのURL）ならTrue"""
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    return 'list' in query and (parsed.path == '/playlist' or 'v' not in query)
+
+
+def watch_url(vid: str) -> str:
+    return 'https://www.youtube.com/watch?v=' + vid
+
+
+def cache_key(url: str) -> Optional[str]:
+    vid = video_id(url)
+    return audio_cache.make_key('youtube', vid) if vid else None
+
+
+def slim(info: Dict[str, Any]) -> Dict[str, Any]:
+    """キューに長く置いても軽いように，再生とダウンロードに要る項目だけ残す"""
+    return {k: v for k, v in info.items() if k not in HEAVY_INFO_KEYS}
+
+
+def is_expired(info: Dict[str, Any]) -> bool:
+    """ストリームのURLの期限（expireパラメータ）が切れている，または切れそうならTrue"""
+    expire = parse_qs(urlparse(info['url']).query).get('expire')
+    if not expire:
+        return False
+    try:
+        return int(expire[0]) - EXPIRE_MARGIN < time.time()
+    except ValueError:
+        return False
+
+
+# 解決済みの動画情報（動画ID → slimした情報）．ストリームのURLは数時間で切れるので
+# それより短いTTLにし，取り出すときにも期限を確かめる
+RESOLVE_CACHE_TTL = int(os.environ.get("YOUTUBE_RESOLVE_CACHE_TTL", 4 * 3600))
+RESOLVE_CACHE_SIZE = int(os.environ.get("YOUTUBE_RESOLVE_CACHE_SIZE", 1024))
+_resolved: TTLCache = TTLCache(maxsize=RESOLVE_CACHE_SIZE, ttl=RESOLVE_CACHE_TTL)
+_resolving: Dict[str, asyncio.Future] = {}
+# YoutubeDLはスレッドセーフではないので，スレッドごとに1つ作って使い回す
+_local = threading.local()
+
+
+def _ydl() -> "youtube_dl.YoutubeDL":
+    ydl = getattr(_local, 'ydl', None)
+    if ydl is None:
+        import youtube_dl
+        ydl = _local.ydl = youtube_dl.YoutubeDL(YDL_OPTS)
+    return ydl
+
+
+def warm_up() -> None:
+    """youtube_dlを読み込んでおく（ブロックするのでスレッドで呼ぶ）"""
+    import youtube_dl  # noqa: F401
+
+
+def _extract(url: str) -> Dict[str, Any]:
+    return slim(_ydl().extract_info(url, download=False))
+
+
+def cached_info(url: str) -> Optional[Dict[str, Any]]:
+    """キャッシュにある，まだ使える動画情報を返す（ネットワークには出ない）"""
+    vid = video_id(url)
+    info = _resolved.get(vid) if vid else None
+    if info is None or is_expired(info):
+        return None
+    return info
+
+
+def _lookup(url: str) -> Optional[Dict[str, Any]]:
+    info = cached_info(url)
+    metrics.cache_result('youtube_resolve', info is not None)
+    return info
+
+
+async def resolve(url: str) -> Dict[str, Any]:
+    """動画の情報と音声ストリームのURLを取ってくる（イベントループの外で）．
+    最近解決した動画ならネットワークに出ずに返す"""
+    info = _lookup(url)
+    if info is not None:
+        return info
+    key = video_id(url) or url
+    future = _resolving.get(key)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = _resolving[key] = loop.run_in_executor(None, _extract, url)
+        future.add_done_callback(lambda f: _resolving.pop(key, None))
+    info = await asyncio.shield(future)
+    _resolved[info['id']] = info
+    return info
+
+
+def _extract_playlist(url: str) -> Dict[str, Any]:
+    # 中の動画は解決せず，IDとタイトルの一覧だけをもらう（1回のリクエストで済む）
+    import youtube_dl
+    opts = dict(YDL_OPTS, extract_flat='in_playlist', noplaylist=False, playlistend=PLAYLIST_LIMIT)
+    with youtube_dl.YoutubeDL(opts) as ydl:
+        return ydl.extract_info(url, download=False)
+
+
+def _entries(info: Dict[str, Any]) -> List[Dict[str, str]]:
+    entries = []
+    for entry in info.get('entries') or []:
+        vid = entry.get('id')
+        if vid:
+            entries.append({'id': vid, 'title': entry.get('title') or vid, 'url': watch_url(vid)})
+    return entries
+
+
+async def playlist_entries(url: str) -> List[Dict[str, str]]:
+    """プレイリストの動画を [{'id', 'title', 'url'}] で返す"""
+    loop = asyncio.get_running_loop()
+    info = await loop.run_in_executor(None, _extract_playlist, url)
+    return _entries(info)[:PLAYLIST_LIMIT]
+
+
+def _extract_search(word: str, limit: int) -> Dict[str, Any]:
+    # プレイリストと同じく，検索結果の動画は解決せずIDとタイトルだけをもらう
+    import youtube_dl
+    opts = dict(YDL_OPTS, extract_flat='in_playlist', noplaylist=False)
+    with youtube_dl.YoutubeDL(opts) as ydl:
+        return ydl.extract_info("ytsearch%d:%s" % (limit, word), download=False)
+
+
+async def search(word: str, limit: int = SEARCH_LIMIT) -> List[Dict[str, str]]:
+    """YouTubeを検索して，上位の動画を [{'id', 'title', 'url'}] で返す"""
+    loop = asyncio.get_running_loop()
+    info = await loop.run_in_executor(None, _extract_search, word, limit)
+    return _entries(info)[:limit]
+
+
+def stream_source(info: Dict[str, Any], offset: float = 0.0) -> discord.AudioSource:
+    """ダウンロードもmp3への変換もせず，ストリームをそのままffmpegに流す"""
+    before_options = FFMPEG_BEFORE_OPTIONS
+    if offset > 0:
+        before_options += " " + opus.seek_options(offset)
+    return discord.FFmpegPCMAudio(
+        info['url'],
+        before_options=before_options,
+        options=FFMPEG_OPTIONS,
+    )
+
+
+def _download(info: Dict[str, Any], key: str) -> None:
+    started = time.monotonic()
+    tmp = cache.tmp_path(key)
+    import youtube_dl
+    opts = dict(YDL_OPTS, outtmpl=tmp, nopart=True, continuedl=False)
+    with youtube_dl.YoutubeDL(opts) as ydl:
+        ydl.process_info(dict(info))
+    nbytes = os.path.getsize(tmp)
+    cache.set_meta(key, {'title': info['title']})
+    cache.commit(key, tmp)
+    metrics.record_fetch('youtube', nbytes, time.monotonic() - started)
+    opus.schedule_encode(key)
+
+
+def download(info: Dict[str, Any], priority: int = jobs.PRIORITY_BACKGROUND) -> "asyncio.Future[None]":
+    """変換せずにそのままキャッシュに落とす．同じ動画を落としている最中ならそれを待つ"""
+    key = audio_cache.make_key('youtube', info['id'])
+    return jobs.wait(jobs.fetch.submit(key, _download, info, key, priority=priority))
+
+
+def fill_cache(info: Dict[str, Any]) -> None:
+    """再生はストリームで始めつつ，次からすぐ再生できるよう裏でキャッシュに落としておく
+    （変換はしないのでCPUはほとんど使わない）"""
+    if audio_cache.make_key('youtube', info['id']) in cache:
+        return
+
+    def done(f: asyncio.Future) -> None:
+        if f.exception():
+            print(f.exception())
+    download(info).add_done_callback(done)